@@ -0,0 +1,245 @@
+"""Asyncio user engine, runs many virtual users in a single process."""
+
+import asyncio
+import concurrent.futures
+import logging
+import logging.handlers
+import queue
+import time
+
+from result import ResultColumns
+
+from session import Session
+
+
+class AsyncUserWorker:
+    """Run a group of coroutine based users in one worker process.
+
+    Each virtual user behaves like a User: it pulls a query, awaits the
+    plugin's async_request_func and pulls the next one. All users of a worker
+    share one results_pipe and the same message protocol as User, so the main
+    process treats a worker exactly like a (very busy) single user.
+    """
+
+    def __init__(
+        self,
+        worker_id,
+        user_ids,
+        dataset_q,
+        warmup_q,
+        stop_q,
+        results_pipe,
+        plugin,
+        logger_q,
+        log_level,
+        run_duration,
+        active_users=None,
+        queries=None,
+        results_buffer=None,
+        test_start=None,
+        results_sketch=None,
+        keep_output_text=True,
+    ):
+        """Initialize object."""
+        self.worker_id = worker_id
+        self.user_ids = user_ids
+        self.plugin = plugin
+        self.dataset_q = dataset_q
+        self.warmup_q = warmup_q
+        self.stop_q = stop_q
+        # Results are kept column wise until the end of the test
+        self.results_list = ResultColumns(keep_output_text)
+        self.results_pipe = results_pipe
+        # Optional ResultRingBuffer, results of the test are streamed through it instead of results_pipe
+        self.results_buffer = results_buffer
+        # Optional ResultsSketch, results of the test are only summarized in it and sent at the end
+        self.results_sketch = results_sketch
+        # Shared multiprocessing value set by the main process to the time the test starts
+        self.test_start = test_start
+        self.logger_q = logger_q
+        self.log_level = log_level
+        # Must get reset in worker process to use the logger created in _init_user_process_logging
+        self.logger = logging.getLogger("user")
+        self.run_duration = run_duration
+        # Shared multiprocessing value, a user is parked while its user_id is >= active_users.value
+        self.active_users = active_users
+        # Dataset partition of each user, keyed by user_id, iterated locally instead of
+        # reading from dataset_q. None when queries are scheduled through dataset_q.
+        self.queries = queries
+        self.query_indexes = dict.fromkeys(user_ids, 0)
+        # Conversation in progress of each user when the dataset is made of sessions
+        self.sessions = dict.fromkeys(user_ids)
+
+    def _init_user_process_logging(self):
+        """Init logging."""
+        qh = logging.handlers.QueueHandler(self.logger_q)
+        root = logging.getLogger()
+        root.setLevel(self.log_level)
+        root.handlers.clear()
+        root.addHandler(qh)
+
+        self.logger = logging.getLogger("user")
+        return logging.getLogger("user")
+
+    def _get_query(self):
+        """Blocking read from the shared dataset queue, run in the feeder thread."""
+        try:
+            return self.dataset_q.get(timeout=0.5)
+        except queue.Empty:
+            return None
+        except ValueError:
+            self.logger.warning("dataset q does not exist!")
+            return None
+
+    async def _feed_queries(self, executor):
+        """Move queries from the multiprocessing dataset_q to the local asyncio queue."""
+        loop = asyncio.get_running_loop()
+        while not self.stopped.is_set():
+            if self.active_users is not None and self.user_ids[0] >= self.active_users.value:
+                # Every user of this worker is parked, leave the queries to other workers
+                await asyncio.sleep(0.1)
+                continue
+            query = await loop.run_in_executor(executor, self._get_query)
+            if query is not None:
+                await self.query_q.put(query)
+
+    async def _watch_events(self):
+        """Poll the multiprocessing warmup/stop queues and mirror them as asyncio events."""
+        while not self.stopped.is_set():
+            if self.warmup_q is None or not self.warmup_q.empty():
+                self.warmup_done.set()
+            if not self.stop_q.empty():
+                self.stopped.set()
+            await asyncio.sleep(0.1)
+
+    def next_query(self, user_id):
+        """Return the next query of a user's dataset partition."""
+        queries = self.queries[user_id]
+        query = queries[self.query_indexes[user_id]]
+        self.query_indexes[user_id] = (self.query_indexes[user_id] + 1) % len(queries)
+        return query
+
+    async def make_request(self, user_id, test_end_time=0, from_queue=True):
+        """Make a request."""
+        if self.sessions[user_id] is not None:
+            query = self.sessions[user_id].next_query()
+        elif not from_queue:
+            query = self.next_query(user_id)
+        else:
+            try:
+                query = await asyncio.wait_for(self.query_q.get(), timeout=2)
+            except asyncio.TimeoutError:
+                # User should continue to poll for inputs
+                return None
+
+            if self.active_users is not None and user_id >= self.active_users.value:
+                # A stair-step parked this user while it was waiting, give the query back to an active user
+                self.query_q.put_nowait(query)
+                return None
+
+        if "turns" in query:
+            # First turn of a new conversation
+            self.sessions[user_id] = Session(query)
+            query = self.sessions[user_id].next_query()
+
+        self.logger.info("User %s making request", user_id)
+        if self.results_buffer is not None and test_end_time:
+            # Warmup requests (no test_end_time) are not streamed, so not counted either
+            self.results_buffer.request_started()
+        result = await self.plugin.async_request_func(query, user_id, test_end_time)
+        if query.get("scheduled_start_time") is not None:
+            result.scheduled_start_time = query["scheduled_start_time"]
+            result.dispatch_delay = query.get("dispatch_delay")
+            result.calculate_results()
+        session = self.sessions[user_id]
+        if session is not None:
+            result.turn = query["turn"]
+            session.add_response(query, result)
+            if session.done():
+                self.sessions[user_id] = None
+        return result
+
+    async def push_result(self, result):
+        """Append a result to the results buffer, other users keep running while it is full."""
+        while not self.results_buffer.try_push(result):
+            await asyncio.sleep(0.01)
+
+    async def run_user(self, user_id):
+        """Run a single virtual user until the test is stopped."""
+        if self.warmup_q is not None:
+            while not self.warmup_done.is_set():
+                result = await self.make_request(user_id)
+                # The main process expects one result per warmup query, a
+                # conversation stops after its first turn
+                self.sessions[user_id] = None
+                if result is not None:
+                    # During warmup, send results as soon as they are received
+                    self.results_pipe.send([result])
+
+        await self.warmup_done.wait()
+        # The test starts with new conversations
+        self.sessions[user_id] = None
+        if self.test_start is not None:
+            # Don't send anything before the main process starts the test timer
+            while self.test_start.value == 0 and not self.stopped.is_set():
+                await asyncio.sleep(0.01)
+            test_end_time = self.test_start.value + self.run_duration
+        else:
+            test_end_time = time.time() + self.run_duration
+        while not self.stopped.is_set():
+            if self.active_users is not None and user_id >= self.active_users.value:
+                # Parked until a later stair-step needs this user
+                await asyncio.sleep(0.1)
+                continue
+            result = await self.make_request(user_id, test_end_time, from_queue=self.queries is None)
+            # make_request will return None after 2 seconds if the queue is empty
+            # to ensure that users don't get stuck waiting for requests indefinitely
+            if result is not None:
+                if self.results_buffer is not None:
+                    await self.push_result(result)
+                elif self.results_sketch is not None:
+                    self.results_sketch.add(result)
+                else:
+                    self.results_list.append(result)
+
+    async def _run(self):
+        self.query_q = asyncio.Queue(maxsize=len(self.user_ids))
+        self.warmup_done = asyncio.Event()
+        self.stopped = asyncio.Event()
+
+        # A single dedicated thread does the blocking dataset_q reads for the whole worker
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        feeder = asyncio.create_task(self._feed_queries(executor))
+        watcher = asyncio.create_task(self._watch_events())
+        try:
+            await asyncio.gather(*(self.run_user(user_id) for user_id in self.user_ids))
+        finally:
+            self.stopped.set()
+            await watcher
+            # The feeder may be blocked on a full query_q once users stop consuming
+            feeder.cancel()
+            try:
+                await feeder
+            except asyncio.CancelledError:
+                pass
+            executor.shutdown(wait=True)
+            await self.plugin.async_close()
+
+    def run_worker_process(self):
+        """Run a process."""
+        self._init_user_process_logging()
+        self.logger.info(
+            "Worker %s starting %s users", self.worker_id, len(self.user_ids)
+        )
+
+        asyncio.run(self._run())
+
+        if self.results_buffer is not None:
+            self.results_buffer.close()
+        elif self.results_sketch is not None:
+            self.results_pipe.send(self.results_sketch)
+        else:
+            self.results_pipe.send(self.results_list)
+
+        time.sleep(4)
+        self.logger.info("Worker %s done", self.worker_id)
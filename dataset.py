@@ -1,10 +1,63 @@
 """Dataset class."""
+import hashlib
 import json
 import logging
+import mmap
+import os
 import random
 
+import numpy as np
+
 dataset_seed = 1337
 
+# Offset indexes of the dataset files and compiled queries are cached here, see load_index() and load_queries().
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "llm-load-test")
+
+# Bumped whenever the layout of the cached indexes changes.
+index_version = 2
+
+# Bumped whenever the layout of the compiled queries changes.
+compiled_version = 1
+
+# Bytes scanned at a time for line breaks when indexing a file.
+index_chunk_size = 64 * 1024 * 1024
+
+
+class CompiledQueries:
+    """Read only list of the queries compiled by compile_queries(), decoded on access.
+
+    The prompts are one UTF-8 blob and the other fields numpy columns, both
+    memory-mapped, so opening it costs the same whatever the number of
+    queries.
+    """
+
+    def __init__(self, path):
+        """Init method."""
+        self.columns = np.load(f"{path}.npy", mmap_mode="r")
+        with open(f"{path}.bin", "rb") as file:
+            # mmap can't map an empty file, all prompts can't be empty either
+            self._text = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if len(self.columns) else b""
+
+    def __len__(self):
+        """Return the number of queries."""
+        return len(self.columns)
+
+    def __getitem__(self, idx):
+        """Return query idx as a dict, or a list of them for a slice."""
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        start, end, input_id, input_tokens, output_tokens = self.columns[idx].tolist()
+        return {
+            "text": self._text[start:end].decode("utf-8"),
+            "input_id": input_id,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        }
+
+    def __iter__(self):
+        """Iterate over the queries."""
+        return (self[i] for i in range(len(self)))
+
 
 class Dataset:
     """Dataset class."""
@@ -17,21 +70,21 @@ class Dataset:
                  max_input_tokens=16000,
                  min_output_tokens=0,
                  max_output_tokens=4096,
-                 max_sequence_tokens=32000
+                 max_sequence_tokens=32000,
+                 cache_dir=default_cache_dir
                  ):
         """Init method."""
         logging.info("Initializing dataset with %s", locals())
-        self.dataset_list = [input for input in
-                             initialize_dataset(file,
-                                                model_name=model_name,
-                                                max_queries=max_queries,
-                                                min_input_tokens=min_input_tokens,
-                                                max_input_tokens=max_input_tokens,
-                                                min_output_tokens=min_output_tokens,
-                                                max_output_tokens=max_output_tokens,
-                                                max_sequence_tokens=max_sequence_tokens,
-                                                )
-                             ]
+        self.dataset_list = load_queries(file,
+                                         model_name=model_name,
+                                         max_queries=max_queries,
+                                         min_input_tokens=min_input_tokens,
+                                         max_input_tokens=max_input_tokens,
+                                         min_output_tokens=min_output_tokens,
+                                         max_output_tokens=max_output_tokens,
+                                         max_sequence_tokens=max_sequence_tokens,
+                                         cache_dir=cache_dir,
+                                         )
         if len(self.dataset_list) < 4:
             logging.warning("Total dataset is %s elements, check filters!", len(self.dataset_list))
         self.index = 0
@@ -43,6 +96,214 @@ class Dataset:
         self.index = (self.index + n) % max_index
         return [self.dataset_list[i] for i in next_n_indices]
 
+    def get_partition(self, index, count):
+        """Get the queries of partition index out of count, every count-th query starting at index.
+
+        Partitions are disjoint, deterministic for a given dataset_seed and
+        together cover the whole dataset. If there are more partitions than
+        queries, a partition gets a single (shared) query.
+        """
+        partition = self.dataset_list[index::count]
+        if not partition:
+            partition = [self.dataset_list[index % len(self.dataset_list)]]
+        return partition
+
+
+def compiled_columns():
+    """Return the numpy dtype of the columns of compiled queries."""
+    return np.dtype([
+        ("text_start", np.int64),
+        ("text_end", np.int64),
+        ("input_id", np.int64),
+        ("input_tokens", np.int64),
+        ("output_tokens", np.int64),
+    ])
+
+
+def compile_queries(path, queries):
+    """Write queries to path.bin (the prompts) and path.npy (offsets and the other fields).
+
+    Returns False without writing anything if they can't be compiled,
+    when an input_id isn't an integer.
+    """
+    if not all(type(query["input_id"]) is int for query in queries):
+        return False
+    texts = [query["text"].encode("utf-8") for query in queries]
+    columns = np.zeros(len(queries), dtype=compiled_columns())
+    ends = np.cumsum([len(text) for text in texts], dtype=np.int64)
+    columns["text_start"] = ends - [len(text) for text in texts]
+    columns["text_end"] = ends
+    for name in ("input_id", "input_tokens", "output_tokens"):
+        columns[name] = [query[name] for query in queries]
+
+    # Written to temporary files first and the columns last, the .npy only exists once both are complete
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(f"{tmp_path}.bin", "wb") as file:
+        file.writelines(texts)
+    os.replace(f"{tmp_path}.bin", f"{path}.bin")
+    np.save(f"{tmp_path}.npy", columns)
+    os.replace(f"{tmp_path}.npy", f"{path}.npy")
+    return True
+
+
+def load_queries(
+    filename,
+    model_name="",
+    max_queries=3000,
+    min_input_tokens=0,
+    max_input_tokens=16000,
+    min_output_tokens=0,
+    max_output_tokens=4096,
+    max_sequence_tokens=32000,
+    cache_dir=default_cache_dir
+):
+    """Return the queries of initialize_dataset(), compiled once into cache_dir.
+
+    The compiled queries are keyed by a hash of the content of the file,
+    the filters, max_queries, dataset_seed and the prompt format of
+    model_name, so any change to one of them compiles them again. Later
+    runs only map them in memory and decode the queries they use. A
+    cache_dir of None disables the cache and returns a list.
+    """
+    filters = {
+        "max_queries": max_queries,
+        "min_input_tokens": min_input_tokens,
+        "max_input_tokens": max_input_tokens,
+        "min_output_tokens": min_output_tokens,
+        "max_output_tokens": max_output_tokens,
+        "max_sequence_tokens": max_sequence_tokens,
+    }
+    if not cache_dir:
+        return list(initialize_dataset(filename, model_name=model_name, cache_dir=None, **filters))
+
+    digest = str(load_index(filename, cache_dir, names=["digest"])["digest"])
+    key = hashlib.sha256(json.dumps({
+        "version": compiled_version,
+        "digest": digest,
+        "dataset_seed": dataset_seed,
+        "prompt_format": get_format_string(model_name),
+        "filters": filters,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    path = os.path.join(os.path.expanduser(cache_dir), f"queries-{key}")
+    if os.path.exists(f"{path}.npy"):
+        try:
+            queries = CompiledQueries(path)
+            logging.info("Using the compiled queries %s of dataset file %s", path, filename)
+            return queries
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable compiled queries %s: %s", path, e)
+
+    queries = list(initialize_dataset(filename, model_name=model_name, cache_dir=cache_dir, **filters))
+    try:
+        if not compile_queries(path, queries):
+            logging.info("Not compiling the queries of dataset file %s, its index fields aren't all integers",
+                         filename)
+    except OSError as e:
+        logging.warning("Could not compile the queries of dataset file %s in %s: %s", filename, cache_dir, e)
+    return queries
+
+
+def line_bounds(buffer):
+    """Return the start and end offsets of the lines of buffer, as split by readlines()."""
+    breaks = [np.zeros(0, dtype=np.int64)]
+    for offset in range(0, len(buffer), index_chunk_size):
+        chunk = np.frombuffer(buffer, dtype=np.uint8, count=min(index_chunk_size, len(buffer) - offset),
+                              offset=offset)
+        breaks.append(np.flatnonzero(chunk == ord("\n")) + offset)
+    ends = np.concatenate(breaks) + 1
+    if len(buffer) and buffer[-1:] != b"\n":
+        # Last line without a line break
+        ends = np.append(ends, len(buffer))
+    starts = np.concatenate(([0], ends[:-1])).astype(np.int64)
+    return starts, ends
+
+
+def build_index(filename):
+    """Index the lines of a dataset file, skipping its first (metadata) line.
+
+    Returns a dict of numpy arrays with one entry per line: its start and
+    end offsets in the file, its input and output token lengths and
+    whether it is a valid query at all (JSON with all the fields
+    initialize_dataset() needs), and the SHA-256 digest of the file. Each
+    line is decoded once here, the prompts are not kept.
+    """
+    index = {
+        "digest": np.array(hashlib.sha256(b"").hexdigest()),
+        "starts": np.zeros(0, dtype=np.int64),
+        "ends": np.zeros(0, dtype=np.int64),
+        "input_tokens": np.zeros(0, dtype=np.int64),
+        "output_tokens": np.zeros(0, dtype=np.int64),
+        "valid": np.zeros(0, dtype=bool),
+    }
+    with open(filename, "rb") as file:
+        if not os.fstat(file.fileno()).st_size:
+            # mmap can't map an empty file
+            return index
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            index["digest"] = np.array(hashlib.sha256(buffer).hexdigest())
+            starts, ends = line_bounds(buffer)
+            index["starts"] = starts[1:]
+            index["ends"] = ends[1:]
+            index["input_tokens"], index["output_tokens"], index["valid"] = index_lines(buffer, starts[1:], ends[1:])
+    return index
+
+
+def index_lines(buffer, starts, ends):
+    """Return the input and output token lengths of the lines of buffer and whether they are valid queries."""
+    input_tokens = np.full(len(starts), -1, dtype=np.int64)
+    output_tokens = np.full(len(starts), -1, dtype=np.int64)
+    valid = np.zeros(len(starts), dtype=bool)
+    for idx, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        try:
+            json_object = json.loads(buffer[start:end].strip())
+            input_tokens[idx] = int(json_object["tok_input_length"])
+            output_tokens[idx] = int(json_object["tok_output_length"])
+            valid[idx] = all(key in json_object for key in ("question", "system_prompt", "index"))
+        except (ValueError, TypeError, KeyError, OverflowError):
+            # Logged when the line is reached by initialize_dataset()
+            continue
+    return input_tokens, output_tokens, valid
+
+
+def index_cache_path(filename, cache_dir):
+    """Return the path of the cached index of filename in cache_dir."""
+    key = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"index-{key}.npz")
+
+
+def load_index(filename, cache_dir=default_cache_dir, names=None):
+    """Return the index of build_index(), from cache_dir when the file hasn't changed since it was cached.
+
+    The cache is keyed by the absolute path of the file and invalidated
+    when its size or modification time change. A cache_dir of None
+    disables the cache. names restricts the arrays read from the cache.
+    """
+    stat = os.stat(filename)
+    stamp = np.array([index_version, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+    path = index_cache_path(filename, cache_dir) if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            with np.load(path) as cached:
+                if np.array_equal(cached["stamp"], stamp):
+                    logging.info("Using the cached index %s of dataset file %s", path, filename)
+                    return {name: cached[name] for name in names or cached.files if name != "stamp"}
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Ignoring unreadable dataset index %s: %s", path, e)
+
+    logging.info("Indexing dataset file %s", filename)
+    index = build_index(filename)
+    if path:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written to a temporary file first, so that concurrent runs never read a partial index
+            tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, stamp=stamp, **index)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Could not cache the index of dataset file %s in %s: %s", filename, cache_dir, e)
+    return index
+
 
 def initialize_dataset(
     filename,
@@ -52,55 +313,51 @@ def initialize_dataset(
     max_input_tokens=16000,
     min_output_tokens=0,
     max_output_tokens=4096,
-    max_sequence_tokens=32000
+    max_sequence_tokens=32000,
+    cache_dir=default_cache_dir
 ):
-    """Initialize the dataset."""
+    """Initialize the dataset.
+
+    Yields up to max_queries queries passing filter_token_lengths(), in
+    the order of the lines shuffled with dataset_seed. The lines are
+    filtered on the (cached) index, only the selected ones are read.
+    """
     prompt_format = get_format_string(model_name)
-    with open(filename, "r", encoding="utf-8") as file:
-        total_queries = 0
-
-        # [1:] to skip the first line, it contains metadata
-        lines = file.readlines()[1:]
-        random.Random(dataset_seed).shuffle(lines)
-
-        for line in lines:
-            # Load each line as a JSON object
-            try:
-                json_object = json.loads(line.strip())
-            except json.JSONDecodeError as e:
-                logging.error("Error decoding JSON in file %s %s", filename, e)
-                continue
-            try:
-                input_tokens = int(json_object["tok_input_length"])
-                output_tokens = int(json_object["tok_output_length"])
-                prompt = json_object["question"]
-                system_prompt = json_object["system_prompt"]
-                input_id = json_object["index"]
-            except KeyError as e:
-                logging.error(
-                    "Unexpected format in dataset file %s, KeyError: %s, \n %s", filename, e, json_object
-                )
-                continue
-                # TODO exit or just skip here?
-            token_lengths_ok = filter_token_lengths(input_tokens,
-                                                    output_tokens,
-                                                    min_input_tokens,
-                                                    max_input_tokens,
-                                                    min_output_tokens,
-                                                    max_output_tokens,
-                                                    max_sequence_tokens)
-            if (token_lengths_ok):
-                input_data = {
-                    "text": prompt_format.format(prompt=prompt,
-                                                 system_prompt=system_prompt),
-                    "input_id": input_id,
-                    "input_tokens": input_tokens,
-                    "output_tokens": output_tokens,
-                }
-                total_queries = total_queries + 1
-                yield input_data
-                if total_queries >= max_queries:
-                    break
+    index = load_index(filename, cache_dir)
+
+    # Shuffling the line numbers gives the same permutation as shuffling the lines themselves
+    order = list(range(len(index["starts"])))
+    random.Random(dataset_seed).shuffle(order)
+    order = np.array(order, dtype=np.int64)
+
+    # Invalid lines are skipped as they come, they don't count towards max_queries
+    token_lengths_ok = filter_token_lengths(index["input_tokens"],
+                                            index["output_tokens"],
+                                            min_input_tokens,
+                                            max_input_tokens,
+                                            min_output_tokens,
+                                            max_output_tokens,
+                                            max_sequence_tokens)
+    selected = order[(token_lengths_ok & index["valid"])[order]][:max_queries]
+    if not len(selected):
+        return
+    last = int(np.flatnonzero(order == selected[-1])[0])
+    for line_number in order[:last][~index["valid"][order[:last]]].tolist():
+        logging.error("Skipping invalid line %s of dataset file %s", line_number + 2, filename)
+
+    with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        starts = index["starts"]
+        ends = index["ends"]
+        for line_number in selected.tolist():
+            json_object = json.loads(buffer[starts[line_number]:ends[line_number]].strip())
+            input_data = {
+                "text": prompt_format.format(prompt=json_object["question"],
+                                             system_prompt=json_object["system_prompt"]),
+                "input_id": json_object["index"],
+                "input_tokens": int(index["input_tokens"][line_number]),
+                "output_tokens": int(index["output_tokens"][line_number]),
+            }
+            yield input_data
 
 
 def filter_token_lengths(input_tokens,
@@ -110,13 +367,13 @@ def filter_token_lengths(input_tokens,
                          min_output_tokens,
                          max_output_tokens,
                          max_sequence_tokens):
-    """Filter the tokens by length."""
+    """Filter the tokens by length, of single queries or numpy arrays of them."""
     sequence_tokens = input_tokens + output_tokens
-    return (output_tokens > min_output_tokens
-            and output_tokens < max_output_tokens
-            and input_tokens < max_input_tokens
-            and input_tokens > min_input_tokens
-            and sequence_tokens < max_sequence_tokens)
+    return ((output_tokens > min_output_tokens)
+            & (output_tokens < max_output_tokens)
+            & (input_tokens < max_input_tokens)
+            & (input_tokens > min_input_tokens)
+            & (sequence_tokens < max_sequence_tokens))
 
 
 def get_format_string(model_name):
@@ -15,13 +15,17 @@
 # limitations under the License.
 
 import os
+import re
 import time
 import argparse
+import numpy as np
 import pandas as pd
 import pickle
 import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
-tqdm.pandas()
 from dataclasses import dataclass
 from functools import partial
 from pathlib import Path
@@ -29,26 +33,40 @@ from transformers import LlamaTokenizerFast
 from typing import Dict
 
 
+# ASCII plus the characters taken from Habana: Unicode quotes and hyphens
+english_pattern = re.compile(r"[\x00-\x7f’–“”—]*")
+
+
 def is_english(s):
-    for c in s:
-        allowed = c.isascii()
-        allowed = allowed or (c in ['’', '–', '“', '”', '—'])  # Taken from Habana: Unicode quotes and hyphens
-        if not allowed:
-            return False
-    return True
+    return english_pattern.fullmatch(s) is not None
+
+
+def english_mask(texts: pd.Series) -> pd.Series:
+    # One regex match per string in C instead of a Python loop per character
+    return texts.str.fullmatch(english_pattern, na=False)
+
+
+_worker_tokenizer = None
 
 
-def _tokenize_helper(x, llama_tokenizer=None, append_response_init_token=False):
-    if not isinstance(x, str):
-        return []
+def _init_tokenizer_worker(model_dir):
+    global _worker_tokenizer
+    # Each worker process tokenizes its own batch, don't let the Rust tokenizer spawn threads on top of that
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = LlamaTokenizerFast.from_pretrained(model_dir)
 
-    tokens = llama_tokenizer(x)["input_ids"]
 
+def _token_lengths_helper(texts, append_response_init_token=False):
+    """Return the token count of each string of a batch, 0 for missing values."""
+    is_text = [isinstance(x, str) for x in texts]
+    encoded = _worker_tokenizer([x for x, ok in zip(texts, is_text) if ok])["input_ids"]
+    lengths = np.zeros(len(texts), dtype=np.int64)
+    lengths[np.flatnonzero(is_text)] = [len(tokens) for tokens in encoded]
     if append_response_init_token:
         # Workaround to enable cheat checking for first token: Llama always outputs token 29871 first
         # It is possible for submitters to just immediately output this token to achieve a very fast TTFT.
-        tokens.append(29871)
-    return tokens
+        lengths[np.asarray(is_text, dtype=bool)] += 1
+    return lengths
 
 
 @dataclass
@@ -65,13 +83,17 @@ class OpenOrcaDatasetGenerator:
                  model_dir: os.PathLike,
                  io_token_limit: int,
                  output_json_file: str,
-                 calibration_subset_size: int = 1000
+                 calibration_subset_size: int = 1000,
+                 num_workers: int = None,
+                 chunk_size: int = 8192
                  ):
         self.pq_path = Path(pq_path)
         self.model_dir = Path(model_dir)
         self.io_token_limit = io_token_limit
         self.keyphrases = []
         self.calibration_subset_size = calibration_subset_size
+        self.num_workers = num_workers or os.cpu_count()
+        self.chunk_size = chunk_size
 
     def load_parquet(self, parquet_elements=None) -> pd.DataFrame:
         df = pd.read_parquet(self.pq_path)
@@ -80,37 +102,36 @@ class OpenOrcaDatasetGenerator:
             return df[:parquet_elements]
         return df
 
-    def get_token_lengths(self, df) -> pd.DataFrame:
-        print(f"Tokenizing input")
+    def _token_lengths(self, executor, texts: pd.Series, append_response_init_token: bool) -> np.ndarray:
+        texts = texts.tolist()
+        chunks = [texts[idx:idx + self.chunk_size] for idx in range(0, len(texts), self.chunk_size)]
+        helper = partial(_token_lengths_helper, append_response_init_token=append_response_init_token)
+        # map() keeps the chunks in order
+        lengths = list(tqdm(executor.map(helper, chunks), total=len(chunks)))
+        return np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
 
-        llama_tokenizer = LlamaTokenizerFast.from_pretrained(self.model_dir)
+    def get_token_lengths(self, df) -> pd.DataFrame:
+        # Only the token counts are used, batches of chunk_size strings are tokenized by num_workers processes
+        print(f"Tokenizing input with {self.num_workers} processes")
 
         tik = time.time()
-
-        input_tokenizer = partial(_tokenize_helper, llama_tokenizer=llama_tokenizer)
-        output_tokenizer = partial(_tokenize_helper, llama_tokenizer=llama_tokenizer, append_response_init_token=False)
-        df['tok_input'] = df['question'].progress_apply(input_tokenizer)
-        df['tok_output'] = df['output'].progress_apply(output_tokenizer)
+        with ProcessPoolExecutor(max_workers=self.num_workers,
+                                 initializer=_init_tokenizer_worker,
+                                 initargs=(self.model_dir,)) as executor:
+            df['tok_input_length'] = self._token_lengths(executor, df['question'], append_response_init_token=False)
+            df['tok_output_length'] = self._token_lengths(executor, df['output'], append_response_init_token=False)
         tok = time.time()
         print(f"Tokenized in {tok-tik} sec.")
         return df
 
     def filter_english(self, df: pd.DataFrame) -> pd.DataFrame:
-        df['input_english'] = df['question'].apply(is_english)
-        df['output_english'] = df['output'].apply(is_english)
-        df['all_english'] = df['input_english'] & df['output_english']
-
         # Filter based on english tokens
-        df = df[df['all_english']].drop(["input_english", "output_english", "all_english"], axis=1)
+        df = df[english_mask(df['question']) & english_mask(df['output'])]
         return df.reset_index(drop=True)
 
     def filter_seqlen_oob(self, df: pd.DataFrame) -> pd.DataFrame:
-        df['tok_input_length'] = df['tok_input'].apply(lambda x: len(x))
-        df['tok_output_length'] = df['tok_output'].apply(lambda x: len(x))
-
         # Filter based on sequence length (2048, 2048)
-        df = df[df["tok_input_length"] < self.io_token_limit]
-        df = df[df["tok_output_length"] < self.io_token_limit]
+        df = df[(df["tok_input_length"] < self.io_token_limit) & (df["tok_output_length"] < self.io_token_limit)]
         return df.reset_index(drop=True)
     
     def filter_output_oob(self, df: pd.DataFrame, output_limit: int=4096) -> pd.DataFrame:
@@ -160,33 +181,34 @@ class OpenOrcaDatasetGenerator:
         return df.sample(n=_N, random_state=rng_seed)
 
 
-    def _get_distributed_subset(self, df, step_size: int = 64, rng_seed: int = 1337):
-        outputs=[]
-        for input_lower in range(0, 12288, step_size):
-            input_upper = input_lower + step_size
-            for output_lower in range(0, 12288, step_size):
-                output_upper = output_lower + step_size
-                
-                data_subset = df[(df['tok_input_length'] > input_lower) & (df['tok_input_length'] < input_upper) & (df['tok_output_length'] > output_lower) & (df['tok_output_length'] < output_upper)]
-                elements_in_region = len(data_subset)
-                if elements_in_region > 0:
-                    # If there are 4 or fewer elements in the region, just take all of them
-                    # otherwise take fourth root+3 of the elements in the region
-                    if elements_in_region < 5:
-                        subset_sample_size = elements_in_region
-                    else:
-                        subset_sample_size = 3 + ((elements_in_region - 3))**(1/4)
-                    print(f"In tile: {input_lower}:{input_upper}, {output_lower}:{output_upper}, subset_sample_size: {subset_sample_size}")
-                    #subset_sample=max(1, (len(data_subset))**(1./3.))
-                    # sample from the subset
-                    sample = data_subset.sample(n=int(subset_sample_size), random_state=rng_seed)
-                    outputs.append(sample)
+    def _get_distributed_subset(self, df, step_size: int = 64, max_length: int = 12288, rng_seed: int = 1337):
+        # Tiles of step_size input by step_size output tokens, like the former loop over every tile
+        # lengths on a tile boundary are left out, so the same seed samples the same subset.
+        input_lengths = df['tok_input_length'].to_numpy()
+        output_lengths = df['tok_output_length'].to_numpy()
+        in_tile = ((input_lengths % step_size != 0) & (output_lengths % step_size != 0)
+                   & (input_lengths < max_length) & (output_lengths < max_length))
+        tiled = df[in_tile]
+        tiles = [tiled['tok_input_length'] // step_size, tiled['tok_output_length'] // step_size]
+
+        outputs = []
+        # A single pass over the rows, tiles come sorted by input then output tile
+        for (input_tile, output_tile), data_subset in tiled.groupby(tiles, sort=True):
+            elements_in_region = len(data_subset)
+            # If there are 4 or fewer elements in the region, just take all of them
+            # otherwise take fourth root+3 of the elements in the region
+            if elements_in_region < 5:
+                subset_sample_size = elements_in_region
+            else:
+                subset_sample_size = 3 + ((elements_in_region - 3))**(1/4)
+            # sample from the subset
+            outputs.append(data_subset.sample(n=int(subset_sample_size), random_state=rng_seed))
+        print(f"Sampled {sum(len(sample) for sample in outputs)} samples from {len(outputs)} tiles")
 
         return pd.concat(outputs, ignore_index=True).reset_index(drop=True)
 
-    def _write_to_json_and_jsonl(self, df, output_name):
-            df = df.drop('tok_input', axis=1)
-            df = df.drop('tok_output', axis=1)
+    def _write_to_parquet_and_jsonl(self, df, output_name):
+            df = df.drop(columns=['tok_input', 'tok_output'], errors='ignore')
             df = df.rename(columns={"output": "expected_output"})
             df = df.sort_values(by=['tok_input_length', 'tok_output_length'])
             df = df.reset_index(drop=True).reset_index()
@@ -195,22 +217,16 @@ class OpenOrcaDatasetGenerator:
             metadata = {"name": "openorca-subset", 
                         "version": "0.1.1", 
                         "license": "MIT License\n\nCopyright (c) [year] [fullname]\n\nPermission is hereby granted, free of charge, to any person obtaining a copy\nof this software and associated documentation files (the \"Software\"), to deal\nin the Software without restriction, including without limitation the rights\nto use, copy, modify, merge, publish, distribute, sublicense, and/or sell\ncopies of the Software, and to permit persons to whom the Software is\nfurnished to do so, subject to the following conditions:\n\nThe above copyright notice and this permission notice shall be included in all\ncopies or substantial portions of the Software.\n\nTHE SOFTWARE IS PROVIDED \"AS IS\", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR\nIMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,\nFITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE\nAUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER\nLIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,\nOUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE\nSOFTWARE.\n"}
-            ### .json file
-            json_obj = {"dataset": df.to_dict(), "metadata": metadata}
-                        
-            with open(f"{output_name}.json", 'w') as f:
-                json.dump(json_obj, f, indent=4)
-            
-
-            ### jsonl file
-            list_of_dicts = df.to_dict('records')
-            list_of_dicts.insert(0, metadata)
+            ### .parquet file, columnar with the metadata in the schema
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata(dict(table.schema.metadata or {}, dataset=json.dumps(metadata)))
+            pq.write_table(table, f"{output_name}.parquet", compression="zstd")
+
+            ### .jsonl file, the metadata line then one record per line
             with open(f"{output_name}.jsonl", 'w') as f:
-                for d in list_of_dicts:
-                    json.dump(d, f)
-                    f.write('\n')
-            #df.to_json("openorca_large_subset_011.jsonl", orient='records', lines=True)
-            #df.to_json("openorca_large_subset_011.json", orient='records', lines=False)
+                json.dump(metadata, f)
+                f.write('\n')
+                df.to_json(f, orient='records', lines=True)
 
     def generate(self,
                  export_dir: os.PathLike,
@@ -253,7 +269,7 @@ class OpenOrcaDatasetGenerator:
         print(len(df))
         df.to_pickle(export_dir / f"open_orca_gpt4_tokenized_llama.sampled.pkl")
 
-        self._write_to_json_and_jsonl(df, output_json_file)
+        self._write_to_parquet_and_jsonl(df, output_json_file)
  
 
 def parse_arguments():
@@ -269,6 +285,8 @@ def parse_arguments():
     parser.add_argument('--num_total_samples', type=int, default=24576, help="Number of samples to generate")
     parser.add_argument('--output_json_file', type=str, default="openorca_large_subset_011", help="Number of samples to generate")
     parser.add_argument('--calibration_subset_size', type=int, default=1000, help="Number of samples for calibration subset")
+    parser.add_argument('--num_workers', type=int, default=None, help="Tokenizer processes, defaults to the CPU count")
+    parser.add_argument('--chunk_size', type=int, default=8192, help="Strings per batched tokenizer call")
     return parser.parse_args()
 
 
@@ -280,7 +298,9 @@ if __name__ == "__main__":
         model_dir=args.model_dir,
         io_token_limit=args.seqlen_limit,
         calibration_subset_size=args.calibration_subset_size,
-        output_json_file=args.output_json_file
+        output_json_file=args.output_json_file,
+        num_workers=args.num_workers,
+        chunk_size=args.chunk_size
     )
     ds_gen.generate(
         export_dir=args.export_dir,
@@ -0,0 +1,348 @@
+"""Distributed load generation, a coordinator drives load_test agents on other hosts.
+
+Coordinator and agents talk over a plain TCP connection, one JSON message
+per line. A test run is one connection:
+
+    coordinator -> agent  {"type": "clock"}                  (repeated)
+    agent -> coordinator  {"type": "clock", "time": ...}
+    coordinator -> agent  {"type": "prepare", "config": ..., "agent_index": i, "agent_count": n}
+    agent -> coordinator  {"type": "ready"}                  (users started and warmed up)
+    coordinator -> agent  {"type": "start", "start_time": ...} (in the agent's clock)
+    agent -> coordinator  {"type": "results", "results": [...], "step_windows": ...}
+
+Any failure on the agent is reported as {"type": "error", "message": ...}.
+"""
+
+import copy
+import json
+import logging
+import multiprocessing as mp
+import socket
+import time
+from array import array
+
+import logging_utils
+
+from result import RequestResult
+
+from scheduler import sleep_until
+
+from sketch import ResultsSketch
+
+import utils
+
+# Result fields holding absolute timestamps, shifted from agent to coordinator clock.
+time_fields = ["scheduled_start_time", "start_time", "ack_time", "first_token_time", "end_time"]
+
+
+class AgentError(RuntimeError):
+    """Raised when an agent reports an error or the connection fails."""
+
+
+class Connection:
+    """Newline delimited JSON messages over a socket."""
+
+    def __init__(self, sock):
+        """Init method."""
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+
+    def send(self, message):
+        """Send one message."""
+        self.sock.sendall(json.dumps(message, default=str).encode("utf-8") + b"\n")
+
+    def recv(self, expected_type=None):
+        """Receive one message, optionally checking its type."""
+        line = self.reader.readline()
+        if not line:
+            raise AgentError("Connection closed by peer")
+        message = json.loads(line)
+        if message.get("type") == "error":
+            raise AgentError(message.get("message"))
+        if expected_type is not None and message.get("type") != expected_type:
+            raise AgentError(f"Expected a {expected_type} message, got {message.get('type')}")
+        return message
+
+    def close(self):
+        """Close the connection."""
+        self.reader.close()
+        self.sock.close()
+
+
+def parse_address(address, default_host="0.0.0.0"):
+    """Parse a "host:port" or "port" string."""
+    host, _, port = str(address).rpartition(":")
+    return host or default_host, int(port)
+
+
+def split_evenly(total, count, index):
+    """Return the share of an integer total given to index out of count."""
+    return total // count + (1 if index < total % count else 0)
+
+
+def split_load_options(load_options, count, index):
+    """Return the load_options of agent index out of count, concurrency and rates are divided between agents.
+
+    Every agent runs at least one user, so a concurrency level smaller than
+    the number of agents raises ValueError instead of adding users.
+    """
+    agent_options = dict(load_options)
+    concurrency = load_options.get("concurrency")
+    levels = concurrency if isinstance(concurrency, list) else [concurrency]
+    if any(level is not None and level < count for level in levels):
+        raise ValueError(f"load_options.concurrency {concurrency} can't be split between {count} agents, "
+                         "every concurrency level must be at least the number of agents")
+    if isinstance(concurrency, list):
+        agent_options["concurrency"] = [split_evenly(c, count, index) for c in concurrency]
+    elif concurrency is not None:
+        agent_options["concurrency"] = split_evenly(concurrency, count, index)
+    rate = load_options.get("rate")
+    if isinstance(rate, list):
+        agent_options["rate"] = [step_rate / count for step_rate in rate]
+    elif rate is not None:
+        agent_options["rate"] = rate / count
+    return agent_options
+
+
+def result_to_dict(result):
+    """Return the fields of a RequestResult as a JSON serializable dict."""
+    values = dict(result.asdict())
+    if values.get("itl_deltas") is not None:
+        values["itl_deltas"] = values["itl_deltas"].tolist()
+    return values
+
+
+def result_from_dict(values, time_offset=0.0, user_id_offset=0):
+    """Rebuild a RequestResult sent by an agent, shifting its timestamps by -time_offset."""
+    result = RequestResult(values["user_id"], values["input_id"], values["input_tokens"])
+    for name, value in values.items():
+        setattr(result, name, value)
+    if result.itl_deltas is not None:
+        result.itl_deltas = array("f", result.itl_deltas)
+    for name in time_fields:
+        if getattr(result, name) is not None:
+            setattr(result, name, getattr(result, name) - time_offset)
+    result.user_id = result.user_id + user_id_offset
+    return result
+
+
+# Agent side
+
+def run_agent(address, log_level, run_load_test):
+    """Serve test runs from a coordinator, one run per connection, until interrupted.
+
+    run_load_test is load_test.run_load_test, passed in to avoid a circular import.
+    """
+    mp_ctx = mp.get_context("spawn")
+    logger_q = mp_ctx.Queue()
+    log_reader_thread = logging_utils.init_logging(log_level, logger_q)
+
+    host, port = parse_address(address)
+    server = socket.create_server((host, port))
+    logging.info("Agent listening on %s:%s", host, port)
+    try:
+        while True:
+            sock, peer = server.accept()
+            logging.info("Coordinator connected from %s", peer)
+            conn = Connection(sock)
+            try:
+                serve_run(conn, mp_ctx, logger_q, log_level, run_load_test)
+            except Exception as e:
+                logging.exception("Agent run failed")
+                try:
+                    conn.send({"type": "error", "message": repr(e)})
+                except OSError:
+                    pass
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        logging.info("Agent shutting down")
+    finally:
+        server.close()
+        logger_q.put(None)
+        log_reader_thread.join()
+
+
+def serve_run(conn, mp_ctx, logger_q, log_level, run_load_test):
+    """Answer clock probes, then run the test the coordinator prepares."""
+    while True:
+        message = conn.recv()
+        if message["type"] == "clock":
+            conn.send({"type": "clock", "time": time.time()})
+        elif message["type"] == "prepare":
+            break
+        else:
+            raise AgentError(f"Unexpected message {message['type']}")
+
+    config = message["config"]
+    concurrency, duration, plugin = utils.parse_config(config)
+
+    def wait_for_start():
+        conn.send({"type": "ready"})
+        start_time = conn.recv("start")["start_time"]
+        logging.info("Starting test in %.3f s", start_time - time.time())
+        sleep_until(start_time)
+
+    stop_q = mp_ctx.Queue(1)
+    dataset_q = mp_ctx.Queue()
+    warmup_q = mp_ctx.Queue(1)
+    procs = []
+    results_pipes = []
+    try:
+        results_list, step_windows = run_load_test(
+            config,
+            concurrency,
+            duration,
+            plugin,
+            mp_ctx,
+            logger_q,
+            log_level,
+            procs,
+            results_pipes,
+            dataset_q,
+            warmup_q,
+            stop_q,
+            dataset_partition=(message["agent_index"], message["agent_count"]),
+            before_start=wait_for_start,
+        )
+    finally:
+        # Release the users whatever happened, like load_test.exit_gracefully
+        if warmup_q.empty():
+            warmup_q.put(None)
+        if stop_q.empty():
+            stop_q.put(None)
+        while not dataset_q.empty():
+            dataset_q.get()
+        for proc in procs:
+            proc.join()
+
+    if isinstance(results_list, ResultsSketch):
+        conn.send({"type": "results", "sketch": results_list.to_dict()})
+        logging.info("Sent the summary of %d results to the coordinator", results_list.total_requests)
+        return
+
+    conn.send({
+        "type": "results",
+        "results": [result_to_dict(result) for result in results_list],
+        "step_windows": step_windows,
+    })
+    logging.info("Sent %d results to the coordinator", len(results_list))
+
+
+# Coordinator side
+
+def estimate_clock_offset(conn, samples=8):
+    """Estimate agent clock minus coordinator clock, NTP style from the probe with the lowest round trip."""
+    best_rtt, best_offset = None, 0.0
+    for _ in range(samples):
+        send_time = time.time()
+        conn.send({"type": "clock"})
+        agent_time = conn.recv("clock")["time"]
+        recv_time = time.time()
+        rtt = recv_time - send_time
+        if best_rtt is None or rtt < best_rtt:
+            best_rtt = rtt
+            best_offset = agent_time - (send_time + recv_time) / 2
+    return best_offset, best_rtt
+
+
+def run_coordinator(config):
+    """Run the test described by config on all agents, return the merged results and stair-step windows."""
+    distributed_options = config["distributed"]
+    agents = distributed_options["agents"]
+    start_delay = distributed_options.get("start_delay", 2)
+    connect_timeout = distributed_options.get("connect_timeout", 10)
+    agent_count = len(agents)
+    if config["load_options"].get("type") == "search":
+        raise ValueError("load_options.type search adjusts the load live and can't be distributed")
+    # Each agent gets its share of the load, checked before connecting to any agent
+    agent_load_options = [split_load_options(config["load_options"], agent_count, idx) for idx in range(agent_count)]
+
+    conns = []
+    try:
+        for address in agents:
+            host, port = parse_address(address, default_host="localhost")
+            sock = socket.create_connection((host, port), timeout=connect_timeout)
+            # Runs can last for hours, only the connect is bounded
+            sock.settimeout(None)
+            conns.append(Connection(sock))
+
+        offsets = []
+        for address, conn in zip(agents, conns):
+            offset, rtt = estimate_clock_offset(conn)
+            logging.info("Agent %s clock offset %.3f ms, round trip %.3f ms", address, 1000 * offset, 1000 * rtt)
+            offsets.append(offset)
+        distributed_options["clock_offsets_ms"] = [1000 * offset for offset in offsets]
+
+        # Each agent gets its share of the load and of the dataset
+        user_id_offsets = []
+        user_id_offset = 0
+        for idx, conn in enumerate(conns):
+            agent_config = copy.deepcopy(config)
+            del agent_config["distributed"]
+            agent_config["load_options"] = agent_load_options[idx]
+            conn.send({"type": "prepare", "config": agent_config, "agent_index": idx, "agent_count": agent_count})
+            user_id_offsets.append(user_id_offset)
+            agent_concurrency = agent_config["load_options"].get("concurrency")
+            user_id_offset += max(agent_concurrency) if isinstance(agent_concurrency, list) else agent_concurrency
+
+        logging.info("Waiting for %d agents to be ready", agent_count)
+        for conn in conns:
+            conn.recv("ready")
+
+        start_time = time.time() + start_delay
+        logging.info("All agents ready, starting at %s", start_time)
+        for conn, offset in zip(conns, offsets):
+            conn.send({"type": "start", "start_time": start_time + offset})
+
+        results_list = []
+        agent_step_windows = []
+        for address, conn, offset, id_offset in zip(agents, conns, offsets, user_id_offsets):
+            message = conn.recv("results")
+            if "sketch" in message:
+                agent_sketch = sketch_from_dict(message["sketch"], time_offset=offset)
+                logging.info("Received the summary of %d results from agent %s", agent_sketch.total_requests, address)
+                if results_list:
+                    results_list.merge(agent_sketch)
+                else:
+                    results_list = agent_sketch
+                continue
+            logging.info("Received %d results from agent %s", len(message["results"]), address)
+            results_list.extend(
+                result_from_dict(values, time_offset=offset, user_id_offset=id_offset)
+                for values in message["results"]
+            )
+            if message.get("step_windows") is not None:
+                agent_step_windows.append((message["step_windows"], offset))
+    finally:
+        for conn in conns:
+            conn.close()
+
+    return results_list, merge_step_windows(agent_step_windows)
+
+
+def sketch_from_dict(values, time_offset=0.0):
+    """Rebuild a ResultsSketch sent by an agent, shifting its timestamps by -time_offset."""
+    results_sketch = ResultsSketch.from_dict(values)
+    for name in ("start_time", "end_time"):
+        if getattr(results_sketch, name) is not None:
+            setattr(results_sketch, name, getattr(results_sketch, name) - time_offset)
+    return results_sketch
+
+
+def merge_step_windows(agent_step_windows):
+    """Combine the stair-step windows of all agents into coordinator clock windows covering every agent."""
+    if not agent_step_windows:
+        return None
+    merged = []
+    for steps in zip(*(windows for windows, _ in agent_step_windows)):
+        window = dict(steps[0])
+        window["start_time"] = min(step["start_time"] - offset
+                                   for step, (_, offset) in zip(steps, agent_step_windows))
+        window["end_time"] = max(step["end_time"] - offset
+                                 for step, (_, offset) in zip(steps, agent_step_windows))
+        window["concurrency"] = sum(step["concurrency"] for step in steps)
+        if window["rate"] is not None:
+            window["rate"] = sum(step["rate"] for step in steps)
+        merged.append(window)
+    return merged
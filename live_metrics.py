@@ -0,0 +1,184 @@
+"""Live metrics of a running test, served in the Prometheus text format and shown on the console."""
+
+import collections
+import http.server
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+
+# Prefix of the names of the exported metrics.
+metric_prefix = "llm_load_test"
+
+# Quantiles of the latency metrics over the sliding window.
+quantiles = [0.5, 0.99]
+
+
+class LiveMetrics:
+    """Running aggregates of the results streamed by the ResultsAggregator.
+
+    Totals cover the whole test, rates and latency quantiles only the
+    requests which finished within the last window seconds. The in flight
+    count is read from the ring buffers, as requests started minus results
+    pushed by each user process.
+    """
+
+    def __init__(self, results_buffers, window=10):
+        """Init method."""
+        self.results_buffers = results_buffers
+        self.window = window
+        self.start_time = time.time()
+        self.requests_total = 0
+        self.errors_total = 0
+        self.output_tokens_total = 0
+        # (end_time, output_tokens, ttft, itl, failed) of the requests finished within the window
+        self._recent = collections.deque()
+        self._lock = threading.Lock()
+        self._server = None
+        self._console_thread = None
+        self._stop_event = threading.Event()
+
+    def add_results(self, results):
+        """Account for newly received results, called by the ResultsAggregator after each drain."""
+        with self._lock:
+            for result in results:
+                failed = result.error_text is not None or result.error_code is not None
+                self.requests_total += 1
+                self.errors_total += failed
+                self.output_tokens_total += result.output_tokens or 0
+                self._recent.append((
+                    result.end_time or time.time(),
+                    result.output_tokens or 0,
+                    None if failed else result.ttft,
+                    None if failed else result.itl,
+                    failed,
+                ))
+
+    def in_flight(self):
+        """Return the number of requests currently in flight."""
+        return sum(results_buffer.in_flight() for results_buffer in self.results_buffers)
+
+    def snapshot(self):
+        """Return the current values of all metrics as a dict."""
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0][0] < now - self.window:
+                self._recent.popleft()
+            recent = list(self._recent)
+            values = {
+                "requests_total": self.requests_total,
+                "errors_total": self.errors_total,
+                "output_tokens_total": self.output_tokens_total,
+            }
+        # The window is shorter than configured at the start of the test
+        window = max(min(self.window, now - self.start_time), 1e-3)
+        values["elapsed_seconds"] = now - self.start_time
+        values["in_flight_requests"] = self.in_flight()
+        values["requests_per_second"] = len(recent) / window
+        values["errors_per_second"] = sum(entry[4] for entry in recent) / window
+        values["output_tokens_per_second"] = sum(entry[1] for entry in recent) / window
+        for idx, metric in ((2, "ttft"), (3, "itl")):
+            latencies = np.array([entry[idx] for entry in recent if entry[idx] is not None], dtype=np.float64)
+            values[f"{metric}_ms"] = {
+                quantile: float(np.quantile(latencies, quantile)) if len(latencies) else None
+                for quantile in quantiles
+            }
+        return values
+
+    def prometheus_text(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        values = self.snapshot()
+        lines = []
+
+        def add(name, metric_type, help_text, value, labels=None):
+            if not labels or not any(line.startswith(f"# TYPE {metric_prefix}_{name} ") for line in lines):
+                lines.append(f"# HELP {metric_prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {metric_prefix}_{name} {metric_type}")
+            label_text = "" if not labels else "{" + ",".join(f'{key}="{val}"' for key, val in labels.items()) + "}"
+            lines.append(f"{metric_prefix}_{name}{label_text} {'NaN' if value is None else value}")
+
+        add("requests_total", "counter", "Requests finished since the start of the test.", values["requests_total"])
+        add("errors_total", "counter", "Failed requests since the start of the test.", values["errors_total"])
+        add("output_tokens_total", "counter", "Output tokens received since the start of the test.",
+            values["output_tokens_total"])
+        add("in_flight_requests", "gauge", "Requests currently in flight.", values["in_flight_requests"])
+        add("requests_per_second", "gauge", f"Requests finished per second over the last {self.window}s.",
+            values["requests_per_second"])
+        add("errors_per_second", "gauge", f"Failed requests per second over the last {self.window}s.",
+            values["errors_per_second"])
+        add("output_tokens_per_second", "gauge", f"Output tokens per second over the last {self.window}s.",
+            values["output_tokens_per_second"])
+        for metric, help_text in (("ttft", "Time to first token"), ("itl", "Inter-token latency")):
+            for quantile, value in values[f"{metric}_ms"].items():
+                add(f"{metric}_ms", "gauge", f"{help_text} in ms over the last {self.window}s.", value,
+                    labels={"quantile": quantile})
+        return "\n".join(lines) + "\n"
+
+    def console_text(self):
+        """Return a short human readable summary of the metrics."""
+        values = self.snapshot()
+
+        def fmt(value):
+            return "-" if value is None else f"{value:.1f}"
+
+        return "\n".join([
+            f"llm-load-test  elapsed {values['elapsed_seconds']:.0f}s  (rates and latencies over the last "
+            f"{self.window}s)",
+            f"  in flight {values['in_flight_requests']}  requests {values['requests_total']}  "
+            f"errors {values['errors_total']}",
+            f"  req/s {values['requests_per_second']:.2f}  tokens/s {values['output_tokens_per_second']:.1f}  "
+            f"errors/s {values['errors_per_second']:.2f}",
+            f"  TTFT ms p50 {fmt(values['ttft_ms'][0.5])}  p99 {fmt(values['ttft_ms'][0.99])}",
+            f"  ITL ms  p50 {fmt(values['itl_ms'][0.5])}  p99 {fmt(values['itl_ms'][0.99])}",
+        ])
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serve the metrics on http://host:port/metrics from a background thread."""
+        live_metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = live_metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics endpoint: " + format, *args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        logging.info("Serving live metrics on http://%s:%s/metrics", host, port)
+
+    def show_console(self, refresh=2):
+        """Print the metrics every refresh seconds from a background thread."""
+        self._console_thread = threading.Thread(
+            target=self._run_console, args=(refresh,), name="metrics-console", daemon=True
+        )
+        self._console_thread.start()
+
+    def _run_console(self, refresh):
+        # Redraw in place on a terminal, append otherwise (e.g. when redirected to a file)
+        redraw = sys.stdout.isatty()
+        while not self._stop_event.wait(refresh):
+            text = self.console_text()
+            if redraw:
+                text = "\033[H\033[J" + text
+            print(text, flush=True)
+
+    def stop(self):
+        """Stop the endpoint and the console."""
+        self._stop_event.set()
+        if self._console_thread is not None:
+            self._console_thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
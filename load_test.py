@@ -2,23 +2,43 @@
 
 import logging
 import logging.handlers
+import math
 import multiprocessing as mp
 import sys
 import time
-from user import User
 
-from dataset import Dataset
+from async_user import AsyncUserWorker
+
+from dataset import Dataset, dataset_seed
+
+import distributed
+
+from live_metrics import LiveMetrics
 
 import logging_utils
 
-import utils
+import numpy as np
 
+from result import ResultColumns
 
-def run_main_process(concurrency, duration, dataset, dataset_q, stop_q):
-    """Run the main process."""
-    logging.info("Test from main process")
+from result_buffer import ResultRingBuffer, ResultsAggregator
+
+from scheduler import ArrivalSchedule, sleep_until
+
+from session import make_sessions
 
-    # Initialize the dataset_queue with 4*concurrency requests
+from sketch import ResultsSketch
+
+from synthetic_dataset import SyntheticDataset
+
+from user import User
+
+import utils
+
+
+def fill_dataset_queue(concurrency, duration, dataset, dataset_q):
+    """Keep the dataset queue topped up for closed-loop users for duration seconds."""
+    # Initialize the dataset_queue with 2*concurrency requests
     for query in dataset.get_next_n_queries(2 * concurrency):
         dataset_q.put(query)
 
@@ -33,19 +53,217 @@ def run_main_process(concurrency, duration, dataset, dataset_q, stop_q):
         time.sleep(0.1)
         current_time = time.time()
 
+
+def schedule_queries(rate, arrival, duration, dataset, dataset_q):
+    """Put queries on the dataset queue following an arrival schedule, return the number scheduled."""
+    # Queries are put on the dataset queue at their scheduled send time regardless of how many requests are
+    # still in flight, so any time a query waits for a free user is visible as schedule_delay in the results.
+    schedule = ArrivalSchedule(rate, arrival)
+    scheduled_count = 0
+    start_time = time.time()
+    for send_time in schedule.send_times(start_time, duration):
+        lateness = sleep_until(send_time)
+        query = dict(dataset.get_next_n_queries(1)[0], scheduled_start_time=send_time, dispatch_delay=1000 * lateness)
+        dataset_q.put(query)
+        scheduled_count = scheduled_count + 1
+
+    sleep_until(start_time + duration)
+    return scheduled_count
+
+
+def drain_dataset_queue(dataset_q):
+    """Empty the dataset queue, return the number of queries removed."""
+    removed_count = 0
+    while not dataset_q.empty():
+        logging.debug("Removing element from dataset_q")
+        dataset_q.get()
+        removed_count = removed_count + 1
+    return removed_count
+
+
+def run_main_process(concurrency, duration, dataset, dataset_q, stop_q, partitioned=False):
+    """Run the main process."""
+    logging.info("Test from main process")
+
+    if partitioned:
+        # Users iterate over their own dataset partition, there is nothing to feed them
+        time.sleep(duration)
+    else:
+        fill_dataset_queue(concurrency, duration, dataset, dataset_q)
+
     logging.info("Timer ended, stopping processes")
 
     # Signal users to stop sending requests
     stop_q.put(None)
 
     # Empty the dataset queue
-    while not dataset_q.empty():
-        logging.debug("Removing element from dataset_q")
-        dataset_q.get()
+    drain_dataset_queue(dataset_q)
+
+    return
+
+
+def run_loadgen_main_process(rate, arrival, duration, dataset, dataset_q, stop_q):
+    """Run the main process with an open-loop arrival schedule."""
+    logging.info("Test from main process, sending %s requests/s with %s arrivals", rate, arrival)
+
+    scheduled_count = schedule_queries(rate, arrival, duration, dataset, dataset_q)
+
+    logging.info("Timer ended after scheduling %d requests, stopping processes", scheduled_count)
+
+    # Signal users to stop sending requests
+    stop_q.put(None)
+
+    # Empty the dataset queue, anything left here was scheduled but never sent
+    unsent_count = drain_dataset_queue(dataset_q)
+    if unsent_count > 0:
+        logging.warning("%d scheduled requests were never sent, all users were busy. Increase concurrency?",
+                        unsent_count)
 
     return
 
 
+def run_trace_main_process(trace_replay, queries, duration, dataset_q, stop_q):
+    """Send the queries at the offsets of the trace, then stop the users once duration seconds have passed."""
+    logging.info("Test from main process, replaying %d requests at %sx speed", len(queries), trace_replay.speedup)
+
+    # Like schedule_queries, queries are put on the dataset queue at their send time whatever is in flight
+    start_time = time.time()
+    lateness = []
+    for idx, send_time in trace_replay.send_times(start_time, duration):
+        late = sleep_until(send_time)
+        dataset_q.put(dict(queries[idx], scheduled_start_time=send_time, dispatch_delay=1000 * late))
+        lateness.append(late)
+    sleep_until(start_time + duration)
+
+    if lateness:
+        lateness = np.array(lateness)
+        logging.info("Replayed %d requests, scheduler lateness mean %.3f ms, p99 %.3f ms, max %.3f ms",
+                     len(lateness), 1000 * lateness.mean(), 1000 * np.percentile(lateness, 99),
+                     1000 * lateness.max())
+    logging.info("Timer ended, stopping processes")
+
+    # Signal users to stop sending requests
+    stop_q.put(None)
+
+    # Empty the dataset queue, anything left here was scheduled but never sent
+    unsent_count = drain_dataset_queue(dataset_q)
+    if unsent_count > 0:
+        logging.warning("%d replayed requests were never sent, all users were busy. Increase concurrency?",
+                        unsent_count)
+
+
+def run_stair_step_main_process(steps, step_duration, arrival, dataset, dataset_q, stop_q, active_users,
+                                partitioned=False):
+    """Run each (concurrency, rate) step in turn with the same warm user processes.
+
+    Users with a user_id >= active_users.value are parked, so a step only
+    changes the shared value instead of respawning processes. Returns one
+    dict per step with the time window its results should be taken from.
+    """
+    step_windows = []
+    for idx, (concurrency, rate) in enumerate(steps):
+        logging.info("Starting step %d/%d, concurrency: %s, rate: %s", idx + 1, len(steps), concurrency, rate)
+        active_users.value = concurrency
+        start_time = time.time()
+        if rate is None and partitioned:
+            time.sleep(step_duration)
+        elif rate is None:
+            fill_dataset_queue(concurrency, step_duration, dataset, dataset_q)
+        else:
+            schedule_queries(rate, arrival, step_duration, dataset, dataset_q)
+        end_time = time.time()
+
+        # Don't let queries queued for this step leak into the next one
+        unsent_count = drain_dataset_queue(dataset_q)
+        if rate is not None and unsent_count > 0:
+            logging.warning("Step %d: %d scheduled requests were never sent, all users were busy",
+                            idx + 1, unsent_count)
+        step_windows.append({
+            "step": idx,
+            "concurrency": concurrency,
+            "rate": rate,
+            "start_time": start_time,
+            "end_time": end_time,
+            "duration": step_duration,
+        })
+
+    logging.info("All steps done, stopping processes")
+
+    # Signal users to stop sending requests
+    stop_q.put(None)
+
+    drain_dataset_queue(dataset_q)
+
+    return step_windows
+
+
+def run_search_main_process(load_search, slo, search_over, probe_duration, max_probes, concurrency, arrival,
+                            dataset, dataset_q, stop_q, active_users, aggregator):
+    """Probe the load levels picked by load_search until it settles on the highest one meeting the SLO.
+
+    Results are streamed live by the aggregator, after each probe the
+    requests started and finished within its window are checked against
+    the SLO to pick the next load. Returns one dict per probe, like the
+    stair-step windows, with the SLO evaluation of the probe added.
+    """
+    probe_windows = []
+    load = load_search.next_load()
+    while load is not None and len(probe_windows) < max_probes:
+        if search_over == "rate":
+            probe_concurrency, rate = concurrency, load
+        else:
+            probe_concurrency, rate = load, None
+        logging.info("Starting probe %d, concurrency: %s, rate: %s", len(probe_windows) + 1, probe_concurrency, rate)
+        active_users.value = probe_concurrency
+        start_time = time.time()
+        if rate is None:
+            # Closed-loop users iterate over their own dataset partition
+            time.sleep(probe_duration)
+        else:
+            schedule_queries(rate, arrival, probe_duration, dataset, dataset_q)
+        end_time = time.time()
+        drain_dataset_queue(dataset_q)
+
+        # Let the aggregator pick up the requests which finished right before the end of the window
+        time.sleep(2 * aggregator.interval)
+        probe_results = [
+            result for result in aggregator.snapshot()
+            if result.start_time >= start_time and result.end_time is not None and result.end_time <= end_time
+        ]
+        evaluation = slo.evaluate(probe_results, end_time - start_time)
+        logging.info(
+            "Probe %d: %d requests, goodput %.1f tokens/s, SLO %s",
+            len(probe_windows) + 1,
+            evaluation["requests"],
+            evaluation["goodput"],
+            "met" if evaluation["slo_met"] else "missed",
+        )
+        load_search.record(load, evaluation["slo_met"])
+        probe_windows.append(dict(
+            {
+                "step": len(probe_windows),
+                "concurrency": probe_concurrency,
+                "rate": rate,
+                "start_time": start_time,
+                "end_time": end_time,
+                "duration": probe_duration,
+            },
+            **evaluation,
+        ))
+        load = load_search.next_load()
+
+    if load is not None:
+        logging.warning("Search stopped after max_probes (%d) probes before converging", max_probes)
+    logging.info("Search done, highest %s meeting the SLO: %s", search_over, load_search.best)
+
+    # Signal users to stop sending requests
+    stop_q.put(None)
+
+    drain_dataset_queue(dataset_q)
+
+    return probe_windows
+
+
 def run_warmup(
     dataset,
     dataset_q,
@@ -99,16 +317,29 @@ def run_warmup(
 
 
 def gather_results(results_pipes):
-    """Get the results."""
+    """Get the results, as a single ResultColumns."""
     # Receive all results from each processes results_pipe
     logging.debug("Receiving results from user processes")
-    results_list = []
+    results_list = ResultColumns()
     for results_pipe in results_pipes:
         user_results = results_pipe.recv()
         results_list.extend(user_results)
     return results_list
 
 
+def gather_sketches(results_pipes):
+    """Get the ResultsSketch of each process and merge them."""
+    logging.debug("Receiving result sketches from user processes")
+    results_sketch = None
+    for results_pipe in results_pipes:
+        user_sketch = results_pipe.recv()
+        if results_sketch is None:
+            results_sketch = user_sketch
+        else:
+            results_sketch.merge(user_sketch)
+    return results_sketch
+
+
 def exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thread, code):
     """Exit gracefully."""
     # Signal users to stop sending requests
@@ -135,10 +366,269 @@ def exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thr
     sys.exit(code)
 
 
+class WarmupError(RuntimeError):
+    """Raised when the warmup requests time out or return errors."""
+
+
+def run_load_test(
+    config,
+    concurrency,
+    duration,
+    plugin,
+    mp_ctx,
+    logger_q,
+    log_level,
+    procs,
+    results_pipes,
+    dataset_q,
+    warmup_q,
+    stop_q,
+    dataset_partition=None,
+    before_start=None,
+    results_writer=None,
+):
+    """Create the users, run the warmup and the test, return the results and stair-step windows.
+
+    With results_options.transport sketch the results are a single merged
+    ResultsSketch instead of a list of RequestResult.
+
+    Started processes are appended to procs and results_pipes so the caller
+    can still clean them up if this raises. dataset_partition is an optional
+    (index, count) tuple restricting the dataset to one share of it, and
+    before_start an optional callable run after the warmup, right before
+    the test starts. results_writer is an optional utils.open_result_writer()
+    the streamed results are appended to as they arrive.
+    """
+    logging.debug("Creating dataset with configuration %s", config["dataset"])
+    # Get model_name if set for prompt formatting
+    model_name = config.get("plugin_options", {}).get("model_name", "")
+    dataset_options = dict(config["dataset"])
+    sessions = dataset_options.pop("sessions", None)
+    if "synthetic" in dataset_options:
+        dataset = SyntheticDataset(model_name=model_name, **dataset_options)
+    else:
+        dataset = Dataset(model_name=model_name, **dataset_options)
+    if sessions:
+        # Queries are played as the turns of multi-turn conversations
+        dataset.dataset_list = make_sessions(dataset.dataset_list, seed=dataset_seed, **sessions)
+    if dataset_partition is not None:
+        # Only use this agent's share of the dataset in a distributed test
+        dataset.dataset_list = dataset.get_partition(*dataset_partition)
+
+    load_options = config["load_options"]
+    load_type = load_options.get("type", "constant")
+    trace_replay = None
+    if load_type == "trace":
+        trace_replay = utils.get_trace_replay(load_options)
+        if dataset_partition is not None:
+            # Each agent replays its share of the requests, at their original offsets
+            trace_replay = trace_replay.partition(*dataset_partition)
+        # Prompts are picked before the test, the scheduler only has to send them
+        trace_queries = trace_replay.map_queries(dataset)
+
+    warmup = config.get("warmup")
+    if not warmup:
+        warmup_q = None
+    # Number of users allowed to send requests, users above it stay parked between stair-steps
+    active_users = None
+    if load_type in ("stair-step", "search"):
+        active_users = mp_ctx.Value("i", concurrency, lock=False)
+    # Closed-loop users each get a fixed partition of the dataset up front, dataset_q
+    # is only used for warmup and for open-loop schedules which decide when to send.
+    partitioned = (
+        load_type == "constant"
+        or (load_type == "stair-step" and not isinstance(load_options.get("rate"), list))
+        or (load_type == "search" and load_options.get("search_over", "concurrency") == "concurrency")
+    )
+    # Optionally stream results through a shared memory ring buffer per process
+    # while the test runs, instead of sending them all through results_pipes at the end.
+    results_options = config.get("results_options", {})
+    metrics_options = config.get("metrics_options", {})
+    live_metrics_enabled = bool(metrics_options.get("port") or metrics_options.get("console"))
+    streaming_results = utils.streams_results(config)
+    # With the sketch transport each process only keeps running summaries, merged at the end.
+    sketch_results = results_options.get("transport", "pipe") == "sketch"
+    relative_accuracy = results_options.get("relative_accuracy", 0.01)
+    results_buffers = []
+    aggregator = None
+    live_metrics = None
+    # Set to the start time of the test once the warmup is done, users wait for it
+    test_start = mp_ctx.Value("d", 0.0, lock=False)
+    processes = load_options.get("processes")
+    if processes:
+        # Asyncio engine: split the users across a fixed number of worker processes
+        if plugin.async_request_func is None:
+            raise ValueError(f"Plugin {config.get('plugin')} does not support load_options.processes")
+        users_per_process = math.ceil(concurrency / processes)
+        logging.debug("Creating %s Users across %s worker processes", concurrency, processes)
+        for idx in range(processes):
+            user_ids = list(range(idx * users_per_process, min((idx + 1) * users_per_process, concurrency)))
+            if not user_ids:
+                break
+            send_results, recv_results = mp_ctx.Pipe()
+            results_buffer = None
+            if streaming_results:
+                results_buffer = ResultRingBuffer(mp_ctx, results_options.get("buffer_size", 4096))
+                results_buffers.append(results_buffer)
+            worker = AsyncUserWorker(
+                idx,
+                user_ids,
+                dataset_q=dataset_q,
+                warmup_q=warmup_q,
+                stop_q=stop_q,
+                results_pipe=send_results,
+                plugin=plugin,
+                logger_q=logger_q,
+                log_level=log_level,
+                run_duration=duration,
+                active_users=active_users,
+                queries={
+                    user_id: dataset.get_partition(user_id, concurrency) for user_id in user_ids
+                } if partitioned else None,
+                results_buffer=results_buffer,
+                test_start=test_start,
+                results_sketch=ResultsSketch(relative_accuracy) if sketch_results else None,
+                keep_output_text=results_options.get("keep_output_text", True),
+            )
+            proc = mp_ctx.Process(target=worker.run_worker_process)
+            procs.append(proc)
+            logging.info("Starting %s with %s users", proc, len(user_ids))
+            proc.start()
+            results_pipes.append(recv_results)
+    else:
+        logging.debug("Creating %s Users and corresponding processes", concurrency)
+        for idx in range(concurrency):
+            send_results, recv_results = mp_ctx.Pipe()
+            results_buffer = None
+            if streaming_results:
+                results_buffer = ResultRingBuffer(mp_ctx, results_options.get("buffer_size", 4096))
+                results_buffers.append(results_buffer)
+            user = User(
+                idx,
+                dataset_q=dataset_q,
+                warmup_q=warmup_q,
+                stop_q=stop_q,
+                results_pipe=send_results,
+                plugin=plugin,
+                logger_q=logger_q,
+                log_level=log_level,
+                run_duration=duration,
+                active_users=active_users,
+                queries=dataset.get_partition(idx, concurrency) if partitioned else None,
+                results_buffer=results_buffer,
+                test_start=test_start,
+                results_sketch=ResultsSketch(relative_accuracy) if sketch_results else None,
+                keep_output_text=results_options.get("keep_output_text", True),
+            )
+            proc = mp_ctx.Process(target=user.run_user_process)
+            procs.append(proc)
+            logging.info("Starting %s", proc)
+            proc.start()
+            results_pipes.append(recv_results)
+
+    if config.get("warmup"):
+        logging.info("Running warmup")
+        warmup_options = config.get("warmup_options", {})
+        warmup_reqs = warmup_options.get("requests", 10)
+        warmup_timeout = warmup_options.get("timeout_sec", 120)
+        warmup_passed = run_warmup(
+            dataset,
+            dataset_q,
+            results_pipes,
+            warmup_q,
+            warmup_reqs=warmup_reqs,
+            warmup_timeout=warmup_timeout,
+        )
+        if not warmup_passed:
+            raise WarmupError("Warmup failed")
+        else:
+            time.sleep(2)
+
+    if before_start is not None:
+        before_start()
+
+    if live_metrics_enabled:
+        live_metrics = LiveMetrics(results_buffers, metrics_options.get("window", 10))
+        if metrics_options.get("port"):
+            live_metrics.serve(metrics_options["port"], metrics_options.get("host", "0.0.0.0"))
+        if metrics_options.get("console"):
+            live_metrics.show_console(metrics_options.get("refresh", 2))
+
+    if streaming_results:
+        listeners = []
+        if live_metrics is not None:
+            listeners.append(live_metrics.add_results)
+        if results_writer is not None:
+            # Rows are written out while the test runs, the summary once it is over
+            listeners.append(results_writer.append)
+        aggregator = ResultsAggregator(results_buffers, listeners=listeners)
+        aggregator.start()
+
+    logging.debug("Running main process")
+    test_start.value = time.time()
+    step_windows = None
+    if load_type == "loadgen":
+        run_loadgen_main_process(
+            load_options.get("rate"),
+            load_options.get("arrival", "poisson"),
+            duration,
+            dataset,
+            dataset_q,
+            stop_q,
+        )
+    elif load_type == "trace":
+        run_trace_main_process(trace_replay, trace_queries, duration, dataset_q, stop_q)
+    elif load_type == "stair-step":
+        step_windows = run_stair_step_main_process(
+            utils.get_stair_steps(load_options),
+            utils.get_step_duration(load_options),
+            load_options.get("arrival", "poisson"),
+            dataset,
+            dataset_q,
+            stop_q,
+            active_users,
+            partitioned=partitioned,
+        )
+    elif load_type == "search":
+        load_search, slo = utils.get_load_search(load_options)
+        step_windows = run_search_main_process(
+            load_search,
+            slo,
+            load_options.get("search_over", "concurrency"),
+            utils.get_probe_duration(load_options),
+            utils.get_max_probes(load_options),
+            concurrency,
+            load_options.get("arrival", "poisson"),
+            dataset,
+            dataset_q,
+            stop_q,
+            active_users,
+            aggregator,
+        )
+    else:
+        run_main_process(concurrency, duration, dataset, dataset_q, stop_q, partitioned=partitioned)
+
+    if aggregator is not None:
+        results_list = aggregator.stop(procs)
+    elif sketch_results:
+        results_list = gather_sketches(results_pipes)
+    else:
+        results_list = gather_results(results_pipes)
+
+    if live_metrics is not None:
+        live_metrics.stop()
+
+    return results_list, step_windows
+
+
 def main(args):
     """Load test CLI entrypoint."""
     args = utils.parse_args(args)
 
+    if args.agent is not None:
+        distributed.run_agent(args.agent, args.log_level, run_load_test)
+        return
+
     mp_ctx = mp.get_context("spawn")
     logger_q = mp_ctx.Queue()
     log_reader_thread = logging_utils.init_logging(args.log_level, logger_q)
@@ -160,63 +650,44 @@ def main(args):
         logging.error("Exiting due to invalid input: %s", e)
         exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thread, 1)
 
+    results_writer = None
     try:
-        logging.debug("Creating dataset with configuration %s", config["dataset"])
-        # Get model_name if set for prompt formatting
-        model_name = config.get("plugin_options", {}).get("model_name", "")
-        dataset = Dataset(model_name=model_name, **config["dataset"])
-
-        warmup = config.get("warmup")
-        if not warmup:
-            warmup_q = None
-        logging.debug("Creating %s Users and corresponding processes", concurrency)
-        for idx in range(concurrency):
-            send_results, recv_results = mp_ctx.Pipe()
-            user = User(
-                idx,
-                dataset_q=dataset_q,
-                warmup_q=warmup_q,
-                stop_q=stop_q,
-                results_pipe=send_results,
-                plugin=plugin,
-                logger_q=logger_q,
-                log_level=args.log_level,
-                run_duration=duration,
-            )
-            proc = mp_ctx.Process(target=user.run_user_process)
-            procs.append(proc)
-            logging.info("Starting %s", proc)
-            proc.start()
-            results_pipes.append(recv_results)
-
-        if config.get("warmup"):
-            logging.info("Running warmup")
-            warmup_options = config.get("warmup_options", {})
-            warmup_reqs = warmup_options.get("requests", 10)
-            warmup_timeout = warmup_options.get("timeout_sec", 120)
-            warmup_passed = run_warmup(
-                dataset,
-                dataset_q,
+        if "distributed" in config:
+            results_list, step_windows = distributed.run_coordinator(config)
+        else:
+            results_writer = utils.open_result_writer(config)
+            results_list, step_windows = run_load_test(
+                config,
+                concurrency,
+                duration,
+                plugin,
+                mp_ctx,
+                logger_q,
+                args.log_level,
+                procs,
                 results_pipes,
+                dataset_q,
                 warmup_q,
-                warmup_reqs=warmup_reqs,
-                warmup_timeout=warmup_timeout,
+                stop_q,
+                results_writer=results_writer,
             )
-            if not warmup_passed:
-                exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thread, 1)
-            else:
-                time.sleep(2)
 
-        logging.debug("Running main process")
-        run_main_process(concurrency, duration, dataset, dataset_q, stop_q)
-
-        results_list = gather_results(results_pipes)
-
-        utils.write_output(config, results_list)
+        if step_windows is not None:
+            utils.write_stair_step_output(config, results_list, step_windows)
+        elif isinstance(results_list, ResultsSketch):
+            utils.write_sketch_output(config, results_list)
+        else:
+            utils.write_output(config, results_list, results_writer=results_writer)
 
+    except WarmupError:
+        exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thread, 1)
     except Exception:
         logging.exception("Unexpected exception in main process")
         exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thread, 1)
+    finally:
+        if results_writer is not None:
+            # Keep the rows written so far readable if the test failed, closing again does nothing
+            results_writer.close()
 
     exit_gracefully(procs, warmup_q, dataset_q, stop_q, logger_q, log_reader_thread, 0)
 
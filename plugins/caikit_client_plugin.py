@@ -1,11 +1,17 @@
+import asyncio
+import collections
+import concurrent.futures
 import json
 import logging
+import threading
 import time
 
+import grpc
+import requests
 import urllib3
 from caikit_nlp_client import GrpcClient, HttpClient
 
-from plugins import plugin
+from plugins import http_session, plugin
 from result import RequestResult
 
 urllib3.disable_warnings()
@@ -21,6 +27,8 @@ plugin_options:
   model_name: "Llama-2-7b-hf"
   host: "https://llama-2-7b-hf-isvc-predictor-dagray-test.apps.modelserving.nvidia.eng.rdu2.redhat.com"
   port: 443
+  timeout: 240 # Optional, seconds
+  max_concurrent_requests: 1024 # Optional, in flight requests per asyncio worker process
 """
 
 logger = logging.getLogger("user")
@@ -28,12 +36,127 @@ logger = logging.getLogger("user")
 required_args = ["model_name", "host", "port", "interface", "streaming"]
 
 
-# TODO:
-# - Add error handling to requests
-# - Add configurable timeout for requests
+class _ClientCallDetails(
+    collections.namedtuple(
+        "_ClientCallDetails", ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression")
+    ),
+    grpc.ClientCallDetails,
+):
+    pass
+
+
+class TimeoutInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor):
+    """Apply the timeout set by the calling thread to its gRPC calls."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def set_timeout(self, timeout):
+        self._local.timeout = timeout
+
+    def _call_details(self, client_call_details):
+        timeout = getattr(self._local, "timeout", None)
+        if timeout is None:
+            return client_call_details
+        return _ClientCallDetails(
+            client_call_details.method,
+            timeout,
+            client_call_details.metadata,
+            client_call_details.credentials,
+            client_call_details.wait_for_ready,
+            client_call_details.compression,
+        )
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        return continuation(self._call_details(client_call_details), request)
+
+    def intercept_unary_stream(self, continuation, client_call_details, request):
+        return continuation(self._call_details(client_call_details), request)
+
+
+class TimeoutGrpcClient(GrpcClient):
+    """GrpcClient whose calls honour a per thread timeout, caikit-nlp-client doesn't accept one."""
+
+    def __init__(self, *args, **kwargs):
+        self.interceptor = TimeoutInterceptor()
+        super().__init__(*args, **kwargs)
+
+    def _make_channel(self, *args, **kwargs):
+        return grpc.intercept_channel(super()._make_channel(*args, **kwargs), self.interceptor)
+
+
+class SessionHttpClient(HttpClient):
+    """HttpClient sending its requests through a keep-alive session.
+
+    caikit-nlp-client posts with the module level requests.post, which opens
+    a new connection (and TLS handshake) for every request. The requests
+    built and the responses parsed are the same as HttpClient's.
+    """
+
+    def __init__(self, base_url, session, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.session = session
+
+    def generate_text(self, model_id, text, timeout=60.0, **kwargs):
+        if not model_id:
+            raise ValueError("request must have a model id")
+        response = self.session.post(
+            self._api_url,
+            json=self._create_json_request(model_id, text, **kwargs),
+            timeout=timeout,
+            **self._get_tls_configuration(),
+        )
+        if response.status_code == 200:
+            return response.json()["generated_text"]
+        if 400 <= response.status_code < 500:
+            raise RuntimeError(response.json()["details"])
+        raise RuntimeError(f"{response.status_code}: Server error {response.reason}")
+
+    def generate_text_stream(self, model_id, text, timeout=60.0, **kwargs):
+        if not model_id:
+            raise ValueError("request must have a model id")
+        response = self.session.post(
+            self._stream_api_url,
+            json=self._create_json_request(model_id, text, **kwargs),
+            timeout=timeout,
+            stream=True,
+            **self._get_tls_configuration(),
+        )
+        # A stream left before its end closes its connection instead of returning it to the pool
+        with response:
+            buffer = []
+            for line in response.iter_lines():
+                if line:
+                    # the first 6 bytes contain "data: "
+                    buffer.append(line[6:])
+                    continue
+                try:
+                    message = json.loads(b"".join(buffer))
+                except json.JSONDecodeError:
+                    # message not over yet
+                    continue
+                buffer.clear()
+                yield self._generated_text(message)
+            if buffer:
+                yield self._generated_text(json.loads(b"".join(buffer)))
+
+    def _generated_text(self, message):
+        if "details" in message and "code" in message:
+            raise RuntimeError("Exception iterating responses: {}".format(message["details"]))
+        try:
+            return message["generated_text"]
+        except KeyError as exc:
+            raise RuntimeError("Unexpected response from the server: generated text is missing") from exc
+
+
 class CaikitClientPlugin(plugin.Plugin):
     def __init__(self, args):
         self._parse_args(args)
+        # Clients are created once per user process. One client (and gRPC channel) is shared by
+        # all users of an asyncio worker, their requests run concurrently in a thread pool.
+        self._grpc_client = None
+        self._http_client = None
+        self._executor = None
 
     def _parse_args(self, args):
         for arg in required_args:
@@ -43,6 +166,8 @@ class CaikitClientPlugin(plugin.Plugin):
         self.model_name = args["model_name"]
         self.host = args["host"]
         self.port = args["port"]
+        self.timeout = args.get("timeout", 240)
+        self.max_concurrent_requests = args.get("max_concurrent_requests", 1024)
 
         if args["interface"] == "http":
             self.url = f"{self.host}:{self.port}"
@@ -57,21 +182,41 @@ class CaikitClientPlugin(plugin.Plugin):
                 self.request_func = self.request_grpc
         else:
             logger.error("Interface %s not yet implemented", args["interface"])
-
-    def request_grpc(self, query, user_id, test_end_time: float=0):
-        grpc_client = GrpcClient(self.host, self.port, verify=False)
-
-        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
-
-        result.start_time = time.time()
-        response = grpc_client.generate_text(
-            self.model_name,
-            query["text"],
-            min_new_tokens=query["output_tokens"],
-            max_new_tokens=query["output_tokens"],
-            # timeout=240 #Not supported, may need to contribute to caikit-nlp-client
-        )
-
+        self.async_request_func = self.async_request
+
+    def _get_grpc_client(self):
+        if self._grpc_client is None:
+            self._grpc_client = TimeoutGrpcClient(self.host, self.port, verify=False)
+        return self._grpc_client
+
+    def _get_http_client(self):
+        if self._http_client is None:
+            # Threads of an asyncio worker share the session, keep a connection alive for each
+            session = http_session.new_session(self.max_concurrent_requests)
+            self._http_client = SessionHttpClient(self.url, session, verify=False)
+        return self._http_client
+
+    def _timeout(self, deadline):
+        # timeout, cut short by the hard deadline
+        if deadline is None:
+            return self.timeout
+        remaining = max(0.001, deadline - time.time())
+        return remaining if self.timeout is None else min(self.timeout, remaining)
+
+    def _deadline_reached(self, deadline):
+        return deadline is not None and time.time() >= deadline
+
+    def _request_failed(self, result, err, deadline, tokens_received):
+        """Record a failed request, return True if it was only aborted at the hard deadline."""
+        result.end_time = time.time()
+        if self._deadline_reached(deadline):
+            self.mark_deadline_exceeded(result, tokens_received)
+            return True
+        result.error_text = repr(err)
+        logger.exception("Request failed")
+        return False
+
+    def _finish_response(self, result, response, query):
         logger.debug("Response: %s", json.dumps(response))
         result.end_time = time.time()
 
@@ -80,96 +225,151 @@ class CaikitClientPlugin(plugin.Plugin):
         result.output_text = response
 
         result.calculate_results()
-        return result
-
-    def streaming_request_grpc(self, query, user_id, test_end_time: float=0):
-        grpc_client = GrpcClient(self.host, self.port, verify=False)
-
-        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
-        tokens = []
-        result.start_time = time.time()
-
-        for token in grpc_client.generate_text_stream(
-            self.model_name,
-            query["text"],
-            min_new_tokens=query["output_tokens"],
-            max_new_tokens=query["output_tokens"],
-            # timeout=240
-        ):
+    def _read_stream(self, result, tokens, stream, deadline):
+        for token in stream:
             # First chunk is not a token, just an acknowledgement of connection
             if not result.ack_time:
                 result.ack_time = time.time()
             # First non empty chunk is the first token
             if not result.first_token_time and token != "":
                 result.first_token_time = time.time()
+            if result.first_token_time:
+                result.add_token_time(time.perf_counter())
             tokens.append(token)
             logger.debug("Token: %s", token)
+            # A stream which keeps sending tokens never times out, check the deadline between tokens
+            if self._deadline_reached(deadline):
+                self.mark_deadline_exceeded(result, len(tokens))
+                break
 
+    def _finish_stream(self, result, tokens):
         result.end_time = time.time()
         result.output_text = "".join(tokens)
         result.output_tokens = len(tokens)
 
         # TODO: Calculate correct output tokens before test timeout duration for streaming requests
-        result.output_tokens_before_timeout = result.output_tokens
+        if result.output_tokens_before_timeout is None:
+            result.output_tokens_before_timeout = result.output_tokens
 
         result.calculate_results()
 
-        return result
-
-    def request_http(self, query, user_id):
-        http_client = HttpClient(self.url, verify=False)
+    def request_grpc(self, query, user_id, test_end_time: float=0):
+        grpc_client = self._get_grpc_client()
 
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
+        deadline = self.request_deadline(test_end_time)
+
         result.start_time = time.time()
+        grpc_client.interceptor.set_timeout(self._timeout(deadline))
+        try:
+            response = grpc_client.generate_text(
+                self.model_name,
+                query["text"],
+                min_new_tokens=query["output_tokens"],
+                max_new_tokens=query["output_tokens"],
+            )
+        except RuntimeError as err:
+            if self._request_failed(result, err, deadline, 0):
+                result.output_tokens = 0
+                result.calculate_results()
+            return result
+
+        self._finish_response(result, response, query)
+        return result
 
-        response = http_client.generate_text(
-            self.model_name,
-            query["text"],
-            min_new_tokens=query["output_tokens"],
-            max_new_tokens=query["output_tokens"],
-            timeout=240,
-        )
-        logger.debug("Response: %s", json.dumps(response))
-        result.end_time = time.time()
+    def streaming_request_grpc(self, query, user_id, test_end_time: float=0):
+        grpc_client = self._get_grpc_client()
 
-        result.output_tokens = query["output_tokens"]
-        result.output_tokens_before_timeout = result.output_tokens
-        result.output_text = response
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
-        result.calculate_results()
+        deadline = self.request_deadline(test_end_time)
+
+        tokens = []
+        result.start_time = time.time()
+        grpc_client.interceptor.set_timeout(self._timeout(deadline))
+        try:
+            stream = grpc_client.generate_text_stream(
+                self.model_name,
+                query["text"],
+                min_new_tokens=query["output_tokens"],
+                max_new_tokens=query["output_tokens"],
+            )
+            self._read_stream(result, tokens, stream, deadline)
+        except (RuntimeError, grpc.RpcError) as err:
+            if not self._request_failed(result, err, deadline, len(tokens)):
+                return result
+
+        self._finish_stream(result, tokens)
         return result
 
-    def streaming_request_http(self, query, user_id):
-        http_client = HttpClient(self.url, verify=False)
+    def request_http(self, query, user_id, test_end_time: float=0):
+        http_client = self._get_http_client()
 
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
-        tokens = []
+        deadline = self.request_deadline(test_end_time)
+
+        http_session.pop_connect_time()
         result.start_time = time.time()
-        for token in http_client.generate_text_stream(
-            self.model_name,
-            query["text"],
-            min_new_tokens=query["output_tokens"],
-            max_new_tokens=query["output_tokens"],
-            timeout=240,
-        ):
-            # First chunk is not a token, just an acknowledgement of connection
-            if not result.ack_time:
-                result.ack_time = time.time()
-            # First non empty chunk is the first token
-            if not result.first_token_time and token != "":
-                result.first_token_time = time.time()
-            tokens.append(token)
-            logger.debug("Token: %s", token)
+        try:
+            response = http_client.generate_text(
+                self.model_name,
+                query["text"],
+                min_new_tokens=query["output_tokens"],
+                max_new_tokens=query["output_tokens"],
+                timeout=self._timeout(deadline),
+            )
+            result.connect_time = http_session.pop_connect_time()
+        except (RuntimeError, requests.exceptions.RequestException) as err:
+            if self._request_failed(result, err, deadline, 0):
+                result.output_tokens = 0
+                result.calculate_results()
+            return result
+
+        self._finish_response(result, response, query)
+        return result
 
-        result.end_time = time.time()
+    def streaming_request_http(self, query, user_id, test_end_time: float=0):
+        http_client = self._get_http_client()
 
-        result.output_text = "".join(tokens)
-        result.output_tokens = len(tokens)
-        # TODO: Calculate correct output tokens before test timeout duration for streaming requests
-        result.output_tokens_before_timeout = result.output_tokens
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
-        result.calculate_results()
+        deadline = self.request_deadline(test_end_time)
+
+        tokens = []
+        http_session.pop_connect_time()
+        result.start_time = time.time()
+        try:
+            stream = http_client.generate_text_stream(
+                self.model_name,
+                query["text"],
+                min_new_tokens=query["output_tokens"],
+                max_new_tokens=query["output_tokens"],
+                timeout=self._timeout(deadline),
+            )
+            self._read_stream(result, tokens, stream, deadline)
+            # The stream only connects once its first chunk is read
+            result.connect_time = http_session.pop_connect_time()
+        except (RuntimeError, requests.exceptions.RequestException) as err:
+            if not self._request_failed(result, err, deadline, len(tokens)):
+                return result
+
+        self._finish_stream(result, tokens)
         return result
+
+    async def async_request(self, query, user_id, test_end_time: float=0):
+        # caikit-nlp-client is synchronous, run the requests of all users of the
+        # worker concurrently in threads sharing the same client and gRPC channel
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrent_requests, thread_name_prefix="caikit"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.request_func, query, user_id, test_end_time)
+
+    async def async_close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -1,3 +1,4 @@
+import asyncio
 import time
 
 from plugins import plugin
@@ -19,8 +20,10 @@ class DummyPlugin(plugin.Plugin):
     def _parse_args(self, args):
         if args["streaming"]:
             self.request_func = self.streaming_request_http
+            self.async_request_func = self.async_streaming_request_http
         else:
             self.request_func = self.request_http
+            self.async_request_func = self.async_request_http
 
     def request_http(self, query, user_id, test_end_time: float=0):
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
@@ -47,21 +50,79 @@ class DummyPlugin(plugin.Plugin):
         result.ack_time = time.time()
         time.sleep(0.1)
 
-        result.first_token_time = time.time()
-        time.sleep(1)
+        # Fake response is just the input backwards, streamed over 1s
+        words = query.get("text", "")[::-1].split(" ")
+        deadline = self.request_deadline(test_end_time)
+        tokens = []
+        for word in words:
+            if deadline is not None and time.time() >= deadline:
+                # Pretend the generation was cut at the hard deadline
+                self.mark_deadline_exceeded(result, len(tokens))
+                break
+            if not result.first_token_time:
+                result.first_token_time = time.time()
+            result.add_token_time(time.perf_counter())
+            tokens.append(word)
+            time.sleep(1 / len(words))
 
+        # Response received, return
         result.end_time = time.time()
+        result.output_text = "".join(tokens)
+        result.output_tokens = len(tokens)
+
+        # TODO: Calculate correct output tokens before test timeout duration for streaming requests
+        if result.output_tokens_before_timeout is None:
+            result.output_tokens_before_timeout = result.output_tokens
+
+        result.calculate_results()
+        return result
+
+    async def async_request_http(self, query, user_id, test_end_time: float=0):
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+        result.start_time = time.time()
 
         # Fake response is just the input backwards
-        tokens = query.get("text", "")[::-1].split(" ")
+        result.output_text = query.get("text")[::-1]
+        result.output_tokens = query["output_tokens"]
+        result.output_tokens_before_timeout = result.output_tokens
+
+        await asyncio.sleep(1)
+
+        result.end_time = time.time()
+
+        result.calculate_results()
+
+        return result
+
+    async def async_streaming_request_http(self, query, user_id, test_end_time: float=0):
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+        result.start_time = time.time()
+        await asyncio.sleep(0.1)
+
+        result.ack_time = time.time()
+        await asyncio.sleep(0.1)
+
+        # Fake response is just the input backwards, streamed over 1s
+        words = query.get("text", "")[::-1].split(" ")
+        deadline = self.request_deadline(test_end_time)
+        tokens = []
+        for word in words:
+            if deadline is not None and time.time() >= deadline:
+                # Pretend the generation was cut at the hard deadline
+                self.mark_deadline_exceeded(result, len(tokens))
+                break
+            if not result.first_token_time:
+                result.first_token_time = time.time()
+            result.add_token_time(time.perf_counter())
+            tokens.append(word)
+            await asyncio.sleep(1 / len(words))
 
         # Response received, return
         result.end_time = time.time()
         result.output_text = "".join(tokens)
         result.output_tokens = len(tokens)
-
-        # TODO: Calculate correct output tokens before test timeout duration for streaming requests
-        result.output_tokens_before_timeout = result.output_tokens
+        if result.output_tokens_before_timeout is None:
+            result.output_tokens_before_timeout = result.output_tokens
 
         result.calculate_results()
         return result
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import time
@@ -5,9 +6,14 @@ import time
 import requests
 import urllib3
 
-from plugins import plugin
+from plugins import http_session, plugin
 from result import RequestResult
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 urllib3.disable_warnings()
 
 required_args = ["host", "streaming"]
@@ -15,11 +21,12 @@ required_args = ["host", "streaming"]
 logger = logging.getLogger("user")
 
 
-# TODO:
-# - Add configurable timeout for requests
 class HFTGIPlugin(plugin.Plugin):
     def __init__(self, args):
         self._parse_args(args)
+        # Keep-alive sessions, created lazily in the user process (and inside the worker's event loop)
+        self._session = None
+        self._aio_session = None
 
     def _parse_args(self, args):
         for arg in required_args:
@@ -29,17 +36,19 @@ class HFTGIPlugin(plugin.Plugin):
         if args["streaming"]:
             endpoint = "/generate_stream"
             self.request_func = self.streaming_request_http
+            self.async_request_func = self.async_streaming_request_http
         else:
             endpoint = "/generate"
             logger.error("option streaming: %s not yet implemented", args["streaming"])
 
         self.host = args["host"] + endpoint
 
-    def streaming_request_http(self, query, user_id, test_end_time: float=0):
-
-        headers = {"Content-Type": "application/json"}
+        self.pool_size = args.get("pool_size")
+        self.connect_timeout = args.get("connect_timeout")
+        self.read_timeout = args.get("read_timeout")
 
-        data = {
+    def _request_data(self, query):
+        return {
             "inputs": query["text"],
             "parameters": {
                 "max_new_tokens": query["output_tokens"],
@@ -48,15 +57,90 @@ class HFTGIPlugin(plugin.Plugin):
             },
         }
 
+    def _process_stream_line(self, result, tokens, line, status_code):
+        """Process one line of a streaming response, return False when the stream should be abandoned."""
+        _, found, data = line.partition(b"data:")
+        if not found:
+            return True
+
+        try:
+            message = json.loads(data)
+            error = message.get("error")
+            if error is None:
+                token = message["token"]["text"]
+                logger.debug("Token: %s", token)
+            else:
+                result.error_code = status_code
+                result.error_text = error
+                logger.error("Error received in response message: %s", error)
+                return False
+        except json.JSONDecodeError:
+            logger.error("response line could not be json decoded: %s", line)
+            return True
+        except KeyError:
+            logger.error(
+                "KeyError, unexpected response format in line: %s", line
+            )
+            return True
+
+        # First chunk is not a token, just an acknowledgement of connection
+        if not result.ack_time:
+            result.ack_time = time.time()
+
+        # First non empty chunk is the first token
+        if not result.first_token_time and token != "":
+            result.first_token_time = time.time()
+        if result.first_token_time:
+            result.add_token_time(time.perf_counter())
+        tokens.append(token)
+        return True
+
+    def _finish_stream(self, result, tokens):
+        # Response received, return
+        result.end_time = time.time()
+        result.output_text = "".join(tokens)
+        result.output_tokens = len(tokens)
+
+        # TODO: Calculate correct output tokens before test timeout duration for streaming requests
+        result.output_tokens_before_timeout = result.output_tokens
+
+        result.calculate_results()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = http_session.new_session(self.pool_size)
+        return self._session
+
+    def _read_timeout(self, deadline):
+        # read_timeout, cut short by the hard deadline
+        if deadline is None:
+            return self.read_timeout
+        remaining = max(0.001, deadline - time.time())
+        return remaining if self.read_timeout is None else min(self.read_timeout, remaining)
+
+    def _deadline_reached(self, deadline):
+        return deadline is not None and time.time() >= deadline
+
+    def streaming_request_http(self, query, user_id, test_end_time: float=0):
+
+        headers = {"Content-Type": "application/json"}
+
+        data = self._request_data(query)
+
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
-        tokens = []        
+        deadline = self.request_deadline(test_end_time)
+
+        tokens = []
         response = None
+        http_session.pop_connect_time()
         result.start_time = time.time()
         try:
-            response = requests.post(
-                self.host, headers=headers, json=data, verify=False, stream=True
+            response = self._get_session().post(
+                self.host, headers=headers, json=data, stream=True,
+                timeout=(self.connect_timeout, self._read_timeout(deadline)),
             )
+            result.connect_time = http_session.pop_connect_time()
             response.raise_for_status()
         except requests.exceptions.ConnectionError as err:
             result.end_time = time.time()
@@ -64,6 +148,15 @@ class HFTGIPlugin(plugin.Plugin):
             if response is not None:
                 result.error_code = response.status_code
             return result
+        except requests.exceptions.Timeout as err:
+            if not self._deadline_reached(deadline):
+                result.end_time = time.time()
+                result.error_text = repr(err)
+                return result
+            # Aborted at the hard deadline, the stream never started
+            self._finish_stream(result, tokens)
+            self.mark_deadline_exceeded(result, 0)
+            return result
         except requests.exceptions.HTTPError as err:
             result.end_time = time.time()
             result.error_text = repr(err)
@@ -72,47 +165,98 @@ class HFTGIPlugin(plugin.Plugin):
             return result
 
         logger.debug("response: %s", response)
-        for line in response.iter_lines():
-            _, found, data = line.partition(b"data:")
-            if found:
-                try:
-                    message = json.loads(data)
-                    error = message.get("error")
-                    if error is None:
-                        token = message["token"]["text"]
-                        logger.debug("Token: %s", token)
-                    else:
-                        result.error_code = response.status_code
-                        result.error_text = error
-                        logger.error("Error received in response message: %s", error)
-                        break
-                except json.JSONDecodeError:
-                    logger.error("response line could not be json decoded: %s", line)
-                    continue
-                except KeyError:
-                    logger.error(
-                        "KeyError, unexpected response format in line: %s", line
-                    )
-                    continue
+        aborted = False
+        watchdog = None
+        if deadline is not None:
+            watchdog = plugin.start_deadline_watchdog(response, deadline)
+        try:
+            for line in response.iter_lines():
+                if self._deadline_reached(deadline):
+                    aborted = True
+                    break
+                if not self._process_stream_line(result, tokens, line, response.status_code):
+                    break
+        except requests.exceptions.RequestException as err:
+            if self._deadline_reached(deadline):
+                # The watchdog shut down the stalled connection
+                aborted = True
             else:
-                continue
+                result.end_time = time.time()
+                result.error_text = repr(err)
+                result.error_code = response.status_code
+                return result
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            response.close()
 
-            # First chunk is not a token, just an acknowledgement of connection
-            if not result.ack_time:
-                result.ack_time = time.time()
+        self._finish_stream(result, tokens)
+        if aborted:
+            self.mark_deadline_exceeded(result, len(tokens))
+        return result
 
-            # First non empty chunk is the first token
-            if not result.first_token_time and token != "":
-                result.first_token_time = time.time()
-            tokens.append(token)
+    def _get_aio_session(self):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required to use the hf_tgi_plugin with the asyncio user engine")
+        if self._aio_session is None:
+            # One session (and connection pool) is shared by all users in the worker process
+            self._aio_session = http_session.new_aio_session(self.pool_size, self.connect_timeout, self.read_timeout)
+        return self._aio_session
 
-        # Response received, return
-        result.end_time = time.time()
-        result.output_text = "".join(tokens)
-        result.output_tokens = len(tokens)
+    async def async_close(self):
+        if self._aio_session is not None:
+            await self._aio_session.close()
+            self._aio_session = None
 
-        # TODO: Calculate correct output tokens before test timeout duration for streaming requests
-        result.output_tokens_before_timeout = result.output_tokens
+    async def _read_stream(self, response, result, tokens):
+        async for line in response.content:
+            line = line.rstrip(b"\r\n")
+            if not self._process_stream_line(result, tokens, line, response.status):
+                break
 
-        result.calculate_results()
+    async def async_streaming_request_http(self, query, user_id, test_end_time: float=0):
+        session = self._get_aio_session()
+
+        headers = {"Content-Type": "application/json"}
+
+        data = self._request_data(query)
+
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+
+        deadline = self.request_deadline(test_end_time)
+
+        tokens = []
+        aborted = False
+        trace_ctx = {}
+        result.start_time = time.time()
+        try:
+            # Leaving the context manager early closes the connection, aborting the stream
+            async with session.post(self.host, headers=headers, json=data, trace_request_ctx=trace_ctx) as response:
+                result.connect_time = trace_ctx.get("connect_time")
+                response.raise_for_status()
+                logger.debug("response: %s", response)
+                await asyncio.wait_for(
+                    self._read_stream(response, result, tokens),
+                    timeout=None if deadline is None else max(0.001, deadline - time.time()),
+                )
+        except asyncio.TimeoutError as err:
+            if not self._deadline_reached(deadline):
+                result.end_time = time.time()
+                result.error_text = repr(err)
+                return result
+            # Aborted at the hard deadline
+            aborted = True
+        except aiohttp.ClientResponseError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            result.error_code = err.status
+            return result
+        except aiohttp.ClientError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            return result
+
+        self._finish_stream(result, tokens)
+        if aborted:
+            self.mark_deadline_exceeded(result, len(tokens))
         return result
@@ -0,0 +1,105 @@
+"""Pooled keep-alive HTTP sessions for the HTTP plugins, with connection setup timing."""
+
+import threading
+import time
+
+import requests
+import urllib3
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Time taken by the last new connection opened by the current thread, in seconds.
+_connect_times = threading.local()
+
+
+class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    """HTTPConnection recording how long the TCP connect took."""
+
+    def connect(self):
+        """Connect and record the time taken."""
+        start_time = time.time()
+        super().connect()
+        _connect_times.last = time.time() - start_time
+
+
+class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    """HTTPSConnection recording how long the TCP connect and TLS handshake took."""
+
+    def connect(self):
+        """Connect and record the time taken."""
+        start_time = time.time()
+        super().connect()
+        _connect_times.last = time.time() - start_time
+
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    """Connection pool of TimedHTTPConnection."""
+
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    """Connection pool of TimedHTTPSConnection."""
+
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connections record their setup time."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        """Create the pool manager with timed connection pools."""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+def new_session(pool_size=None):
+    """Return a requests.Session keeping up to pool_size connections per host alive."""
+    session = requests.Session()
+    session.verify = False
+    adapter = TimedHTTPAdapter(pool_maxsize=pool_size or requests.adapters.DEFAULT_POOLSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def pop_connect_time():
+    """Return the setup time in ms of the connection opened since the last call, None if none was opened."""
+    connect_time = getattr(_connect_times, "last", None)
+    _connect_times.last = None
+    return None if connect_time is None else 1000 * connect_time
+
+
+async def _on_connection_create_start(session, trace_config_ctx, params):
+    trace_config_ctx.connect_start_time = time.time()
+
+
+async def _on_connection_create_end(session, trace_config_ctx, params):
+    if trace_config_ctx.trace_request_ctx is not None:
+        trace_config_ctx.trace_request_ctx["connect_time"] = 1000 * (
+            time.time() - trace_config_ctx.connect_start_time
+        )
+
+
+def new_aio_session(pool_size=None, connect_timeout=None, read_timeout=None):
+    """Return an aiohttp.ClientSession recording connection setup times.
+
+    Pass trace_request_ctx={} to a request, it gets a "connect_time" key
+    in ms when the request had to open a new connection.
+    """
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is required for HTTP requests with the asyncio user engine")
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(_on_connection_create_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size or 0, ssl=False),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout),
+        trace_configs=[trace_config],
+    )
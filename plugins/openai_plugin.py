@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import time
@@ -5,9 +6,14 @@ import time
 import requests
 import urllib3
 
-from plugins import plugin
+from plugins import http_session, plugin, sse
 from result import RequestResult
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 urllib3.disable_warnings()
 """
 Example plugin config.yaml:
@@ -18,17 +24,38 @@ plugin_options:
   host: "http://127.0.0.1:5000/v1/completions"
   model_name: "/mnt/model/"
   endpoint: "/v1/completions" # "/v1/chat/completions"
+  pool_size: 10 # Optional, connections kept alive per host
+  connect_timeout: 10 # Optional, seconds
+  read_timeout: 300 # Optional, seconds without receiving data
 """
 
 required_args = ["host", "streaming", "endpoint"]
 
 logger = logging.getLogger("user")
 
+# Bytes read from the socket at once when streaming, read1 returns whatever has arrived up to this.
+sse_read_size = 65536
+
+
+def iter_stream_chunks(response):
+    """Yield the decoded chunks of a streamed response as soon as they arrive."""
+    raw = response.raw
+    if hasattr(raw, "read1"):
+        # raw is created with decode_content=False, compressed streams must be decoded here
+        yield from iter(lambda: raw.read1(sse_read_size, decode_content=True), b"")
+    else:
+        # urllib3 < 2 has no read1, chunk_size=None yields each chunk of a chunked response as it arrives
+        yield from response.iter_content(chunk_size=None)
+
+
 # This plugin is written primarily for testing vLLM, though it can be made
 # to work for other runtimes which conform to the OpenAI API, as required.
 class OpenAIPlugin(plugin.Plugin):
     def __init__(self, args):
         self._parse_args(args)
+        # Keep-alive sessions, created lazily in the user process (and inside the worker's event loop)
+        self._session = None
+        self._aio_session = None
 
     def _parse_args(self, args):
         for arg in required_args:
@@ -37,26 +64,30 @@ class OpenAIPlugin(plugin.Plugin):
 
         if args["streaming"]:
             self.request_func = self.streaming_request_http
+            self.async_request_func = self.async_streaming_request_http
         else:
             self.request_func = self.request_http
+            self.async_request_func = self.async_request_http
 
         self.host = args.get("host") + args.get("endpoint")
+        self.chat = "/v1/chat/completions" in self.host
 
         self.model_name = args.get("model_name")
 
-    def request_http(self, query: dict, user_id: int, test_end_time: float = 0):
+        self.pool_size = args.get("pool_size")
+        self.connect_timeout = args.get("connect_timeout")
+        self.read_timeout = args.get("read_timeout")
 
-        result = RequestResult(user_id, query.get("text"), query.get("input_tokens"))
-
-        result.start_time = time.time()
-
-        headers = {"Content-Type": "application/json"}
+    def _messages(self, query: dict):
+        # Turns of a multi-turn session carry their whole conversation
+        if query.get("messages") is not None:
+            return query["messages"]
+        return [{"role": "user", "content": query["text"]}]
 
-        if "/v1/chat/completions" in self.host:
+    def _request_data(self, query: dict):
+        if self.chat:
             data = {
-                "messages": [
-                    {"role": "user", "content": query["text"]}
-                ],
+                "messages": self._messages(query),
                 "max_tokens": query["output_tokens"],
                 "temperature": 0.1,
             }
@@ -71,36 +102,34 @@ class OpenAIPlugin(plugin.Plugin):
             }
         if self.model_name is not None:
             data["model"] = self.model_name
+        return data
 
-        response = None
-        try:
-            response = requests.post(self.host, headers=headers, json=data, verify=False)
-            response.raise_for_status()
-        except requests.exceptions.ConnectionError as err:
-            result.end_time = time.time()
-            result.error_text = repr(err)
-            if response is not None:
-                result.error_code = response.status_code
-            logger.exception("Connection error")
-            return result
-        except requests.exceptions.HTTPError as err:
-            result.end_time = time.time()
-            result.error_text = repr(err)
-            if response is not None:
-                result.error_code = response.status_code
-            logger.exception("HTTP error")
-            return result
+    def _streaming_request_data(self, query: dict):
+        data = {
+                "max_tokens": query["output_tokens"],
+                "temperature": 0.1,
+                "stream": True,
+            }
+        if self.chat:
+            data["messages"] = self._messages(query)
+        else:
+            data["prompt"] = query["text"],
+            data["min_tokens"] = query["output_tokens"]
 
-        result.end_time = time.time()
+        # some runtimes only serve one model, won't check this.
+        if self.model_name is not None:
+            data["model"] = self.model_name
+        return data
 
-        logger.debug("Response: %s", json.dumps(response.text))
+    def _process_response(self, result: RequestResult, text: str, status_code: int):
+        logger.debug("Response: %s", json.dumps(text))
 
         try:
-            message = json.loads(response.text)
+            message = json.loads(text)
             error = message.get("error")
             if error is None:
-                if "/v1/chat/completions" in self.host:
-                    result.output_text = message["choices"][0]['delta']['content']
+                if self.chat:
+                    result.output_text = message["choices"][0]["message"]["content"]
                 else:
                     result.output_text = message["choices"][0]["text"]
 
@@ -108,52 +137,178 @@ class OpenAIPlugin(plugin.Plugin):
                 result.input_tokens = message["usage"]["prompt_tokens"]
                 result.stop_reason =  message["choices"][0]["finish_reason"]
             else:
-                result.error_code = response.status_code
+                result.error_code = status_code
                 result.error_text = error
                 logger.error("Error received in response message: %s", error)
         except json.JSONDecodeError:
-            logger.exception("Response could not be json decoded: %s", response.text)
-            result.error_text = f"Response could not be json decoded {response.text}"
+            logger.exception("Response could not be json decoded: %s", text)
+            result.error_text = f"Response could not be json decoded {text}"
         except KeyError:
-            logger.exception("KeyError, unexpected response format: %s", response.text)
-            result.error_text = f"KeyError, unexpected response format: {response.text}"
+            logger.exception("KeyError, unexpected response format: %s", text)
+            result.error_text = f"KeyError, unexpected response format: {text}"
 
         # For non-streaming requests we are keeping output_tokens_before_timeout and output_tokens same.
         result.output_tokens_before_timeout = result.output_tokens
         result.calculate_results()
 
+    def _process_stream_events(self, result: RequestResult, tokens: list, events: list, test_end_time: float,
+                               status_code: int):
+        """Decode the (arrival time, perf_counter time, data) events of a streamed response once it is over."""
+        for event_time, event_perf_time, data in events:
+            if data == b"[DONE]":
+                continue
+            try:
+                message = sse.json_loads(data)
+                error = message.get("error")
+                if error is not None:
+                    result.error_code = status_code
+                    result.error_text = error
+                    logger.error("Error received in response message: %s", error)
+                    return
+                choice = message["choices"][0]
+                if self.chat:
+                    token = choice["delta"].get("content") or ""
+                else:
+                    token = choice["text"]
+            except ValueError:
+                logger.exception("Response event could not be json decoded: %s", data)
+                continue
+            except (KeyError, IndexError):
+                logger.exception("KeyError, unexpected response format in event: %s", data)
+                continue
+
+            # First chunk may not be a token, just a connection ack
+            if not result.ack_time:
+                result.ack_time = event_time
+
+            # First non empty token is the first token
+            if not result.first_token_time and token != "":
+                result.first_token_time = event_time
+            if result.first_token_time and token != "":
+                result.add_token_time(event_perf_time)
+
+            # If the current token time is outside the test duration, record the total tokens received before
+            # the current token.
+            if not result.output_tokens_before_timeout and event_time > test_end_time:
+                result.output_tokens_before_timeout = len(tokens)
+
+            tokens.append(token)
+
+            # Last token comes with finish_reason set.
+            if choice.get("finish_reason"):
+                result.stop_reason = choice["finish_reason"]
+                usage = message.get("usage")
+                if usage is not None:
+                    result.output_tokens = usage.get("completion_tokens")
+                    result.input_tokens = usage.get("prompt_tokens")
+
+                # If test duration timeout didn't happen before the last token is received,
+                # total tokens before the timeout will be equal to the total tokens in the response.
+                if not result.output_tokens_before_timeout:
+                    result.output_tokens_before_timeout = result.output_tokens or len(tokens)
+
+    def _finish_stream(self, result: RequestResult, tokens: list, query: dict):
+        # Full response received, return
+        result.end_time = time.time()
+        result.output_text = "".join(tokens)
+
+        if not result.input_tokens:
+            logger.warning("Input token count not found in response, using dataset input_tokens")
+            result.input_tokens = query.get("input_tokens")
+
+        if not result.output_tokens:
+            logger.warning("Output token count not found in response, length of token list")
+            result.output_tokens = len(tokens)
+
+        result.calculate_results()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = http_session.new_session(self.pool_size)
+        return self._session
+
+    def _read_timeout(self, deadline):
+        # read_timeout, cut short by the hard deadline
+        if deadline is None:
+            return self.read_timeout
+        remaining = max(0.001, deadline - time.time())
+        return remaining if self.read_timeout is None else min(self.read_timeout, remaining)
+
+    def _deadline_reached(self, deadline):
+        return deadline is not None and time.time() >= deadline
+
+    def request_http(self, query: dict, user_id: int, test_end_time: float = 0):
+
+        result = RequestResult(user_id, query.get("text"), query.get("input_tokens"))
+
+        deadline = self.request_deadline(test_end_time)
+
+        result.start_time = time.time()
+
+        headers = {"Content-Type": "application/json"}
+
+        data = self._request_data(query)
+
+        response = None
+        http_session.pop_connect_time()
+        try:
+            response = self._get_session().post(
+                self.host, headers=headers, json=data, timeout=(self.connect_timeout, self._read_timeout(deadline))
+            )
+            result.connect_time = http_session.pop_connect_time()
+            response.raise_for_status()
+        except requests.exceptions.ConnectionError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            if response is not None:
+                result.error_code = response.status_code
+            logger.exception("Connection error")
+            return result
+        except requests.exceptions.Timeout as err:
+            result.end_time = time.time()
+            if not self._deadline_reached(deadline):
+                result.error_text = repr(err)
+                logger.exception("Read timeout")
+                return result
+            # Aborted at the hard deadline, no tokens were received
+            self.mark_deadline_exceeded(result, 0)
+            result.output_tokens = 0
+            result.calculate_results()
+            return result
+        except requests.exceptions.HTTPError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            if response is not None:
+                result.error_code = response.status_code
+            logger.exception("HTTP error")
+            return result
+
+        result.end_time = time.time()
+
+        self._process_response(result, response.text, response.status_code)
+
         return result
 
 
     def streaming_request_http(self, query: dict, user_id: int, test_end_time: float):
         headers = {"Content-Type": "application/json"}
 
-        data = {
-                "max_tokens": query["output_tokens"],
-                "temperature": 0.1,
-                "stream": True,
-            }
-        if "/v1/chat/completions" in self.host:
-            data["messages"] = [
-                    {"role": "user", "content": query["text"]}
-                ]
-        else:
-            data["prompt"] = query["text"],
-            data["min_tokens"] = query["output_tokens"]
-
-        # some runtimes only serve one model, won't check this.
-        if self.model_name is not None:
-            data["model"] = self.model_name
+        data = self._streaming_request_data(query)
 
         result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
 
+        deadline = self.request_deadline(test_end_time)
+
         tokens = []
         response = None
+        http_session.pop_connect_time()
         result.start_time = time.time()
         try:
-            response = requests.post(
-                self.host, headers=headers, json=data, verify=False, stream=True
+            response = self._get_session().post(
+                self.host, headers=headers, json=data, stream=True,
+                timeout=(self.connect_timeout, self._read_timeout(deadline)),
             )
+            result.connect_time = http_session.pop_connect_time()
             response.raise_for_status()
         except requests.exceptions.ConnectionError as err:
             result.end_time = time.time()
@@ -162,6 +317,16 @@ class OpenAIPlugin(plugin.Plugin):
                 result.error_code = response.status_code
             logger.exception("Connection error")
             return result
+        except requests.exceptions.Timeout as err:
+            if not self._deadline_reached(deadline):
+                result.end_time = time.time()
+                result.error_text = repr(err)
+                logger.exception("Read timeout")
+                return result
+            # Aborted at the hard deadline, the stream never started
+            self.mark_deadline_exceeded(result, 0)
+            self._finish_stream(result, tokens, query)
+            return result
         except requests.exceptions.HTTPError as err:
             result.end_time = time.time()
             result.error_text = repr(err)
@@ -171,82 +336,175 @@ class OpenAIPlugin(plugin.Plugin):
             return result
 
         logger.debug("Response: %s", response)
-        message = None
-        for line in response.iter_lines():
-            logger.debug("response line: %s", line)
-            _, found, data = line.partition(b"data: ")
-            if found and data != b"[DONE]":
-                try:
-                    message = json.loads(data)
-                    logger.debug("Message: %s", message)
-                    if "/v1/chat/completions" in self.host and not message["choices"][0]['delta'].get('content'):
-                        message["choices"][0]['delta']['content']=""
-                    error = message.get("error")
-                    if error is None:
-                        if "/v1/chat/completions" in self.host:
-                            token = message["choices"][0]['delta']['content']
-                        else:
-                            token = message["choices"][0]["text"]
-                        logger.debug("Token: %s", token)
-                    else:
-                        result.error_code = response.status_code
-                        result.error_text = error
-                        logger.error("Error received in response message: %s", error)
-                        break
-                except json.JSONDecodeError:
-                    logger.exception("Response line could not be json decoded: %s", line)
-                except KeyError:
-                    logger.exception(
-                        "KeyError, unexpected response format in line: %s", line
-                    )
-                    continue
-            else:
-                continue
+        # Events are only timestamped while streaming, they are decoded once the response is over
+        parser = sse.SSEParser()
+        events = []
+        aborted = False
+        watchdog = None
+        if deadline is not None:
+            watchdog = plugin.start_deadline_watchdog(response, deadline)
+        try:
+            for chunk in iter_stream_chunks(response):
+                chunk_time = time.time()
+                chunk_perf_time = time.perf_counter()
+                for data in parser.feed(chunk):
+                    events.append((chunk_time, chunk_perf_time, data))
+                if events and b'"error"' in events[-1][2]:
+                    break
+                if deadline is not None and chunk_time >= deadline:
+                    aborted = True
+                    break
+            events.extend((time.time(), time.perf_counter(), data) for data in parser.flush())
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as err:
+            if not self._deadline_reached(deadline):
+                result.end_time = time.time()
+                result.error_text = repr(err)
+                result.error_code = response.status_code
+                logger.exception("Error while reading the response stream")
+                return result
+            # The watchdog shut down the stalled connection
+            aborted = True
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            response.close()
+
+        self._process_stream_events(result, tokens, events, test_end_time, response.status_code)
+        if (aborted or self._deadline_reached(deadline)) and result.stop_reason is None:
+            self.mark_deadline_exceeded(result, len(tokens))
+        self._finish_stream(result, tokens, query)
+        return result
 
-            try:
-                # First chunk may not be a token, just a connection ack
-                if not result.ack_time:
-                    result.ack_time = time.time()
-
-                # First non empty token is the first token
-                if not result.first_token_time and token != "":
-                    result.first_token_time = time.time()
-
-                # If the current token time is outside the test duration, record the total tokens received before
-                # the current token.
-                if (
-                    not result.output_tokens_before_timeout
-                    and time.time() > test_end_time
-                ):
-                    result.output_tokens_before_timeout = len(tokens)
-
-                tokens.append(token)
-
-                # Last token comes with finish_reason set.
-                if message.get("choices", [])[0].get("finish_reason", None):
-                    result.output_tokens = message["usage"]["completion_tokens"]
-                    result.input_tokens = message["usage"]["prompt_tokens"]
-                    result.stop_reason =  message["choices"][0]["finish_reason"]
-
-                    # If test duration timeout didn't happen before the last token is received, 
-                    # total tokens before the timeout will be equal to the total tokens in the response.
-                    if not result.output_tokens_before_timeout:
-                        result.output_tokens_before_timeout = result.output_tokens
-
-            except KeyError:
-                logging.exception("KeyError, unexpected response format in line: %s", line)
+    def _get_aio_session(self):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required to use the openai_plugin with the asyncio user engine")
+        if self._aio_session is None:
+            # One session (and connection pool) is shared by all users in the worker process
+            self._aio_session = http_session.new_aio_session(self.pool_size, self.connect_timeout, self.read_timeout)
+        return self._aio_session
+
+    async def async_close(self):
+        if self._aio_session is not None:
+            await self._aio_session.close()
+            self._aio_session = None
+
+    async def async_request_http(self, query: dict, user_id: int, test_end_time: float = 0):
+        session = self._get_aio_session()
+
+        result = RequestResult(user_id, query.get("text"), query.get("input_tokens"))
+
+        deadline = self.request_deadline(test_end_time)
+
+        result.start_time = time.time()
+
+        headers = {"Content-Type": "application/json"}
+
+        data = self._request_data(query)
+
+        trace_ctx = {}
+        try:
+            async with session.post(
+                self.host, headers=headers, json=data, trace_request_ctx=trace_ctx,
+                timeout=aiohttp.ClientTimeout(
+                    total=None if deadline is None else max(0.001, deadline - time.time()),
+                    sock_connect=self.connect_timeout,
+                    sock_read=self.read_timeout,
+                ),
+            ) as response:
+                result.connect_time = trace_ctx.get("connect_time")
+                response.raise_for_status()
+                text = await response.text()
+                status_code = response.status
+        except asyncio.TimeoutError as err:
+            result.end_time = time.time()
+            if not self._deadline_reached(deadline):
+                result.error_text = repr(err)
+                logger.exception("Read timeout")
+                return result
+            # Aborted at the hard deadline, no tokens were received
+            self.mark_deadline_exceeded(result, 0)
+            result.output_tokens = 0
+            result.calculate_results()
+            return result
+        except aiohttp.ClientResponseError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            result.error_code = err.status
+            logger.exception("HTTP error")
+            return result
+        except aiohttp.ClientError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            logger.exception("Connection error")
+            return result
 
-        # Full response received, return
         result.end_time = time.time()
-        result.output_text = "".join(tokens)
 
-        if not result.input_tokens:
-            logger.warning("Input token count not found in response, using dataset input_tokens")
-            result.input_tokens = query.get("input_tokens")
+        self._process_response(result, text, status_code)
 
-        if not result.output_tokens:
-            logger.warning("Output token count not found in response, length of token list")
-            result.output_tokens = len(tokens)
+        return result
 
-        result.calculate_results()
+    async def _read_stream(self, response, events: list):
+        parser = sse.SSEParser()
+        async for chunk in response.content.iter_any():
+            chunk_time = time.time()
+            chunk_perf_time = time.perf_counter()
+            for data in parser.feed(chunk):
+                events.append((chunk_time, chunk_perf_time, data))
+            if events and b'"error"' in events[-1][2]:
+                return
+        events.extend((time.time(), time.perf_counter(), data) for data in parser.flush())
+
+    async def async_streaming_request_http(self, query: dict, user_id: int, test_end_time: float):
+        session = self._get_aio_session()
+
+        headers = {"Content-Type": "application/json"}
+
+        data = self._streaming_request_data(query)
+
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+
+        deadline = self.request_deadline(test_end_time)
+
+        tokens = []
+        events = []
+        aborted = False
+        status_code = None
+        trace_ctx = {}
+        result.start_time = time.time()
+        try:
+            # Leaving the context manager early closes the connection, aborting the stream
+            async with session.post(self.host, headers=headers, json=data, trace_request_ctx=trace_ctx) as response:
+                result.connect_time = trace_ctx.get("connect_time")
+                response.raise_for_status()
+                logger.debug("Response: %s", response)
+                status_code = response.status
+                await asyncio.wait_for(
+                    self._read_stream(response, events),
+                    timeout=None if deadline is None else max(0.001, deadline - time.time()),
+                )
+        except asyncio.TimeoutError as err:
+            if not self._deadline_reached(deadline):
+                result.end_time = time.time()
+                result.error_text = repr(err)
+                logger.exception("Read timeout")
+                return result
+            # Aborted at the hard deadline
+            aborted = True
+        except aiohttp.ClientResponseError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            result.error_code = err.status
+            logger.exception("HTTP error")
+            return result
+        except aiohttp.ClientError as err:
+            result.end_time = time.time()
+            result.error_text = repr(err)
+            logger.exception("Connection error")
+            return result
+
+        self._process_stream_events(result, tokens, events, test_end_time, status_code)
+        if aborted and result.stop_reason is None:
+            self.mark_deadline_exceeded(result, len(tokens))
+        self._finish_stream(result, tokens, query)
         return result
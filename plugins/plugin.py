@@ -1,7 +1,58 @@
+import socket
+import threading
+import time
+
+# stop_reason of a request aborted at its hard deadline
+deadline_stop_reason = "deadline_exceeded"
+
+
+def start_deadline_watchdog(response, deadline):
+    """Shut down the socket of a streaming requests.Response at deadline.
+
+    Closing the socket from another thread does not wake up a blocked read,
+    shutting it down does, so a stalled stream can't outlive the deadline.
+    Returns the timer, cancel it once the response is done.
+    """
+    def abort():
+        connection = getattr(response.raw, "_connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    timer = threading.Timer(max(0.0, deadline - time.time()), abort)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
 class Plugin:
+    # Coroutine used by the asyncio user engine, plugins which support
+    # it set this in _parse_args alongside request_func.
+    async_request_func = None
+
+    # Seconds after test_end_time at which in-flight requests are aborted,
+    # None lets them run to completion. Set from load_options.hard_deadline.
+    deadline_grace = None
+
     def __init__(self, args):
         self.args = args
 
+    def request_deadline(self, test_end_time):
+        """Return the absolute time at which a request must be aborted, or None."""
+        if self.deadline_grace is None or not test_end_time:
+            # test_end_time is 0 during warmup
+            return None
+        return test_end_time + self.deadline_grace
+
+    def mark_deadline_exceeded(self, result, tokens_received):
+        """Record a request aborted at its hard deadline as a partial result."""
+        result.stop_reason = deadline_stop_reason
+        if result.output_tokens_before_timeout is None:
+            result.output_tokens_before_timeout = tokens_received
+
     def request_http(self, query, user_id):
         pass
 
@@ -13,3 +64,7 @@ class Plugin:
 
     def streaming_request_grpc(self, query, user_id):
         pass
+
+    async def async_close(self):
+        """Release connections opened by the async request functions."""
+        pass
@@ -0,0 +1,48 @@
+"""Incremental parser for server-sent event (SSE) streams."""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Decoder for the JSON payload of the events, orjson is several times faster when installed.
+json_loads = json.loads if orjson is None else orjson.loads
+
+
+class SSEParser:
+    """Split an event stream, fed in chunks as they come off the socket, into the data of each event.
+
+    Only data fields are kept, other fields and comments are ignored. A
+    chunk can hold several events, or end in the middle of one.
+    """
+
+    def __init__(self):
+        """Init method."""
+        self._buffer = b""
+        self._data = []
+
+    def feed(self, chunk):
+        """Return the data of the events completed by chunk."""
+        events = []
+        lines = (self._buffer + chunk).split(b"\n") if self._buffer else chunk.split(b"\n")
+        # The last line is incomplete, or empty when chunk ends on a newline
+        self._buffer = lines.pop()
+        for line in lines:
+            if line[-1:] == b"\r":
+                line = line[:-1]
+            if not line:
+                # A blank line dispatches the event
+                if self._data:
+                    events.append(self._data[0] if len(self._data) == 1 else b"\n".join(self._data))
+                    self._data = []
+            elif line[:5] == b"data:":
+                self._data.append(line[6:] if line[5:6] == b" " else line[5:])
+        return events
+
+    def flush(self):
+        """Return the data of an event left unterminated at the end of the stream."""
+        events = self.feed(b"\n\n") if self._buffer else self.feed(b"\n")
+        self._buffer = b""
+        return events
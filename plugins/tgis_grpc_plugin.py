@@ -2,6 +2,7 @@ import logging
 import time
 
 import grpc
+import grpc.aio
 import socket
 import ssl
 import sys
@@ -26,13 +27,33 @@ plugin_options:
   model_name: "Llama-2-7b-hf"
   host: "localhost"
   port: 8033
+  keepalive_time_ms: 30000 # Optional gRPC channel settings
+  max_message_size: 16777216
+  channel_options: # Optional, any other grpc channel argument
+    grpc.max_concurrent_streams: 100
 """
 
+# Friendly plugin options mapped to the gRPC channel arguments they set.
+channel_arg_options = {
+    "keepalive_time_ms": ["grpc.keepalive_time_ms"],
+    "keepalive_timeout_ms": ["grpc.keepalive_timeout_ms"],
+    "keepalive_permit_without_calls": ["grpc.keepalive_permit_without_calls"],
+    "max_concurrent_streams": ["grpc.max_concurrent_streams"],
+    "max_message_size": ["grpc.max_send_message_length", "grpc.max_receive_message_length"],
+}
+
 
 class TGISGRPCPlugin(plugin.Plugin):
     def __init__(self, args):
         self._parse_args(args)
         self.connection = f"{self.host}:{self.port}"
+        # The server certificate is fetched once, channels and stubs are created
+        # once per user process (and inside the worker's event loop for grpc.aio)
+        self._credentials = None
+        self._channel = None
+        self._stub = None
+        self._aio_channel = None
+        self._aio_stub = None
 
     def _parse_args(self, args):
         for arg in required_args:
@@ -44,10 +65,20 @@ class TGISGRPCPlugin(plugin.Plugin):
         self.port = args["port"]
         self.use_tls = bool(args["use_tls"])
 
+        channel_options = {}
+        for option, channel_args in channel_arg_options.items():
+            if args.get(option) is not None:
+                for channel_arg in channel_args:
+                    channel_options[channel_arg] = int(args[option])
+        channel_options.update(args.get("channel_options") or {})
+        self.channel_options = list(channel_options.items())
+
         if args["streaming"]:
             self.request_func = self.make_request_stream
+            self.async_request_func = self.async_make_request_stream
         else:
             self.request_func = self.make_request
+            self.async_request_func = self.async_make_request
 
     def get_server_certificate(self, host: str, port: int) -> str:
         if sys.version_info >= (3, 10):
@@ -63,25 +94,26 @@ class TGISGRPCPlugin(plugin.Plugin):
         return ssl.DER_cert_to_PEM_cert(cert_der)
 
     def channel_credentials(self):
-        cert = self.get_server_certificate(self.host, self.port).encode()
-        credentials_kwargs: dict[str, bytes] = {}
-        credentials_kwargs.update(root_certificates=cert)
-        return grpc.ssl_channel_credentials(**credentials_kwargs)
+        if self._credentials is None:
+            cert = self.get_server_certificate(self.host, self.port).encode()
+            credentials_kwargs: dict[str, bytes] = {}
+            credentials_kwargs.update(root_certificates=cert)
+            self._credentials = grpc.ssl_channel_credentials(**credentials_kwargs)
+        return self._credentials
 
-    def make_request(self, query: dict, user_id: int, test_end_time: float = 0):
-        if self.use_tls:
-            grpc_channel = grpc.secure_channel(self.connection, self.channel_credentials())
-        else:
-            grpc_channel = grpc.insecure_channel(self.connection)
-
-        generation_service_stub = generation_pb2_grpc.GenerationServiceStub(
-            grpc_channel
-        )
+    def _get_stub(self):
+        if self._stub is None:
+            if self.use_tls:
+                self._channel = grpc.secure_channel(
+                    self.connection, self.channel_credentials(), options=self.channel_options
+                )
+            else:
+                self._channel = grpc.insecure_channel(self.connection, options=self.channel_options)
+            self._stub = generation_pb2_grpc.GenerationServiceStub(self._channel)
+        return self._stub
 
-        result = RequestResult(
-            user_id, query.get("input_id"), query.get("input_tokens")
-        )
-        request = generation_pb2_grpc.generation__pb2.BatchedGenerationRequest(
+    def _generation_request(self, query: dict):
+        return generation_pb2_grpc.generation__pb2.BatchedGenerationRequest(
             model_id=self.model_name,
             requests=[
                 generation_pb2_grpc.generation__pb2.GenerationRequest(
@@ -96,15 +128,26 @@ class TGISGRPCPlugin(plugin.Plugin):
                 ),
             ),
         )
-        result.start_time = time.time()
-        try:
-            response = generation_service_stub.Generate(request=request)
-        except grpc.RpcError as err:
-            result.end_time = time.time()
-            result.error_text = err.details()
-            result.error_code = err.code().value[0]
-            return result
 
+    def _stream_generation_request(self, query: dict):
+        return generation_pb2_grpc.generation__pb2.SingleGenerationRequest(
+            model_id=self.model_name,
+            request=generation_pb2_grpc.generation__pb2.GenerationRequest(
+                text=query.get("text")
+            ),
+            params=generation_pb2_grpc.generation__pb2.Parameters(
+                method=generation_pb2_grpc.generation__pb2.GREEDY,
+                stopping=generation_pb2_grpc.generation__pb2.StoppingCriteria(
+                    max_new_tokens=query["output_tokens"],
+                    min_new_tokens=query["output_tokens"],
+                ),
+                response=generation_pb2_grpc.generation__pb2.ResponseOptions(
+                    generated_tokens=True
+                ),
+            ),
+        )
+
+    def _process_response(self, result: RequestResult, response, query: dict):
         result.end_time = time.time()
 
         # Only doing one prompt per requests
@@ -122,82 +165,183 @@ class TGISGRPCPlugin(plugin.Plugin):
             result.output_tokens = query["output_tokens"]
 
         result.calculate_results()
-        return result
 
-    def make_request_stream(self, query: dict, user_id: int, test_end_time: float):
-        if self.use_tls:
-            grpc_channel = grpc.secure_channel(self.connection, self.channel_credentials())
-        else:
-            grpc_channel = grpc.insecure_channel(self.connection)
+    def _process_stream_response(self, result: RequestResult, tokens: list, resp, test_end_time: float):
+        # the first response is not a token, just an acknowledgement
+        if not result.ack_time and not resp.tokens:
+            result.ack_time = time.time()
+            if resp.input_token_count:
+                result.input_tokens = resp.input_token_count
+        if resp.tokens:
+            if not result.first_token_time and resp.tokens[0].text != "":
+                result.first_token_time = time.time()
+            if result.first_token_time:
+                result.add_token_time(time.perf_counter())
+            # If the current token time is outside the test duration, record the total tokens received before
+            # the current token.
+            if (
+                not result.output_tokens_before_timeout
+                and time.time() > test_end_time
+            ):
+                result.output_tokens_before_timeout = len(tokens)
+            tokens.append(resp.text)
+        if resp.stop_reason:
+            # Last resp
+            result.stop_reason = resp.stop_reason
+            result.output_tokens = resp.generated_token_count
+            # If test duration timeout didn't happen before the last token is received, total tokens before the
+            # timeout will be equal to the total tokens in the response.
+            if not result.output_tokens_before_timeout:
+                result.output_tokens_before_timeout = result.output_tokens
+
+    def _finish_stream(self, result: RequestResult, tokens: list, query: dict):
+        result.end_time = time.time()
+        result.output_text = "".join(tokens)
+
+        if not result.input_tokens:
+            logger.warning("Input token count not found in response, using dataset input_tokens")
+            result.input_tokens = query.get("input_tokens")
+
+        if not result.output_tokens:
+            logger.warning("Output token count not found in response, using dataset expected output tokens")
+            result.output_tokens = len(tokens)
+
+        result.calculate_results()
 
-        generation_service_stub = generation_pb2_grpc.GenerationServiceStub(
-            grpc_channel
+    def _deadline_timeout(self, deadline):
+        # gRPC deadline of the call, in seconds from now
+        if deadline is None:
+            return None
+        return max(0.001, deadline - time.time())
+
+    def _is_deadline_exceeded(self, err, deadline):
+        return deadline is not None and err.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+
+    def make_request(self, query: dict, user_id: int, test_end_time: float = 0):
+        generation_service_stub = self._get_stub()
+
+        result = RequestResult(
+            user_id, query.get("input_id"), query.get("input_tokens")
         )
+        request = self._generation_request(query)
+        deadline = self.request_deadline(test_end_time)
+        result.start_time = time.time()
+        try:
+            response = generation_service_stub.Generate(request=request, timeout=self._deadline_timeout(deadline))
+        except grpc.RpcError as err:
+            result.end_time = time.time()
+            if self._is_deadline_exceeded(err, deadline):
+                # Aborted at the hard deadline, no tokens were received
+                self.mark_deadline_exceeded(result, 0)
+                result.output_tokens = 0
+                result.calculate_results()
+                return result
+            result.error_text = err.details()
+            result.error_code = err.code().value[0]
+            return result
+
+        self._process_response(result, response, query)
+        return result
+
+    def make_request_stream(self, query: dict, user_id: int, test_end_time: float):
+        generation_service_stub = self._get_stub()
         result = RequestResult(
             user_id, query.get("input_id"), query.get("input_tokens")
         )
         tokens = []
-        request = generation_pb2_grpc.generation__pb2.SingleGenerationRequest(
-            model_id=self.model_name,
-            request=generation_pb2_grpc.generation__pb2.GenerationRequest(
-                text=query.get("text")
-            ),
-            params=generation_pb2_grpc.generation__pb2.Parameters(
-                method=generation_pb2_grpc.generation__pb2.GREEDY,
-                stopping=generation_pb2_grpc.generation__pb2.StoppingCriteria(
-                    max_new_tokens=query["output_tokens"],
-                    min_new_tokens=query["output_tokens"],
-                ),
-                response=generation_pb2_grpc.generation__pb2.ResponseOptions(
-                    generated_tokens=True
-                ),
-            ),
-        )
+        request = self._stream_generation_request(query)
+        deadline = self.request_deadline(test_end_time)
         result.start_time = time.time()
 
         try:
-            resp_stream = generation_service_stub.GenerateStream(request=request)
+            resp_stream = generation_service_stub.GenerateStream(
+                request=request, timeout=self._deadline_timeout(deadline)
+            )
             for resp in resp_stream:
-                # the first response is not a token, just an acknowledgement
-                if not result.ack_time and not resp.tokens:
-                    result.ack_time = time.time()
-                    if resp.input_token_count:
-                        result.input_tokens = resp.input_token_count
-                if resp.tokens:
-                    if not result.first_token_time and resp.tokens[0].text != "":
-                        result.first_token_time = time.time()
-                    # If the current token time is outside the test duration, record the total tokens received before
-                    # the current token.
-                    if (
-                        not result.output_tokens_before_timeout
-                        and time.time() > test_end_time
-                    ):
-                        result.output_tokens_before_timeout = len(tokens)
-                    tokens.append(resp.text)
-                if resp.stop_reason:
-                    # Last resp
-                    result.stop_reason = resp.stop_reason
-                    result.output_tokens = resp.generated_token_count
-                    # If test duration timeout didn't happen before the last token is received, total tokens before the
-                    # timeout will be equal to the total tokens in the response.
-                    if not result.output_tokens_before_timeout:
-                        result.output_tokens_before_timeout = result.output_tokens
+                self._process_stream_response(result, tokens, resp, test_end_time)
+        except grpc.RpcError as err:
+            if self._is_deadline_exceeded(err, deadline):
+                # Aborted at the hard deadline, keep the tokens received so far
+                self.mark_deadline_exceeded(result, len(tokens))
+            else:
+                result.end_time = time.time()
+                result.error_text = err.details()
+                result.error_code = err.code().value[0]
+                return result
+
+        self._finish_stream(result, tokens, query)
+        return result
+
+    def _get_aio_stub(self):
+        # grpc.aio channels are bound to the event loop they are created in, so
+        # the channel is created lazily and shared by all users in the worker.
+        if self._aio_stub is None:
+            if self.use_tls:
+                self._aio_channel = grpc.aio.secure_channel(
+                    self.connection, self.channel_credentials(), options=self.channel_options
+                )
+            else:
+                self._aio_channel = grpc.aio.insecure_channel(self.connection, options=self.channel_options)
+            self._aio_stub = generation_pb2_grpc.GenerationServiceStub(self._aio_channel)
+        return self._aio_stub
+
+    async def async_close(self):
+        if self._aio_channel is not None:
+            await self._aio_channel.close()
+            self._aio_channel = None
+            self._aio_stub = None
+
+    async def async_make_request(self, query: dict, user_id: int, test_end_time: float = 0):
+        generation_service_stub = self._get_aio_stub()
+
+        result = RequestResult(
+            user_id, query.get("input_id"), query.get("input_tokens")
+        )
+        request = self._generation_request(query)
+        deadline = self.request_deadline(test_end_time)
+        result.start_time = time.time()
+        try:
+            response = await generation_service_stub.Generate(request=request, timeout=self._deadline_timeout(deadline))
         except grpc.RpcError as err:
             result.end_time = time.time()
+            if self._is_deadline_exceeded(err, deadline):
+                # Aborted at the hard deadline, no tokens were received
+                self.mark_deadline_exceeded(result, 0)
+                result.output_tokens = 0
+                result.calculate_results()
+                return result
             result.error_text = err.details()
             result.error_code = err.code().value[0]
             return result
 
-        result.end_time = time.time()
-        result.output_text = "".join(tokens)
+        self._process_response(result, response, query)
+        return result
 
-        if not result.input_tokens:
-            logger.warning("Input token count not found in response, using dataset input_tokens")
-            result.input_tokens = query.get("input_tokens")
+    async def async_make_request_stream(self, query: dict, user_id: int, test_end_time: float):
+        generation_service_stub = self._get_aio_stub()
 
-        if not result.output_tokens:
-            logger.warning("Output token count not found in response, using dataset expected output tokens")
-            result.output_tokens = len(tokens)
+        result = RequestResult(
+            user_id, query.get("input_id"), query.get("input_tokens")
+        )
+        tokens = []
+        request = self._stream_generation_request(query)
+        deadline = self.request_deadline(test_end_time)
+        result.start_time = time.time()
 
-        result.calculate_results()
+        try:
+            async for resp in generation_service_stub.GenerateStream(
+                request=request, timeout=self._deadline_timeout(deadline)
+            ):
+                self._process_stream_response(result, tokens, resp, test_end_time)
+        except grpc.RpcError as err:
+            if self._is_deadline_exceeded(err, deadline):
+                # Aborted at the hard deadline, keep the tokens received so far
+                self.mark_deadline_exceeded(result, len(tokens))
+            else:
+                result.end_time = time.time()
+                result.error_text = err.details()
+                result.error_code = err.code().value[0]
+                return result
+
+        self._finish_stream(result, tokens, query)
         return result
@@ -1,26 +1,86 @@
 """Main result class."""
 
+import math
+import sys
+from array import array
+
+import numpy as np
+
+import pandas as pd
+
+# Sentinel for a missing (None) integer field, float fields use NaN.
+missing_int = -(2 ** 63)
+
 
 class RequestResult:
     """Request result class."""
 
+    # No per instance __dict__, a result is a fixed set of fields
+    __slots__ = (
+        "user_id",
+        "input_id",
+        "input_tokens",
+        "turn",
+        "output_text",
+        "output_tokens",
+        "output_tokens_before_timeout",
+        "scheduled_start_time",
+        "start_time",
+        "ack_time",
+        "first_token_time",
+        "end_time",
+        "connect_time",
+        "response_time",
+        "tt_ack",
+        "ttft",
+        "itl",
+        "token_times",
+        "itl_deltas",
+        "max_itl",
+        "itl_jitter",
+        "tpot",
+        "schedule_delay",
+        "dispatch_delay",
+        "corrected_response_time",
+        "corrected_ttft",
+        "stop_reason",
+        "error_code",
+        "error_text",
+    )
+
     def __init__(self, user_id, input_id, input_tokens):
         """Init method."""
         self.user_id = user_id
         self.input_id = input_id
         self.input_tokens = input_tokens
+        # Turn of the request in its multi-turn session, 0 for the first one, None outside of sessions
+        self.turn = None
         self.output_text = None
         self.output_tokens = None
         self.output_tokens_before_timeout = None
+        self.scheduled_start_time = None
         self.start_time = None
         self.ack_time = None
         self.first_token_time = None
         self.end_time = None
+        # Time in ms spent opening a new connection for this request, None if a kept-alive one was reused
+        self.connect_time = None
         self.response_time = None
         self.tt_ack = None
         self.ttft = None
         self.itl = None
+        # time.perf_counter() at the arrival of each output token, from the first one, while streaming.
+        # calculate_results() replaces it by the gaps between tokens in ms, as float32.
+        self.token_times = None
+        self.itl_deltas = None
+        self.max_itl = None
+        self.itl_jitter = None
         self.tpot = None
+        self.schedule_delay = None
+        # Time in ms the scheduler of the main process dispatched the request after its scheduled start time
+        self.dispatch_delay = None
+        self.corrected_response_time = None
+        self.corrected_ttft = None
         self.stop_reason = None
         self.error_code = None
         self.error_text = None
@@ -29,7 +89,13 @@ class RequestResult:
         """Return a dictionary."""
         # Maybe later we will want to only include some fields in the results,
         # but for now, this just puts all object fields in a dict.
-        return vars(self)
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def add_token_time(self, perf_time):
+        """Record the time.perf_counter() arrival time of an output token."""
+        if self.token_times is None:
+            self.token_times = array("d")
+        self.token_times.append(perf_time)
 
     # Fill in calculated fields like response_time, tt_ack, ttft, tpot.
     def calculate_results(self):
@@ -46,10 +112,217 @@ class RequestResult:
                 self.ttft = 1000 * (
                     self.first_token_time - self.start_time
                 )  # Time to first token in ms
-                self.itl = (1000 * (self.end_time - self.first_token_time)) / (
-                    self.output_tokens - 1
-                )  # Inter-token latency in ms. Distinct from TPOT as it excludes the first token time.
+                # Requests aborted at a hard deadline may have stopped after the first token.
+                if self.output_tokens and self.output_tokens > 1:
+                    self.itl = (1000 * (self.end_time - self.first_token_time)) / (
+                        self.output_tokens - 1
+                    )  # Inter-token latency in ms. Distinct from TPOT as it excludes the first token time.
+
+            if self.token_times is not None:
+                times = self.token_times
+                self.itl_deltas = array("f", [1000 * (times[idx] - times[idx - 1]) for idx in range(1, len(times))])
+                self.token_times = None
+
+            if self.itl_deltas:
+                # Longest stall between two tokens and the standard deviation of the gaps (jitter), in ms
+                self.max_itl = max(self.itl_deltas)
+                mean = sum(self.itl_deltas) / len(self.itl_deltas)
+                self.itl_jitter = math.sqrt(sum((delta - mean) ** 2 for delta in self.itl_deltas) / len(self.itl_deltas))
+
+            if self.output_tokens:
+                self.tpot = (
+                    self.response_time / self.output_tokens
+                )  # Time per output token in ms
+
+        # Open-loop load: latency measured from when the request should have been sent,
+        # corrects for coordinated omission when all users are busy.
+        if self.scheduled_start_time is not None and self.start_time is not None:
+            self.schedule_delay = 1000 * (self.start_time - self.scheduled_start_time)
+            if self.response_time is not None:
+                self.corrected_response_time = self.response_time + self.schedule_delay
+            if self.ttft is not None:
+                self.corrected_ttft = self.ttft + self.schedule_delay
+
+
+class ResultColumns:
+    """Struct of arrays holding many RequestResults, compact to keep and cheap to pickle.
+
+    Integer fields are kept in array("q") with missing_int for None, float
+    fields in array("d") with NaN for None, so pickling one only copies a
+    few buffers. input_id is kept as given, stop_reason strings are interned, output_text is optional
+    and the itl_deltas of all results are concatenated in one array("f").
+    It behaves like a list of RequestResult: len(), iteration and indexing
+    rebuild the results on the fly, to_dataframe() converts all fields at once.
+    """
+
+    int_fields = ["user_id", "input_tokens", "turn", "output_tokens", "output_tokens_before_timeout"]
+    float_fields = [
+        "scheduled_start_time",
+        "start_time",
+        "ack_time",
+        "first_token_time",
+        "end_time",
+        "connect_time",
+        "response_time",
+        "tt_ack",
+        "ttft",
+        "itl",
+        "max_itl",
+        "itl_jitter",
+        "tpot",
+        "schedule_delay",
+        "dispatch_delay",
+        "corrected_response_time",
+        "corrected_ttft",
+    ]
+    # Mostly None, or few distinct values, kept as Python objects. input_id is
+    # whatever the dataset or plugin gives, e.g. the prompt text, not always an int.
+    object_fields = ["input_id", "output_text", "stop_reason", "error_code", "error_text"]
+
+    def __init__(self, keep_output_text=True):
+        """Init method."""
+        self.keep_output_text = keep_output_text
+        self.columns = {name: array("q") for name in self.int_fields}
+        self.columns.update({name: array("d") for name in self.float_fields})
+        self.columns.update({name: [] for name in self.object_fields})
+        # Number of itl_deltas of each result, -1 when it has none
+        self.itl_lengths = array("q")
+        self.itl_deltas = array("f")
+        self._itl_offsets_cache = None
+
+    def __len__(self):
+        """Return the number of results."""
+        return len(self.itl_lengths)
+
+    def append(self, result):
+        """Add a RequestResult."""
+        for name in self.int_fields:
+            value = getattr(result, name)
+            self.columns[name].append(value if isinstance(value, int) else missing_int)
+        for name in self.float_fields:
+            value = getattr(result, name)
+            self.columns[name].append(math.nan if value is None else value)
+        self.columns["input_id"].append(result.input_id)
+        self.columns["output_text"].append(result.output_text if self.keep_output_text else None)
+        self.columns["stop_reason"].append(
+            sys.intern(result.stop_reason) if isinstance(result.stop_reason, str) else result.stop_reason
+        )
+        self.columns["error_code"].append(result.error_code)
+        self.columns["error_text"].append(result.error_text)
+        self._itl_offsets_cache = None
+        if result.itl_deltas is None:
+            self.itl_lengths.append(-1)
+        else:
+            self.itl_lengths.append(len(result.itl_deltas))
+            self.itl_deltas.extend(result.itl_deltas)
+
+    def extend(self, results):
+        """Add the results of another ResultColumns, or an iterable of RequestResult."""
+        if not isinstance(results, ResultColumns):
+            for result in results:
+                self.append(result)
+            return
+        self._itl_offsets_cache = None
+        for name, column in results.columns.items():
+            self.columns[name].extend(column)
+        self.itl_lengths.extend(results.itl_lengths)
+        self.itl_deltas.extend(results.itl_deltas)
+
+    def numpy(self, name):
+        """Return an integer or float column as a numpy array sharing its buffer, NaN/missing_int for None."""
+        column = self.itl_lengths if name == "itl_lengths" else self.columns[name]
+        dtype = np.float64 if column.typecode == "d" else np.int64
+        return np.frombuffer(column, dtype=dtype) if len(column) else np.zeros(0, dtype=dtype)
+
+    def _itl_offsets(self):
+        # Start of the itl_deltas of each result in the concatenated array
+        if self._itl_offsets_cache is None:
+            lengths = np.maximum(self.numpy("itl_lengths"), 0)
+            self._itl_offsets_cache = np.cumsum(lengths) - lengths
+        return self._itl_offsets_cache
+
+    def token_itl(self, mask):
+        """Return the itl_deltas counts and the concatenated itl_deltas of the results selected by mask.
+
+        mask is a boolean numpy array with one entry per result.
+        """
+        lengths = np.maximum(self.numpy("itl_lengths"), 0)
+        deltas = np.frombuffer(self.itl_deltas, dtype=np.float32) if len(self.itl_deltas) else np.zeros(0, np.float32)
+        return lengths[mask], deltas[np.repeat(mask, lengths)]
+
+    def select(self, mask):
+        """Return a new ResultColumns with the results selected by the boolean numpy array mask."""
+        selected = ResultColumns(self.keep_output_text)
+        indexes = np.flatnonzero(mask).tolist()
+        for name in self.int_fields + self.float_fields:
+            selected.columns[name].frombytes(self.numpy(name)[mask].tobytes())
+        for name in self.object_fields:
+            column = self.columns[name]
+            selected.columns[name] = [column[idx] for idx in indexes]
+        selected.itl_lengths.frombytes(self.numpy("itl_lengths")[mask].tobytes())
+        selected.itl_deltas.frombytes(self.token_itl(mask)[1].tobytes())
+        return selected
+
+    def _result(self, idx, itl_offset):
+        result = RequestResult(None, None, None)
+        for name in self.int_fields:
+            value = self.columns[name][idx]
+            setattr(result, name, None if value == missing_int else value)
+        for name in self.float_fields:
+            value = self.columns[name][idx]
+            setattr(result, name, None if math.isnan(value) else value)
+        for name in self.object_fields:
+            setattr(result, name, self.columns[name][idx])
+        length = self.itl_lengths[idx]
+        if length >= 0:
+            result.itl_deltas = self.itl_deltas[itl_offset:itl_offset + length]
+        return result
+
+    def __getitem__(self, idx):
+        """Return the RequestResult at idx, or a list of them for a slice."""
+        offsets = self._itl_offsets()
+        if isinstance(idx, slice):
+            return [self._result(pos, int(offsets[pos])) for pos in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        return self._result(idx, int(offsets[idx]))
+
+    def __iter__(self):
+        """Iterate over the results as RequestResults."""
+        offset = 0
+        for idx in range(len(self)):
+            yield self._result(idx, offset)
+            offset += max(self.itl_lengths[idx], 0)
+
+    def to_records(self, exclude=("token_times", "itl_deltas")):
+        """Return the results as a list of dicts like asdict(), converted column by column."""
+        names = [name for name in RequestResult.__slots__ if name not in exclude]
+        values = []
+        for name in names:
+            if name in self.int_fields:
+                values.append([None if value == missing_int else value for value in self.columns[name]])
+            elif name in self.float_fields:
+                # NaN is the only value not equal to itself
+                values.append([None if value != value else value for value in self.columns[name]])
+            elif name in self.object_fields:
+                values.append(self.columns[name])
+            elif name == "itl_deltas":
+                values.append([result.itl_deltas for result in self])
+            else:
+                values.append([None] * len(self))
+        return [dict(zip(names, row)) for row in zip(*values)]
 
-            self.tpot = (
-                self.response_time / self.output_tokens
-            )  # Time per output token in ms
+    def to_dataframe(self):
+        """Return all results as a DataFrame with one column per field, the same columns as asdict()."""
+        data = {}
+        size = len(self)
+        for name in self.int_fields:
+            values = self.numpy(name)
+            # Nullable integers, like the ints and Nones of the result dicts
+            data[name] = pd.arrays.IntegerArray(values.copy(), values == missing_int)
+        for name in self.float_fields:
+            data[name] = self.numpy(name)
+        for name in self.object_fields:
+            data[name] = pd.Series(self.columns[name], dtype=object, index=pd.RangeIndex(size))
+        df = pd.DataFrame(data)
+        return df[[name for name in RequestResult.__slots__ if name in df]]
@@ -0,0 +1,216 @@
+"""Stream results from user processes to the main process through shared memory."""
+
+import logging
+import math
+import struct
+import threading
+import time
+
+from plugins.plugin import deadline_stop_reason
+
+from result import RequestResult, missing_int
+
+# Bytes of the stop_reason field, longer stop reasons from a server are truncated like error_text.
+stop_reason_size = 32
+
+# Bytes of the input_id_text field holding input_ids which aren't integers, e.g. the prompt text, truncated beyond.
+input_id_text_size = 128
+
+# Stop reasons set by llm-load-test or the OpenAI API, they must come out of the record unchanged.
+known_stop_reasons = [deadline_stop_reason, "stop", "length", "content_filter", "tool_calls", "function_call"]
+
+# Fields of a result record, in order, with their struct format. Derived fields
+# (response_time, ttft, ...) are not stored, calculate_results() restores them.
+# The per token itl_deltas don't fit a fixed size record, only their max and jitter are kept.
+record_fields = [
+    ("user_id", "q"),
+    ("input_id", "q"),
+    ("input_tokens", "q"),
+    ("turn", "q"),
+    ("output_tokens", "q"),
+    ("output_tokens_before_timeout", "q"),
+    ("error_code", "q"),
+    ("scheduled_start_time", "d"),
+    ("dispatch_delay", "d"),
+    ("start_time", "d"),
+    ("ack_time", "d"),
+    ("first_token_time", "d"),
+    ("end_time", "d"),
+    ("connect_time", "d"),
+    ("max_itl", "d"),
+    ("itl_jitter", "d"),
+    ("stop_reason", f"{stop_reason_size}s"),
+    # input_id when it isn't an integer, input_id is then missing_int
+    ("input_id_text", f"{input_id_text_size}s"),
+    ("error_text", "128s"),
+]
+record_struct = struct.Struct("<" + "".join(fmt for _, fmt in record_fields))
+
+assert all(len(reason.encode("utf-8")) <= stop_reason_size for reason in known_stop_reasons), \
+    "A known stop_reason doesn't fit the stop_reason field of the result record"
+
+
+def pack_result(buffer, offset, result):
+    """Pack the fields of a RequestResult into buffer at offset."""
+    values = []
+    for name, fmt in record_fields:
+        if name == "input_id_text":
+            value = None if isinstance(result.input_id, int) else result.input_id
+        else:
+            value = getattr(result, name)
+        if fmt == "q":
+            values.append(value if isinstance(value, int) else missing_int)
+        elif fmt == "d":
+            values.append(math.nan if value is None else value)
+        else:
+            # Text is truncated to the fixed field size
+            values.append(b"" if value is None else str(value).encode("utf-8"))
+    record_struct.pack_into(buffer, offset, *values)
+
+
+def unpack_result(buffer, offset):
+    """Rebuild a RequestResult from the record in buffer at offset."""
+    values = {}
+    for (name, fmt), value in zip(record_fields, record_struct.unpack_from(buffer, offset)):
+        if fmt == "q":
+            values[name] = None if value == missing_int else value
+        elif fmt == "d":
+            values[name] = None if math.isnan(value) else value
+        else:
+            value = value.rstrip(b"\0")
+            values[name] = value.decode("utf-8", errors="ignore") if value else None
+    input_id_text = values.pop("input_id_text")
+    if values["input_id"] is None:
+        values["input_id"] = input_id_text
+    result = RequestResult(values.pop("user_id"), values.pop("input_id"), values.pop("input_tokens"))
+    for name, value in values.items():
+        setattr(result, name, value)
+    result.calculate_results()
+    return result
+
+
+class ResultRingBuffer:
+    """Single producer, single consumer ring buffer of fixed size result records.
+
+    The producer is one user (or async worker) process, the consumer is the
+    main process. head counts the records written and is only written by the
+    producer, tail counts the records read and is only written by the consumer,
+    so no lock is needed.
+    """
+
+    def __init__(self, mp_ctx, capacity=4096):
+        """Init method."""
+        self.capacity = capacity
+        self.buffer = mp_ctx.RawArray("B", capacity * record_struct.size)
+        self.head = mp_ctx.RawValue("Q", 0)
+        self.tail = mp_ctx.RawValue("Q", 0)
+        # Requests started by the producer, head lags behind it by the requests in flight
+        self.started = mp_ctx.RawValue("Q", 0)
+        self.closed = mp_ctx.RawValue("b", 0)
+
+    def request_started(self):
+        """Count a request started by the producer, its result is pushed once it finishes."""
+        self.started.value += 1
+
+    def in_flight(self):
+        """Return the number of requests started by the producer whose result isn't pushed yet."""
+        return max(0, self.started.value - self.head.value)
+
+    def try_push(self, result):
+        """Append a result, return False without waiting if the buffer is full."""
+        head = self.head.value
+        if head - self.tail.value >= self.capacity:
+            return False
+        pack_result(self.buffer, (head % self.capacity) * record_struct.size, result)
+        # Publish the record only once it is completely written
+        self.head.value = head + 1
+        return True
+
+    def push(self, result):
+        """Append a result, waits for the consumer while the buffer is full."""
+        while not self.try_push(result):
+            time.sleep(0.01)
+
+    def close(self):
+        """Mark that the producer will not push any more results."""
+        self.closed.value = 1
+
+    def is_closed(self):
+        """Return True once the producer closed the buffer."""
+        return bool(self.closed.value)
+
+    def drain(self):
+        """Return all results pushed since the last drain."""
+        head = self.head.value
+        tail = self.tail.value
+        results = [
+            unpack_result(self.buffer, (idx % self.capacity) * record_struct.size)
+            for idx in range(tail, head)
+        ]
+        self.tail.value = head
+        return results
+
+
+class ResultsAggregator:
+    """Continuously drain the ring buffers of all user processes in a background thread."""
+
+    def __init__(self, results_buffers, interval=0.1, listeners=None):
+        """Init method."""
+        self.results_buffers = results_buffers
+        self.interval = interval
+        # Callables passed each batch of new results, e.g. LiveMetrics.add_results
+        self.listeners = listeners or []
+        self.results_list = []
+        self.lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="results-aggregator", daemon=True)
+
+    def start(self):
+        """Start draining in the background."""
+        self._thread.start()
+
+    def drain(self):
+        """Drain every buffer once, return the new results."""
+        new_results = []
+        for results_buffer in self.results_buffers:
+            new_results.extend(results_buffer.drain())
+        if new_results:
+            with self.lock:
+                self.results_list.extend(new_results)
+            for listener in self.listeners:
+                listener(new_results)
+        return new_results
+
+    def snapshot(self):
+        """Return a copy of the results received so far."""
+        with self.lock:
+            return list(self.results_list)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.drain()
+
+    def stop(self, procs, timeout=None):
+        """Wait until every producer closed its buffer (or its process died), drain and return all results."""
+        start_time = time.time()
+        pending = list(zip(self.results_buffers, procs))
+        while pending:
+            still_pending = []
+            for results_buffer, proc in pending:
+                if results_buffer.is_closed():
+                    continue
+                if not proc.is_alive():
+                    logging.error("%s exited without closing its results buffer, its results so far are kept", proc)
+                    continue
+                still_pending.append((results_buffer, proc))
+            pending = still_pending
+            if timeout is not None and time.time() - start_time > timeout:
+                logging.error("Timed out waiting for %d user processes to finish", len(pending))
+                break
+            time.sleep(self.interval)
+
+        self._stop_event.set()
+        self._thread.join()
+        self.drain()
+        with self.lock:
+            return list(self.results_list)
@@ -0,0 +1,235 @@
+"""Columnar (Parquet, Arrow IPC) and compressed JSON lines output of the per request results."""
+
+import gzip
+import json
+
+import numpy as np
+
+from result import ResultColumns, missing_int
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Supported output.format values, with their file suffix.
+output_formats = {
+    "json": ".json",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+    "jsonl.gz": ".jsonl.gz",
+}
+
+# Columns of the results, RequestResult fields in order with their type. token_times
+# is always None once calculate_results() has run and is left out.
+result_columns = [
+    ("user_id", "int64"),
+    # Dataset ids, or the prompt text with some plugins
+    ("input_id", "string"),
+    ("input_tokens", "int64"),
+    ("turn", "int64"),
+    ("output_text", "string"),
+    ("output_tokens", "int64"),
+    ("output_tokens_before_timeout", "int64"),
+    ("scheduled_start_time", "float64"),
+    ("start_time", "float64"),
+    ("ack_time", "float64"),
+    ("first_token_time", "float64"),
+    ("end_time", "float64"),
+    ("connect_time", "float64"),
+    ("response_time", "float64"),
+    ("tt_ack", "float64"),
+    ("ttft", "float64"),
+    ("itl", "float64"),
+    ("itl_deltas", "list<float32>"),
+    ("max_itl", "float64"),
+    ("itl_jitter", "float64"),
+    ("tpot", "float64"),
+    ("schedule_delay", "float64"),
+    ("dispatch_delay", "float64"),
+    ("corrected_response_time", "float64"),
+    ("corrected_ttft", "float64"),
+    ("stop_reason", "string"),
+    ("error_code", "int64"),
+    ("error_text", "string"),
+]
+
+
+def check_output_format(output_format):
+    """Raise ValueError if output_format is unknown or needs pyarrow when it isn't installed."""
+    if output_format not in output_formats:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {list(output_formats)}")
+    if output_format in ("parquet", "arrow") and pa is None:
+        raise ValueError(f"output.format {output_format} requires pyarrow")
+
+
+def output_suffix(filename, output_format):
+    """Return filename with the suffix of output_format, replacing a .json suffix."""
+    suffix = output_formats[output_format]
+    if filename.endswith(suffix):
+        return filename
+    if filename.endswith(".json"):
+        filename = filename[:-len(".json")]
+    return filename + suffix
+
+
+def result_schema(metadata=None):
+    """Return the pyarrow schema of the results, with metadata as schema metadata."""
+    types = {
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "string": pa.string(),
+        "list<float32>": pa.list_(pa.float32()),
+    }
+    return pa.schema([(name, types[column_type]) for name, column_type in result_columns], metadata=metadata)
+
+
+def _column_value(value, column_type):
+    if value is None:
+        return None
+    if column_type == "string":
+        return value if isinstance(value, str) else str(value)
+    if column_type == "list<float32>":
+        return value.tolist()
+    return value
+
+
+def _columns_table(results, schema):
+    """Return a pyarrow Table of a ResultColumns, built from its buffers without a row by row pass."""
+    columns = []
+    for name, column_type in result_columns:
+        field_type = schema.field(name).type
+        if name in ResultColumns.int_fields:
+            values = results.numpy(name)
+            columns.append(pa.array(values, type=field_type, mask=values == missing_int))
+        elif name in ResultColumns.float_fields:
+            # NaN stands for None
+            columns.append(pa.array(results.numpy(name), type=field_type, from_pandas=True))
+        elif name == "itl_deltas":
+            lengths = results.numpy("itl_lengths")
+            offsets = np.concatenate(([0], np.cumsum(np.maximum(lengths, 0)))).astype(np.int32)
+            values = np.frombuffer(results.itl_deltas, dtype=np.float32) if len(results.itl_deltas) else []
+            columns.append(pa.ListArray.from_arrays(
+                pa.array(offsets), pa.array(values, type=pa.float32()), mask=pa.array(lengths < 0)
+            ))
+        else:
+            values = results.columns[name]
+            try:
+                columns.append(pa.array(values, type=field_type))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Errors recorded as something else than a string or int, e.g. a dict from the server
+                if column_type == "int64":
+                    values = [value if isinstance(value, int) else None for value in values]
+                else:
+                    values = [_column_value(value, column_type) for value in values]
+                columns.append(pa.array(values, type=field_type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def metadata_sidecar(path):
+    """Return the path of the JSON file holding the metadata of the Arrow IPC file at path."""
+    return f"{path}.metadata.json"
+
+
+class ResultWriter:
+    """Write RequestResults to a file row group by row group, as they arrive.
+
+    metadata maps keys (config, summary, ...) to JSON encoded strings. The
+    metadata given when opening the file goes in the schema metadata of
+    Parquet and Arrow files, and in the first line of JSON lines files,
+    which then have one result per line. The metadata given to close(),
+    only known once every result is in, e.g. the summary, is added to the
+    Parquet footer and as the last line of JSON lines files. The schema of
+    an Arrow IPC file can't change once written, all its metadata goes in
+    a metadata_sidecar() JSON file instead.
+    """
+
+    def __init__(self, path, output_format, metadata, row_group_size=65536):
+        """Init method."""
+        check_output_format(output_format)
+        self.path = path
+        self.output_format = output_format
+        self.metadata = dict(metadata)
+        self.row_group_size = row_group_size
+        # Results appended since the last full row group
+        self._pending = []
+        self._closed = False
+        if output_format == "parquet":
+            self.schema = result_schema(metadata)
+            self._writer = pq.ParquetWriter(str(path), self.schema, compression="zstd")
+        elif output_format == "arrow":
+            self.schema = result_schema(metadata)
+            self._sink = pa.OSFile(str(path), "wb")
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+        else:
+            self._writer = gzip.open(path, "wt", encoding="utf-8")
+            self._writer.write(_metadata_line(metadata))
+
+    def append(self, results):
+        """Add results arriving in small batches, they are written a full row group at a time."""
+        self._pending.extend(results)
+        full = len(self._pending) - len(self._pending) % self.row_group_size
+        if full:
+            self.write(self._pending[:full])
+            del self._pending[:full]
+
+    def write(self, results):
+        """Write results, in row groups of at most row_group_size rows."""
+        if isinstance(results, ResultColumns) and self.output_format != "jsonl.gz":
+            table = _columns_table(results, self.schema)
+            for batch in table.to_batches(max_chunksize=self.row_group_size):
+                # One row group per batch in Parquet files
+                self._writer.write_batch(batch)
+            return
+        for idx in range(0, len(results), self.row_group_size):
+            chunk = results[idx:idx + self.row_group_size]
+            columns = {
+                name: [_column_value(getattr(result, name), column_type) for result in chunk]
+                for name, column_type in result_columns
+            }
+            if self.output_format == "jsonl.gz":
+                # JSON keeps integer and string ids as they are
+                columns["input_id"] = [result.input_id for result in chunk]
+                self._writer.writelines(
+                    json.dumps(dict(zip(columns, row)), default=str) + "\n" for row in zip(*columns.values())
+                )
+            elif self.output_format == "parquet":
+                self._writer.write_table(pa.table(columns, schema=self.schema))
+            else:
+                self._writer.write_batch(pa.record_batch(columns, schema=self.schema))
+
+    def close(self, metadata=None):
+        """Write the appended results left and the metadata, finish the file. Closing twice does nothing."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._pending:
+            self.write(self._pending)
+            self._pending = []
+        if self.output_format == "parquet":
+            if metadata:
+                self._writer.add_key_value_metadata(metadata)
+            self._writer.close()
+        elif self.output_format == "arrow":
+            self._writer.close()
+            self._sink.close()
+            with open(metadata_sidecar(self.path), "w", encoding="utf-8") as file:
+                file.write(_metadata_line(dict(self.metadata, **(metadata or {}))))
+        else:
+            if metadata:
+                self._writer.write(_metadata_line(metadata))
+            self._writer.close()
+
+    def __enter__(self):
+        """Enter the context, return the writer."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the file when leaving the context."""
+        self.close()
+
+
+def _metadata_line(metadata):
+    # The values are already JSON encoded
+    return "{" + ", ".join(f"{json.dumps(key)}: {value}" for key, value in metadata.items()) + "}\n"
@@ -0,0 +1,51 @@
+"""Request arrival schedules for open-loop load generation."""
+
+import logging
+import random
+import time
+
+schedule_seed = 1337
+
+# Remaining time below which sleep_until busy-waits instead of calling time.sleep,
+# time.sleep can overshoot by around a millisecond on a loaded machine.
+spin_threshold = 0.002
+
+
+class ArrivalSchedule:
+    """Generate inter-arrival times for a target request rate."""
+
+    def __init__(self, rate, arrival="poisson", seed=schedule_seed):
+        """Init method."""
+        if rate is None or rate <= 0:
+            raise ValueError(f"load_options.rate must be a positive number of requests per second, got {rate}")
+        if arrival not in ("poisson", "constant"):
+            raise ValueError(f"Unknown load_options.arrival {arrival}, expected poisson or constant")
+        self.rate = rate
+        self.arrival = arrival
+        self.rng = random.Random(seed)
+
+    def next_interval(self):
+        """Return the time in seconds until the next request should be sent."""
+        if self.arrival == "poisson":
+            return self.rng.expovariate(self.rate)
+        return 1.0 / self.rate
+
+    def send_times(self, start_time, duration):
+        """Yield the absolute send times of all requests in [start_time, start_time + duration)."""
+        send_time = start_time
+        while send_time < start_time + duration:
+            yield send_time
+            send_time += self.next_interval()
+
+
+def sleep_until(target_time):
+    """Sleep until time.time() reaches target_time, return how late we woke up in seconds."""
+    remaining = target_time - time.time()
+    if remaining > spin_threshold:
+        time.sleep(remaining - spin_threshold)
+    while time.time() < target_time:
+        pass
+    lateness = time.time() - target_time
+    if lateness > 0.1:
+        logging.debug("Scheduler woke up %.3f s late", lateness)
+    return lateness
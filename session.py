@@ -0,0 +1,86 @@
+"""Multi-turn chat sessions sharing common system prompt prefixes."""
+import numpy as np
+
+from synthetic_dataset import prompt_words
+
+
+def get_prefix(group, prefix_tokens, seed):
+    """Return the shared system prompt of prefix group group, about prefix_tokens tokens of common words."""
+    rng = np.random.default_rng([seed, group])
+    return " ".join(prompt_words[idx] for idx in rng.integers(len(prompt_words), size=prefix_tokens))
+
+
+def make_sessions(queries, turns=4, prefix_groups=1, prefix_tokens=0, seed=0):
+    """Group queries into conversations of turns user messages each.
+
+    Conversation i gets the system prompt of prefix group i %
+    prefix_groups, so conversations of the same group share a common
+    prefix. Returns a list of sessions, dicts with the turns (the
+    original queries) in place of text, to be played by a Session.
+    """
+    if turns < 1 or prefix_groups < 1:
+        raise ValueError("dataset.sessions turns and prefix_groups must be at least 1")
+    queries = list(queries)
+    prefixes = [get_prefix(group, prefix_tokens, seed) if prefix_tokens else None for group in range(prefix_groups)]
+    sessions = []
+    for session_id, start in enumerate(range(0, len(queries), turns)):
+        sessions.append({
+            "session_id": session_id,
+            "input_id": queries[start].get("input_id"),
+            "prefix_group": session_id % prefix_groups,
+            "prefix_tokens": prefix_tokens,
+            "system_prompt": prefixes[session_id % prefix_groups],
+            "turns": queries[start:start + turns],
+        })
+    return sessions
+
+
+class Session:
+    """A conversation being played by a user, one turn per request.
+
+    Every turn resends the whole history: the shared system prompt, the
+    previous user messages and the answers received to them. Chat plugins
+    send it as messages, other plugins as text, the messages joined.
+    """
+
+    def __init__(self, session):
+        """Init method."""
+        self.session = session
+        self.turn = 0
+        self.messages = []
+        self.history_tokens = session["prefix_tokens"]
+        if session["system_prompt"] is not None:
+            self.messages.append({"role": "system", "content": session["system_prompt"]})
+
+    def done(self):
+        """Return True once every turn was sent."""
+        return self.turn >= len(self.session["turns"])
+
+    def next_query(self):
+        """Return the query of the next turn."""
+        query = self.session["turns"][self.turn]
+        if self.turn == 0 and "scheduled_start_time" in self.session:
+            # Open-loop schedules time the conversation from its first turn
+            query = dict(
+                query,
+                scheduled_start_time=self.session["scheduled_start_time"],
+                dispatch_delay=self.session.get("dispatch_delay"),
+            )
+        messages = self.messages + [{"role": "user", "content": query["text"]}]
+        return dict(
+            query,
+            text="\n\n".join(message["content"] for message in messages),
+            messages=messages,
+            # Estimated from the dataset, plugins replace it by the count reported by the server if any
+            input_tokens=self.history_tokens + query["input_tokens"],
+            turn=self.turn,
+        )
+
+    def add_response(self, query, result):
+        """Add the answer to the last turn to the history, a failed turn ends the conversation."""
+        self.turn += 1
+        if result.error_text is not None or result.error_code is not None:
+            self.turn = len(self.session["turns"])
+            return
+        self.messages = query["messages"] + [{"role": "assistant", "content": result.output_text or ""}]
+        self.history_tokens = (result.input_tokens or query["input_tokens"]) + (result.output_tokens or 0)
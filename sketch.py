@@ -0,0 +1,285 @@
+"""Mergeable quantile sketches, to summarize long tests in bounded memory."""
+
+import math
+
+import numpy as np
+
+# Values at or below this are counted as zero, a log scale can't hold them.
+min_value = 1e-6
+
+# Percentiles reported for each metric, like utils.get_summary.
+summary_percentiles = [80, 90, 95, 99]
+
+
+class QuantileSketch:
+    """Log-bucketed histogram with a relative error bound on its quantiles.
+
+    A value x > 0 lands in bucket ceil(log_gamma(x)) with gamma =
+    (1 + relative_accuracy) / (1 - relative_accuracy), and a quantile is
+    reported as the midpoint of its bucket, within relative_accuracy of the
+    exact value of that rank (the same guarantee as DDSketch). Memory grows
+    with the log of the range of the values, not their count: at 1% accuracy
+    1 microsecond to 1 hour takes under 1100 buckets. Count, sum, min, max
+    and the standard deviation are exact. Sketches with the same accuracy merge by adding their buckets.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        """Init method."""
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"relative_accuracy must be between 0 and 1, got {relative_accuracy}")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """Add a single value, None is ignored."""
+        if value is None or math.isnan(value):
+            return
+        self.count += 1
+        self.sum += value
+        self.sum_squares += value * value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value <= min_value:
+            self.zero_count += 1
+        else:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def add_array(self, values):
+        """Add a numpy array of values at once, NaNs are ignored."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.sum_squares += float(np.dot(values, values))
+        self.min = float(values.min()) if self.min is None else min(self.min, float(values.min()))
+        self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+        positive = values[values > min_value]
+        self.zero_count += len(values) - len(positive)
+        keys, counts = np.unique(np.ceil(np.log(positive) / self._log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def merge(self, other):
+        """Add the values of another sketch with the same relative_accuracy."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with a different relative_accuracy")
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.zero_count += other.zero_count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def quantile(self, q):
+        """Return the value of quantile q (0 to 1), None if the sketch is empty."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0)
+        cumulative = self.zero_count
+        for key in sorted(self.buckets):
+            cumulative += self.buckets[key]
+            if cumulative > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def std(self):
+        """Return the exact population standard deviation, None if the sketch is empty."""
+        if not self.count:
+            return None
+        mean = self.sum / self.count
+        return math.sqrt(max(0.0, self.sum_squares / self.count - mean * mean))
+
+    def summary(self):
+        """Return min, max, median, mean and percentiles, with the keys of utils.get_summary."""
+        if not self.count:
+            summary = dict.fromkeys(["min", "max", "median", "mean"])
+            summary.update({f"percentile_{pct}": None for pct in summary_percentiles})
+            return summary
+        summary = {
+            "min": self.min,
+            "max": self.max,
+            "median": self.quantile(0.5),
+            "mean": self.sum / self.count,
+        }
+        for pct in summary_percentiles:
+            summary[f"percentile_{pct}"] = self.quantile(pct / 100)
+        return summary
+
+    def to_dict(self):
+        """Return the sketch as a JSON serializable dict."""
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": [[key, count] for key, count in self.buckets.items()],
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "sum_squares": self.sum_squares,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        """Rebuild a sketch from to_dict()."""
+        sketch = cls(values["relative_accuracy"])
+        sketch.buckets = {key: count for key, count in values["buckets"]}
+        for name in ("zero_count", "count", "sum", "sum_squares", "min", "max"):
+            setattr(sketch, name, values[name])
+        return sketch
+
+
+class ResultsSketch:
+    """Everything write_output summarizes, accumulated result by result instead of kept per request.
+
+    Latency metrics are sketched like the summary of write_output: ttft,
+    itl, tt_ack and tpot over the error free requests completed within the
+    test duration, the others over all error free requests.
+    """
+
+    # Metrics only counted for requests completed within the test duration
+    duration_metrics = ["tpot", "ttft", "itl", "tt_ack", "corrected_ttft"]
+    request_metrics = [
+        "response_time",
+        "schedule_delay",
+        "dispatch_delay",
+        "corrected_response_time",
+        "connect_time",
+        "max_itl",
+        "itl_jitter",
+        "output_tokens",
+        "output_tokens_before_timeout",
+        "input_tokens",
+    ]
+
+    def __init__(self, relative_accuracy=0.01):
+        """Init method."""
+        self.relative_accuracy = relative_accuracy
+        self.sketches = {
+            metric: QuantileSketch(relative_accuracy)
+            for metric in self.duration_metrics + self.request_metrics + ["token_itl", "ttft_cold", "ttft_warm"]
+        }
+        self.total_requests = 0
+        self.total_failures = 0
+        self.req_completed_within_test_duration = 0
+        self.new_connections = 0
+        self.output_tokens = 0
+        self.output_tokens_before_timeout = 0
+        self.start_time = None
+        self.end_time = None
+
+    def add(self, result):
+        """Add a finished RequestResult."""
+        self.total_requests += 1
+        if result.start_time is not None:
+            self.start_time = result.start_time if self.start_time is None else min(self.start_time, result.start_time)
+        if result.end_time is not None:
+            self.end_time = result.end_time if self.end_time is None else max(self.end_time, result.end_time)
+        if result.error_text is not None:
+            # Ignore errors for summary results
+            self.total_failures += 1
+            return
+
+        self.output_tokens += result.output_tokens or 0
+        self.output_tokens_before_timeout += result.output_tokens_before_timeout or 0
+        if result.connect_time is not None:
+            self.new_connections += 1
+        for metric in self.request_metrics:
+            self.sketches[metric].add(getattr(result, metric))
+        if result.output_tokens == result.output_tokens_before_timeout:
+            self.req_completed_within_test_duration += 1
+            for metric in self.duration_metrics:
+                self.sketches[metric].add(getattr(result, metric))
+            if result.turn is not None:
+                self.sketches["ttft_cold" if result.turn == 0 else "ttft_warm"].add(result.ttft)
+        if result.itl_deltas:
+            self.sketches["token_itl"].add_array(np.frombuffer(result.itl_deltas, dtype=np.float32))
+
+    def merge(self, other):
+        """Add everything accumulated by another ResultsSketch."""
+        for metric, sketch in self.sketches.items():
+            sketch.merge(other.sketches[metric])
+        for name in (
+            "total_requests",
+            "total_failures",
+            "req_completed_within_test_duration",
+            "new_connections",
+            "output_tokens",
+            "output_tokens_before_timeout",
+        ):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        if other.start_time is not None:
+            self.start_time = other.start_time if self.start_time is None else min(self.start_time, other.start_time)
+        if other.end_time is not None:
+            self.end_time = other.end_time if self.end_time is None else max(self.end_time, other.end_time)
+
+    def summary(self, duration):
+        """Return the summary block of write_output, with duration the target test duration in seconds."""
+        summary = {}
+        for metric in ["tpot", "ttft", "itl", "tt_ack", "response_time"]:
+            summary[metric] = self.sketches[metric].summary()
+        for metric in ["ttft_cold", "ttft_warm"]:
+            if self.sketches[metric].count:
+                summary[metric] = self.sketches[metric].summary()
+        for metric in ["schedule_delay", "dispatch_delay", "corrected_response_time", "corrected_ttft", "connect_time"]:
+            if self.sketches[metric].count:
+                summary[metric] = self.sketches[metric].summary()
+        if self.sketches["connect_time"].count:
+            summary["new_connections"] = self.new_connections
+        if self.sketches["token_itl"].count:
+            sketch = self.sketches["token_itl"]
+            summary["token_itl"] = dict(sketch.summary(), std=sketch.std(), count=sketch.count)
+            summary["token_itl"]["percentile_99.9"] = sketch.quantile(0.999)
+        for metric in ["max_itl", "itl_jitter"]:
+            if self.sketches[metric].count:
+                summary[metric] = self.sketches[metric].summary()
+        for metric in ["output_tokens", "output_tokens_before_timeout", "input_tokens"]:
+            summary[metric] = self.sketches[metric].summary()
+
+        full_duration = None
+        if self.start_time is not None and self.end_time is not None:
+            full_duration = self.end_time - self.start_time
+        summary["throughput_full_duration"] = self.output_tokens / full_duration if full_duration else None
+        summary["full_duration"] = full_duration
+        summary["throughput"] = self.output_tokens_before_timeout / duration
+        summary["total_requests"] = self.total_requests
+        summary["req_completed_within_test_duration"] = self.req_completed_within_test_duration
+        summary["total_failures"] = self.total_failures
+        summary["failure_rate"] = self.total_failures / self.total_requests * 100 if self.total_requests else None
+        summary["relative_accuracy"] = self.relative_accuracy
+        return summary
+
+    def to_dict(self):
+        """Return the sketch as a JSON serializable dict."""
+        values = {name: value for name, value in vars(self).items() if name != "sketches"}
+        values["sketches"] = {metric: sketch.to_dict() for metric, sketch in self.sketches.items()}
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        """Rebuild a ResultsSketch from to_dict()."""
+        results_sketch = cls(values["relative_accuracy"])
+        for name, value in values.items():
+            if name != "sketches":
+                setattr(results_sketch, name, value)
+        results_sketch.sketches = {
+            metric: QuantileSketch.from_dict(sketch) for metric, sketch in values["sketches"].items()
+        }
+        return results_sketch
@@ -0,0 +1,123 @@
+"""Search for the highest load that still meets latency SLOs."""
+
+import logging
+import math
+
+# RequestResult fields an SLO can be set on, all in milliseconds.
+slo_metrics = ["ttft", "itl", "tpot", "response_time"]
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of values, None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(values)))
+    return values[rank - 1]
+
+
+class SLO:
+    """Latency thresholds on a percentile of the request metrics."""
+
+    def __init__(self, thresholds, pct=99):
+        """Init method."""
+        if not thresholds:
+            raise ValueError(f"load_options.slo must set a threshold on at least one of {slo_metrics}")
+        for metric in thresholds:
+            if metric not in slo_metrics:
+                raise ValueError(f"Unknown load_options.slo metric {metric}, expected one of {slo_metrics}")
+        self.thresholds = thresholds
+        self.pct = pct
+
+    def request_ok(self, result):
+        """Return True if a single request is error free and meets every threshold."""
+        if result.error_text is not None or result.error_code is not None:
+            return False
+        for metric, threshold in self.thresholds.items():
+            value = getattr(result, metric)
+            # itl is not defined for single token responses, ttft for non-streaming ones
+            if value is not None and value > threshold:
+                return False
+        return True
+
+    def evaluate(self, results, duration):
+        """Summarize the results of one probe window and check them against the SLO.
+
+        Failed requests count as infinitely slow, so an error rate above
+        100 - pct percent fails the SLO. goodput only counts the output
+        tokens of requests which individually meet every threshold.
+        """
+        evaluation = {
+            "requests": len(results),
+            "errors": sum(1 for result in results if result.error_text is not None or result.error_code is not None),
+            "goodput": sum(result.output_tokens or 0 for result in results if self.request_ok(result)) / duration,
+        }
+        slo_met = bool(results)
+        for metric, threshold in self.thresholds.items():
+            values = []
+            for result in results:
+                if result.error_text is not None or result.error_code is not None:
+                    values.append(math.inf)
+                elif getattr(result, metric) is not None:
+                    values.append(getattr(result, metric))
+            value = percentile(values, self.pct)
+            evaluation[f"{metric}_percentile_{self.pct}"] = value
+            if value is None or value > threshold:
+                slo_met = False
+        evaluation["slo_met"] = slo_met
+        return evaluation
+
+
+class LoadSearch:
+    """Pick the next load level to probe: double until the SLO fails, then bisect.
+
+    Loads are concurrency levels (integer) or request rates. The search
+    ends once the highest passing and lowest failing loads are within
+    tolerance of each other, the highest load passed, or the lowest load
+    failed.
+    """
+
+    def __init__(self, low, high, tolerance=1, integer=True):
+        """Init method."""
+        if low <= 0 or high < low:
+            raise ValueError(f"Invalid search range [{low}, {high}]")
+        self.low = low
+        self.high = high
+        self.tolerance = tolerance
+        self.integer = integer
+        # Highest load that met the SLO, lowest load that did not
+        self.best = None
+        self.failed = None
+        self._next = low
+
+    def next_load(self):
+        """Return the next load to probe, None once the search is done."""
+        return self._next
+
+    def record(self, load, slo_met):
+        """Record the outcome of probing load and choose the next one."""
+        if slo_met:
+            self.best = load
+        else:
+            self.failed = load
+
+        if self.failed is None:
+            # Still doubling
+            self._next = None if load >= self.high else min(self.high, 2 * load)
+        elif self.best is None:
+            # Only possible when the first probe, at the lowest load, failed
+            logging.warning("The lowest load %s already misses the SLO", self.low)
+            self._next = None
+        elif self.failed - self.best <= self.tolerance:
+            self._next = None
+        else:
+            self._next = self._midpoint(self.best, self.failed)
+
+        if self._next is not None and self._next in (self.best, self.failed):
+            # Nothing left between the bounds at integer resolution
+            self._next = None
+
+    def _midpoint(self, low, high):
+        if self.integer:
+            return (low + high) // 2
+        return (low + high) / 2
@@ -0,0 +1,189 @@
+"""Synthetic prompts of exact token lengths, to benchmark prefill and decode scaling in isolation."""
+import hashlib
+import json
+import logging
+import os
+
+from dataset import Dataset, dataset_seed, default_cache_dir
+
+import numpy as np
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+# Common English words, a single token each (with a leading space) in the usual BPE and SentencePiece vocabularies.
+prompt_words = (
+    "the of and to in is was for that on with as by at from his her he she it they we you this which are be or "
+    "an had not but have were their one all been has more also when there who will would can new other first "
+    "after time people year some out up about into over only most such than them these may then two made many "
+    "where its world city water light house music river game story night black white small large great old long "
+    "part place life work day state school family group number system power field line name home point order "
+    "form film book team war end high open road land sea sun"
+).split()
+
+# Bumped whenever the prompts generated for the same settings change.
+synthetic_version = 1
+
+# Token length distributions, and their parameters besides distribution.
+length_distributions = {
+    "fixed": ["value"],
+    "uniform": ["min", "max"],
+    "lognormal": ["median", "sigma"],
+}
+
+
+def get_length_distribution(spec, name):
+    """Return a token length distribution as a dict, spec is a number for a fixed length or a dict.
+
+    Raises ValueError if spec isn't a valid distribution, name is the
+    option it comes from.
+    """
+    if isinstance(spec, int):
+        spec = {"distribution": "fixed", "value": spec}
+    if not isinstance(spec, dict):
+        raise ValueError(f"dataset.synthetic.{name} must be a number of tokens or a distribution")
+    distribution = spec.get("distribution", "fixed")
+    if distribution not in length_distributions:
+        raise ValueError(f"Unknown dataset.synthetic.{name} distribution {distribution}, "
+                         f"expected one of {list(length_distributions)}")
+    for param in length_distributions[distribution]:
+        if spec.get(param) is None:
+            raise ValueError(f"dataset.synthetic.{name} {distribution} distribution requires {param}")
+    spec = dict(spec, distribution=distribution)
+    if spec.get("min", 1) < 1 or spec.get("value", 1) < 1:
+        raise ValueError(f"dataset.synthetic.{name} lengths must be at least 1 token")
+    return spec
+
+
+def sample_lengths(spec, count, rng):
+    """Return count token lengths drawn from the distribution spec, clipped to its optional min and max."""
+    if spec["distribution"] == "fixed":
+        lengths = np.full(count, spec["value"], dtype=np.int64)
+    elif spec["distribution"] == "uniform":
+        lengths = rng.integers(spec["min"], spec["max"], size=count, endpoint=True)
+    else:
+        lengths = np.rint(spec["median"] * rng.lognormal(0, spec["sigma"], size=count)).astype(np.int64)
+    return np.clip(lengths, spec.get("min", 1), spec.get("max", None))
+
+
+class SyntheticDataset(Dataset):
+    """Dataset of generated prompts of exactly input_tokens tokens, asking for output_tokens tokens.
+
+    input_tokens and output_tokens are a number of tokens or a
+    distribution (fixed, uniform or lognormal) sampled once for the
+    max_queries queries. Prompts are random sequences of common words,
+    so that no two prompts share a prefix. With a Hugging Face tokenizer
+    each prompt is checked and trimmed or extended to the exact token
+    count; without one a prompt has round(input_tokens /
+    tokens_per_word) words, tokens_per_word being calibrated for the
+    model. Generated prompts are kept per length, and on disk in
+    cache_dir when using a tokenizer, so later runs don't need it.
+    """
+
+    def __init__(self,
+                 synthetic,
+                 model_name="",
+                 max_queries=3000,
+                 cache_dir=default_cache_dir,
+                 **ignored
+                 ):
+        """Init method."""
+        logging.info("Initializing synthetic dataset with %s", locals())
+        if ignored:
+            logging.warning("Ignoring dataset options %s of a synthetic dataset", list(ignored))
+        input_spec = get_length_distribution(synthetic.get("input_tokens"), "input_tokens")
+        output_spec = get_length_distribution(synthetic.get("output_tokens"), "output_tokens")
+        self.seed = synthetic.get("seed", dataset_seed)
+        self.tokenizer_name = synthetic.get("tokenizer")
+        self.tokens_per_word = synthetic.get("tokens_per_word", 1.0)
+        if self.tokenizer_name and AutoTokenizer is None:
+            raise ValueError("dataset.synthetic.tokenizer requires the transformers package")
+        self._tokenizer = None
+        self._words = prompt_words
+        self._prompts = {}
+        self._cache_path = None
+        self._cache_changed = False
+        if self.tokenizer_name and cache_dir:
+            key = hashlib.sha256(json.dumps([synthetic_version, self.tokenizer_name, self.seed]).encode()).hexdigest()
+            self._cache_path = os.path.join(os.path.expanduser(cache_dir), f"synthetic-{key}.json")
+            self._load_cache()
+
+        rng = np.random.default_rng(self.seed)
+        input_lengths = sample_lengths(input_spec, max_queries, rng).tolist()
+        output_lengths = sample_lengths(output_spec, max_queries, rng).tolist()
+        counts = {}
+        self.dataset_list = []
+        for input_id, (input_tokens, output_tokens) in enumerate(zip(input_lengths, output_lengths)):
+            # The k-th prompt of each length is the same whatever the distribution it was drawn from
+            prompt_index = counts.get(input_tokens, 0)
+            counts[input_tokens] = prompt_index + 1
+            self.dataset_list.append({
+                "text": self.get_prompt(input_tokens, prompt_index),
+                "input_id": input_id,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+            })
+        self._save_cache()
+        self.index = 0
+
+    def get_prompt(self, input_tokens, prompt_index=0):
+        """Return prompt prompt_index of input_tokens tokens, generating it if it isn't cached."""
+        prompts = self._prompts.setdefault(input_tokens, [])
+        while len(prompts) <= prompt_index:
+            prompts.append(self._generate(input_tokens, len(prompts)))
+            self._cache_changed = self._cache_path is not None
+        return prompts[prompt_index]
+
+    def _generate(self, input_tokens, prompt_index):
+        rng = np.random.default_rng([self.seed, input_tokens, prompt_index])
+        if not self.tokenizer_name:
+            word_count = max(1, round(input_tokens / self.tokens_per_word))
+            return " ".join(self._words[idx] for idx in rng.integers(len(self._words), size=word_count))
+
+        tokenizer = self._get_tokenizer()
+        words = [self._words[idx] for idx in rng.integers(len(self._words), size=input_tokens)]
+        for _ in range(10):
+            text = " ".join(words)
+            token_count = len(tokenizer.encode(text, add_special_tokens=False))
+            if token_count == input_tokens:
+                return text
+            if token_count > input_tokens:
+                words = words[:max(1, len(words) - (token_count - input_tokens))]
+            else:
+                words += [self._words[idx] for idx in rng.integers(len(self._words), size=input_tokens - token_count)]
+        logging.warning("Synthetic prompt has %d tokens instead of %d", token_count, input_tokens)
+        return text
+
+    def _get_tokenizer(self):
+        if self._tokenizer is None:
+            logging.info("Loading tokenizer %s for synthetic prompts", self.tokenizer_name)
+            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+            # Only keep the words which are a single token in this vocabulary
+            words = [word for word in prompt_words if len(self._tokenizer.encode(" " + word, add_special_tokens=False)) == 1]
+            self._words = words or prompt_words
+        return self._tokenizer
+
+    def _load_cache(self):
+        if not os.path.exists(self._cache_path):
+            return
+        try:
+            with open(self._cache_path, "r", encoding="utf-8") as file:
+                self._prompts = {int(length): prompts for length, prompts in json.load(file).items()}
+            logging.info("Using the cached synthetic prompts %s", self._cache_path)
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable synthetic prompts %s: %s", self._cache_path, e)
+
+    def _save_cache(self):
+        if not self._cache_changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            tmp_path = f"{self._cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(self._prompts, file)
+            os.replace(tmp_path, self._cache_path)
+            self._cache_changed = False
+        except OSError as e:
+            logging.warning("Could not cache the synthetic prompts in %s: %s", self._cache_path, e)
@@ -0,0 +1,19 @@
+"""Split of the load between the agents of a distributed test."""
+from distributed import split_load_options
+
+import pytest
+
+
+def test_split_keeps_the_total_concurrency():
+    """Agent shares add up to every requested concurrency level and rate."""
+    load_options = {"type": "stair-step", "concurrency": [4, 6, 9], "rate": [2.0, 4.0, 8.0]}
+    shares = [split_load_options(load_options, 4, idx) for idx in range(4)]
+    assert [sum(levels) for levels in zip(*(share["concurrency"] for share in shares))] == [4, 6, 9]
+    assert [sum(rates) for rates in zip(*(share["rate"] for share in shares))] == [2.0, 4.0, 8.0]
+
+
+@pytest.mark.parametrize("concurrency", [1, [1, 2, 4]])
+def test_split_rejects_concurrency_below_agent_count(concurrency):
+    """A concurrency level smaller than the number of agents is an error, not extra users."""
+    with pytest.raises(ValueError):
+        split_load_options({"concurrency": concurrency}, 4 if isinstance(concurrency, list) else 2, 0)
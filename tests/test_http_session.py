@@ -0,0 +1,11 @@
+"""HTTP sessions of the asyncio user engine."""
+from plugins import http_session
+
+import pytest
+
+
+def test_aio_session_without_aiohttp(monkeypatch):
+    """A missing aiohttp is reported clearly rather than as an AttributeError."""
+    monkeypatch.setattr(http_session, "aiohttp", None)
+    with pytest.raises(RuntimeError, match="aiohttp is required"):
+        http_session.new_aio_session()
@@ -0,0 +1,44 @@
+"""Streamed openai_plugin responses are decoded whichever urllib3 is installed."""
+import gzip
+import io
+
+from plugins.openai_plugin import iter_stream_chunks
+
+import requests
+
+import urllib3
+
+
+body = b'data: {"choices": [{"text": "hi"}]}\n\ndata: [DONE]\n\n'
+
+
+def make_response(raw):
+    """Wrap a raw urllib3 response like requests does with stream=True."""
+    response = requests.Response()
+    response.raw = raw
+    return response
+
+
+def test_gzip_stream_is_decoded():
+    """Compressed events come out decoded from read1."""
+    raw = urllib3.HTTPResponse(io.BytesIO(gzip.compress(body)), headers={"Content-Encoding": "gzip"},
+                               preload_content=False, decode_content=False)
+    assert b"".join(iter_stream_chunks(make_response(raw))) == body
+
+
+class OldRaw:
+    """A urllib3 1.x response, which has no read1."""
+
+    def __init__(self, data):
+        """Init method."""
+        self.data = data
+
+    def stream(self, amt, decode_content=None):
+        """Yield the body decoded in a single chunk."""
+        assert decode_content
+        yield self.data
+
+
+def test_fallback_without_read1():
+    """Responses without read1 are read through iter_content."""
+    assert b"".join(iter_stream_chunks(make_response(OldRaw(body)))) == body
@@ -0,0 +1,21 @@
+"""Config combinations parse_config rejects before starting a run."""
+import pytest
+
+from utils import parse_config
+
+
+def make_config(output_format):
+    """Return a sketch transport config writing output_format."""
+    return {
+        "dataset": {},
+        "load_options": {"type": "constant", "concurrency": 1, "duration": 1},
+        "output": {"format": output_format},
+        "results_options": {"transport": "sketch"},
+    }
+
+
+@pytest.mark.parametrize("output_format", ["jsonl.gz", "parquet"])
+def test_sketch_rejects_columnar_formats(output_format):
+    """The sketch summary can only be written as json."""
+    with pytest.raises(ValueError, match="sketch"):
+        parse_config(make_config(output_format))
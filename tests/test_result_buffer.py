@@ -0,0 +1,92 @@
+"""Result records of the shared memory transport."""
+import asyncio
+import multiprocessing as mp
+
+from async_user import AsyncUserWorker
+
+from plugins.plugin import Plugin, deadline_stop_reason
+
+from result import RequestResult
+
+from result_buffer import (
+    ResultRingBuffer,
+    input_id_text_size,
+    known_stop_reasons,
+    pack_result,
+    record_struct,
+    unpack_result,
+)
+
+
+def make_result():
+    """Return a finished result."""
+    result = RequestResult(0, 1, 10)
+    result.start_time = 100.0
+    result.end_time = 101.0
+    result.output_tokens = 5
+    return result
+
+
+def round_trip(result):
+    """Return result packed into a record and unpacked."""
+    buffer = bytearray(record_struct.size)
+    pack_result(buffer, 0, result)
+    return unpack_result(buffer, 0)
+
+
+def test_known_stop_reasons_round_trip():
+    """Known stop reasons come out of a record unchanged."""
+    for stop_reason in known_stop_reasons:
+        result = make_result()
+        result.stop_reason = stop_reason
+        assert round_trip(result).stop_reason == stop_reason
+
+
+def test_deadline_exceeded_round_trip():
+    """A request aborted at its deadline keeps its stop_reason and token counts."""
+    result = make_result()
+    Plugin({}).mark_deadline_exceeded(result, 3)
+    unpacked = round_trip(result)
+    assert unpacked.stop_reason == deadline_stop_reason
+    assert unpacked.output_tokens_before_timeout == result.output_tokens_before_timeout
+
+
+def test_try_push_full_buffer():
+    """try_push refuses a result instead of waiting while the buffer is full."""
+    results_buffer = ResultRingBuffer(mp.get_context("spawn"), capacity=2)
+    assert results_buffer.try_push(make_result())
+    assert results_buffer.try_push(make_result())
+    assert not results_buffer.try_push(make_result())
+    assert len(results_buffer.drain()) == 2
+    assert results_buffer.try_push(make_result())
+
+
+def test_async_push_doesnt_block_other_users():
+    """A user waiting for room in a full buffer lets the other users of its worker run."""
+    results_buffer = ResultRingBuffer(mp.get_context("spawn"), capacity=1)
+    worker = AsyncUserWorker(0, [0, 1], None, None, None, None, None, None, None, 1, results_buffer=results_buffer)
+    ticks = []
+
+    async def other_user():
+        for _ in range(5):
+            ticks.append(len(ticks))
+            await asyncio.sleep(0.01)
+        # Make room for the waiting result
+        results_buffer.drain()
+
+    async def run():
+        await worker.push_result(make_result())
+        await asyncio.gather(worker.push_result(make_result()), other_user())
+
+    asyncio.run(run())
+    assert ticks == list(range(5))
+    assert len(results_buffer.drain()) == 1
+
+
+def test_input_id_round_trip():
+    """Integer and string input_ids come out of a record, long strings truncated."""
+    long_id = "What is the boiling point of water? " * 10
+    for input_id, expected in [(7, 7), ("abc-1", "abc-1"), (None, None), (long_id, long_id[:input_id_text_size])]:
+        result = make_result()
+        result.input_id = input_id
+        assert round_trip(result).input_id == expected
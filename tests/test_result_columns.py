@@ -0,0 +1,37 @@
+"""Results kept in typed columns come back as they were given."""
+import numpy as np
+
+import pyarrow.parquet as pq
+
+from result import RequestResult, ResultColumns
+
+from result_writer import ResultWriter
+
+
+def make_result(input_id):
+    """Return a finished result of input_id."""
+    result = RequestResult(0, input_id, 5)
+    result.start_time = 100.0
+    result.end_time = 101.0
+    result.output_tokens = 3
+    result.calculate_results()
+    return result
+
+
+def test_input_ids_kept_as_given(tmp_path):
+    """Integer, string and missing input_ids survive every conversion."""
+    input_ids = [7, "abc-1", None, "What is the boiling point of water?"]
+    results = ResultColumns()
+    for input_id in input_ids:
+        results.append(make_result(input_id))
+
+    assert [result.input_id for result in results] == input_ids
+    assert results[1].input_id == "abc-1"
+    assert [record["input_id"] for record in results.to_records()] == input_ids
+    assert results.to_dataframe()["input_id"].tolist() == input_ids
+    assert [result.input_id for result in results.select(np.array([False, True, False, True]))] == ["abc-1", input_ids[3]]
+
+    path = tmp_path / "out.parquet"
+    with ResultWriter(path, "parquet", {}) as writer:
+        writer.write(results)
+    assert pq.read_table(path)["input_id"].to_pylist() == ["7", "abc-1", None, input_ids[3]]
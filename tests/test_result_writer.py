@@ -0,0 +1,64 @@
+"""Results written as they arrive, with the summary added on close."""
+import gzip
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from result import RequestResult
+
+from result_writer import ResultWriter, metadata_sidecar
+
+
+def make_results(count):
+    """Return count finished results."""
+    results = []
+    for idx in range(count):
+        result = RequestResult(0, idx, 10)
+        result.start_time = 100.0 + idx
+        result.end_time = 101.0 + idx
+        result.output_tokens = 5
+        result.calculate_results()
+        results.append(result)
+    return results
+
+
+def write(path, output_format):
+    """Append 7 results in batches of 2, then close with the summary."""
+    writer = ResultWriter(path, output_format, {"config": json.dumps({"plugin": "dummy"})}, row_group_size=3)
+    results = make_results(7)
+    for idx in range(0, len(results), 2):
+        writer.append(results[idx:idx + 2])
+    writer.close({"summary": json.dumps({"total_requests": 7})})
+    # Closing again, like load_test does after a failure, does nothing
+    writer.close()
+
+
+def test_parquet_row_groups_and_footer(tmp_path):
+    """Full row groups are written as results arrive, the summary is in the file metadata."""
+    path = tmp_path / "out.parquet"
+    write(path, "parquet")
+    metadata = pq.read_metadata(path)
+    assert [metadata.row_group(idx).num_rows for idx in range(metadata.num_row_groups)] == [3, 3, 1]
+    assert json.loads(metadata.metadata[b"summary"]) == {"total_requests": 7}
+    assert json.loads(metadata.metadata[b"config"]) == {"plugin": "dummy"}
+
+
+def test_arrow_sidecar(tmp_path):
+    """Arrow IPC files get their metadata in a sidecar file."""
+    path = tmp_path / "out.arrow"
+    write(path, "arrow")
+    assert pa.ipc.open_file(str(path)).read_all()["input_id"].to_pylist() == [str(idx) for idx in range(7)]
+    with open(metadata_sidecar(path), encoding="utf-8") as file:
+        assert json.load(file) == {"config": {"plugin": "dummy"}, "summary": {"total_requests": 7}}
+
+
+def test_jsonl_trailer(tmp_path):
+    """JSON lines files start with the config and end with the summary."""
+    path = tmp_path / "out.jsonl.gz"
+    write(path, "jsonl.gz")
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        lines = [json.loads(line) for line in file]
+    assert lines[0] == {"config": {"plugin": "dummy"}}
+    assert [line["input_id"] for line in lines[1:-1]] == list(range(7))
+    assert lines[-1] == {"summary": {"total_requests": 7}}
@@ -0,0 +1,103 @@
+"""Warmup with multi-turn sessions sends a single result per warmup query."""
+import asyncio
+import queue
+
+from async_user import AsyncUserWorker
+
+from result import RequestResult
+
+from session import make_sessions
+
+from user import User
+
+
+class FakePlugin:
+    """Answer every query at once."""
+
+    def request_func(self, query, user_id, test_end_time=0):
+        """Return an error free result."""
+        result = RequestResult(user_id, query.get("input_id"), query.get("input_tokens"))
+        result.output_text = "answer"
+        result.output_tokens = 1
+        return result
+
+    async def async_request_func(self, query, user_id, test_end_time=0):
+        """Return an error free result."""
+        return self.request_func(query, user_id, test_end_time)
+
+
+class FakePipe:
+    """Keep the sent messages."""
+
+    def __init__(self):
+        """Init method."""
+        self.messages = []
+
+    def send(self, message):
+        """Record a message."""
+        self.messages.append(list(message))
+
+
+class ListQueue:
+    """A dataset_q which doesn't wait once it's empty."""
+
+    def __init__(self, items):
+        """Init method."""
+        self.items = list(items)
+
+    def get(self, timeout=None):
+        """Return the next item, raise queue.Empty at once if there is none."""
+        if not self.items:
+            raise queue.Empty
+        return self.items.pop(0)
+
+
+class WarmupQueue:
+    """A warmup_q the main process signals after empty() was called calls times."""
+
+    def __init__(self, calls):
+        """Init method."""
+        self.calls = calls
+
+    def empty(self):
+        """Return True until the end of the warmup."""
+        self.calls -= 1
+        return self.calls >= 0
+
+
+def get_session():
+    """Return a session of 3 turns."""
+    queries = [{"text": f"turn {idx}", "input_id": idx, "input_tokens": 2, "output_tokens": 1} for idx in range(3)]
+    return make_sessions(queries, turns=3)[0]
+
+
+def test_user_warmup_sends_first_turn_only():
+    """A User sends the first turn of a warmup session only."""
+    pipe = FakePipe()
+    user = User(0, ListQueue([get_session()]), WarmupQueue(5), None, pipe, FakePlugin(), None, None, 1)
+    user.run_warmup()
+
+    assert [[result.turn for result in message] for message in pipe.messages] == [[0]]
+    assert user.session is None
+
+
+def test_async_worker_warmup_sends_first_turn_only():
+    """An AsyncUserWorker user sends the first turn of a warmup session only."""
+    pipe = FakePipe()
+    worker = AsyncUserWorker(0, [0], None, None, None, pipe, FakePlugin(), None, None, 1)
+
+    async def run():
+        worker.query_q = asyncio.Queue()
+        worker.warmup_done = asyncio.Event()
+        worker.stopped = asyncio.Event()
+        worker.query_q.put_nowait(get_session())
+        user = asyncio.create_task(worker.run_user(0))
+        await asyncio.sleep(0.2)
+        worker.warmup_done.set()
+        worker.stopped.set()
+        await user
+
+    worker.warmup_q = WarmupQueue(0)
+    asyncio.run(run())
+
+    assert [[result.turn for result in message] for message in pipe.messages] == [[0]]
@@ -0,0 +1,37 @@
+"""A trace is parsed once per run."""
+import trace_replay
+
+import utils
+
+
+def test_trace_parsed_once(tmp_path, monkeypatch):
+    """Validation, duration and the replay itself share a single parse of the trace."""
+    trace = tmp_path / "trace.csv"
+    trace.write_text("timestamp,input_tokens,output_tokens\n0,10,5\n1.5,20,5\n3,30,5\n4,40,5\n")
+    parses = []
+
+    class CountingTraceReplay(trace_replay.TraceReplay):
+        def __init__(self, *args, **kwargs):
+            parses.append(args)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "TraceReplay", CountingTraceReplay)
+    monkeypatch.setattr(utils, "trace_replays", {})
+    load_options = {"type": "trace", "trace": str(trace), "concurrency": 2}
+
+    replay = utils.get_trace_replay(load_options)
+    assert utils.get_concurrency_duration(load_options) == (2, 5)
+    assert utils.get_concurrency_duration(load_options) == (2, 5)
+    assert utils.get_trace_replay(load_options) is replay
+    assert len(parses) == 1
+
+    # An agent's share doesn't change the trace other callers get
+    share = replay.partition(1, 2)
+    assert share.input_tokens.tolist() == [20, 40]
+    assert utils.get_trace_replay(load_options).input_tokens.tolist() == [10, 20, 30, 40]
+
+    # Different options, or a changed file, are parsed again
+    utils.get_trace_replay(dict(load_options, speedup=2))
+    trace.write_text("timestamp,input_tokens,output_tokens\n0,10,5\n")
+    assert len(utils.get_trace_replay(load_options)) == 1
+    assert len(parses) == 3
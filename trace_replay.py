@@ -0,0 +1,125 @@
+"""Replay of recorded request arrivals, from a CSV or JSON lines trace."""
+import copy
+import logging
+
+import numpy as np
+
+import pandas as pd
+
+from synthetic_dataset import SyntheticDataset
+
+# Default column names of the trace, load_options.trace_columns renames them.
+default_trace_columns = {"timestamp": "timestamp", "input_tokens": "input_tokens", "output_tokens": "output_tokens"}
+
+# Seconds per unit of numeric timestamps.
+time_units = {"s": 1.0, "ms": 1e-3, "us": 1e-6, "ns": 1e-9}
+
+
+class TraceReplay:
+    """Arrival offsets and token lengths of the requests of a trace.
+
+    Timestamps are numbers in time_unit or date strings, only their
+    offsets from the first request matter. Offsets are divided by
+    speedup, a speedup of 2 replays the trace twice as fast.
+    """
+
+    def __init__(self, trace_file, speedup=1.0, columns=None, time_unit="s"):
+        """Init method."""
+        if not speedup or speedup <= 0:
+            raise ValueError(f"load_options.speedup must be a positive number, got {speedup}")
+        if time_unit not in time_units:
+            raise ValueError(f"Unknown load_options.trace_time_unit {time_unit}, expected one of {list(time_units)}")
+        columns = dict(default_trace_columns, **(columns or {}))
+        if str(trace_file).endswith((".csv", ".csv.gz")):
+            frame = pd.read_csv(trace_file)
+        else:
+            frame = pd.read_json(trace_file, lines=True)
+        missing = [column for column in columns.values() if column not in frame]
+        if missing:
+            raise ValueError(f"Trace {trace_file} has no column {missing}, set load_options.trace_columns")
+
+        timestamps = frame[columns["timestamp"]]
+        if pd.api.types.is_numeric_dtype(timestamps):
+            seconds = timestamps.to_numpy(dtype=np.float64) * time_units[time_unit]
+        else:
+            seconds = pd.to_datetime(timestamps).to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+        order = np.argsort(seconds, kind="stable")
+        self.offsets = (seconds[order] - seconds[order][0]) / speedup if len(order) else seconds
+        self.input_tokens = frame[columns["input_tokens"]].to_numpy(dtype=np.int64)[order]
+        self.output_tokens = frame[columns["output_tokens"]].to_numpy(dtype=np.int64)[order]
+        self.speedup = speedup
+        logging.info("Loaded %d requests over %.1f s from trace %s", len(self), self.duration(), trace_file)
+
+    def __len__(self):
+        """Return the number of requests."""
+        return len(self.offsets)
+
+    def duration(self):
+        """Return the time in seconds between the first and the last request, once sped up."""
+        return float(self.offsets[-1]) if len(self) else 0.0
+
+    def partition(self, index, count):
+        """Return a TraceReplay of every count-th request starting at index, the share of one agent of a distributed test."""
+        share = copy.copy(self)
+        share.offsets = self.offsets[index::count]
+        share.input_tokens = self.input_tokens[index::count]
+        share.output_tokens = self.output_tokens[index::count]
+        return share
+
+    def send_times(self, start_time, duration=None):
+        """Yield the index and absolute send time of each request sent within duration seconds of start_time."""
+        for idx, offset in enumerate(self.offsets.tolist()):
+            if duration is not None and offset >= duration:
+                return
+            yield idx, start_time + offset
+
+    def map_queries(self, dataset):
+        """Return a query for each request, with the token lengths of the trace.
+
+        A SyntheticDataset generates prompts of the exact input length.
+        Otherwise each request gets the dataset query closest in input
+        length, cycling over the queries of the same length so that they
+        aren't all the same prompt. Output lengths always come from the
+        trace.
+        """
+        input_tokens = self.input_tokens.tolist()
+        output_tokens = self.output_tokens.tolist()
+        if isinstance(dataset, SyntheticDataset):
+            counts = {}
+            queries = []
+            for idx, (request_input_tokens, request_output_tokens) in enumerate(zip(input_tokens, output_tokens)):
+                prompt_index = counts.get(request_input_tokens, 0)
+                counts[request_input_tokens] = prompt_index + 1
+                queries.append({
+                    "text": dataset.get_prompt(request_input_tokens, prompt_index),
+                    "input_id": idx,
+                    "input_tokens": request_input_tokens,
+                    "output_tokens": request_output_tokens,
+                })
+            return queries
+
+        dataset_list = dataset.dataset_list
+        if not len(dataset_list):
+            raise ValueError("The dataset is empty, no query to replay the trace with")
+        lengths = np.array([query["input_tokens"] for query in dataset_list], dtype=np.int64)
+        order = np.argsort(lengths, kind="stable")
+        sorted_lengths = lengths[order]
+        # Nearest dataset input length of each request
+        targets = np.asarray(input_tokens, dtype=np.int64)
+        right = np.clip(np.searchsorted(sorted_lengths, targets), 0, len(sorted_lengths) - 1)
+        left = np.clip(right - 1, 0, len(sorted_lengths) - 1)
+        nearest = np.where(
+            np.abs(sorted_lengths[left] - targets) <= np.abs(sorted_lengths[right] - targets),
+            sorted_lengths[left],
+            sorted_lengths[right],
+        )
+        first = np.searchsorted(sorted_lengths, nearest, side="left").tolist()
+        last = np.searchsorted(sorted_lengths, nearest, side="right").tolist()
+        counts = {}
+        queries = []
+        for start, end, request_output_tokens in zip(first, last, output_tokens):
+            count = counts.get(start, 0)
+            counts[start] = count + 1
+            query = dataset_list[int(order[start + count % (end - start)])]
+            queries.append(dict(query, output_tokens=request_output_tokens))
+        return queries
@@ -4,6 +4,10 @@ import logging
 import queue
 import time
 
+from result import ResultColumns
+
+from session import Session
+
 
 class User:
     """Define a user."""
@@ -19,6 +23,12 @@ class User:
         logger_q,
         log_level,
         run_duration,
+        active_users=None,
+        queries=None,
+        results_buffer=None,
+        test_start=None,
+        results_sketch=None,
+        keep_output_text=True,
     ):
         """Initialize object."""
         self.user_id = user_id
@@ -26,28 +36,77 @@ class User:
         self.dataset_q = dataset_q
         self.warmup_q = warmup_q
         self.stop_q = stop_q
-        self.results_list = []
+        # Results are kept column wise until the end of the test
+        self.keep_output_text = keep_output_text
+        self.results_list = ResultColumns(keep_output_text)
         self.results_pipe = results_pipe
+        # Optional ResultRingBuffer, results of the test are streamed through it instead of results_pipe
+        self.results_buffer = results_buffer
+        # Optional ResultsSketch, results of the test are only summarized in it and sent at the end
+        self.results_sketch = results_sketch
+        # Shared multiprocessing value set by the main process to the time the test starts
+        self.test_start = test_start
         self.logger_q = logger_q
         self.log_level = log_level
         # Must get reset in user process to use the logger created in _init_user_process_logging
         self.logger = logging.getLogger("user")
         self.run_duration = run_duration
+        # Shared multiprocessing value, the user is parked while its user_id is >= active_users.value
+        self.active_users = active_users
+        # This user's own partition of the dataset, iterated locally instead of reading
+        # from dataset_q. None when queries are scheduled through dataset_q.
+        self.queries = queries
+        self.query_index = 0
+        # Conversation in progress when the dataset is made of sessions, its turns are sent one per request
+        self.session = None
+
+    def next_query(self):
+        """Return the next query of this user's dataset partition."""
+        query = self.queries[self.query_index]
+        self.query_index = (self.query_index + 1) % len(self.queries)
+        return query
 
-    def make_request(self, test_end_time=0):
+    def make_request(self, test_end_time=0, from_queue=True):
         """Make a request."""
-        try:
-            query = self.dataset_q.get(timeout=2)
-        except queue.Empty:
-            # if timeout passes, queue.Empty will be thrown
-            # User should continue to poll for inputs
-            return None
-        except ValueError:
-            self.logger.warn("dataset q does not exist!")
-            return None
+        if self.session is not None:
+            query = self.session.next_query()
+        elif not from_queue:
+            query = self.next_query()
+        else:
+            try:
+                query = self.dataset_q.get(timeout=2)
+            except queue.Empty:
+                # if timeout passes, queue.Empty will be thrown
+                # User should continue to poll for inputs
+                return None
+            except ValueError:
+                self.logger.warn("dataset q does not exist!")
+                return None
+
+            if self.active_users is not None and self.user_id >= self.active_users.value:
+                # A stair-step parked this user while it was waiting, give the query back to an active user
+                self.dataset_q.put(query)
+                return None
+
+        if "turns" in query:
+            # First turn of a new conversation
+            self.session = Session(query)
+            query = self.session.next_query()
 
         self.logger.info("User %s making request", self.user_id)
+        if self.results_buffer is not None and test_end_time:
+            # Warmup requests (no test_end_time) are not streamed, so not counted either
+            self.results_buffer.request_started()
         result = self.plugin.request_func(query, self.user_id, test_end_time)
+        if query.get("scheduled_start_time") is not None:
+            result.scheduled_start_time = query["scheduled_start_time"]
+            result.dispatch_delay = query.get("dispatch_delay")
+            result.calculate_results()
+        if self.session is not None:
+            result.turn = query["turn"]
+            self.session.add_response(query, result)
+            if self.session.done():
+                self.session = None
         return result
 
     def _init_user_process_logging(self):
@@ -61,32 +120,59 @@ class User:
         self.logger = logging.getLogger("user")
         return logging.getLogger("user")
 
+    def run_warmup(self):
+        """Send warmup queries from dataset_q until the main process ends the warmup."""
+        self.logger.info("User %s starting warmup", self.user_id)
+        while self.warmup_q.empty():
+            result = self.make_request()
+            # The main process expects one result per warmup query, a
+            # conversation stops after its first turn
+            self.session = None
+            # make_request will return None after 2 seconds if dataset_q is empty
+            # to ensure that users don't get stuck waiting for requests
+            if result is not None:
+                # During warmup, send results as soon as they are received
+                self.results_list.append(result)
+                self.results_pipe.send(self.results_list)
+                self.results_list = ResultColumns(self.keep_output_text)
+        self.logger.info("User %s done warmup", self.user_id)
+
     def run_user_process(self):
         """Run a process."""
         self._init_user_process_logging()
 
         if self.warmup_q is not None:
-            self.logger.info("User %s starting warmup", self.user_id)
-            while self.warmup_q.empty():
-                result = self.make_request()
-                # make_request will return None after 2 seconds if dataset_q is empty
-                # to ensure that users don't get stuck waiting for requests
-                if result is not None:
-                    # During warmup, send results as soon as they are received
-                    self.results_list.append(result)
-                    self.results_pipe.send(self.results_list)
-                    self.results_list = []
-            self.logger.info("User %s done warmup", self.user_id)
+            self.run_warmup()
 
-        test_end_time = time.time() + self.run_duration
+        if self.test_start is not None:
+            # Don't send anything before the main process starts the test timer
+            while self.test_start.value == 0 and self.stop_q.empty():
+                time.sleep(0.01)
+            test_end_time = self.test_start.value + self.run_duration
+        else:
+            test_end_time = time.time() + self.run_duration
         while self.stop_q.empty():
-            result = self.make_request(test_end_time)
+            if self.active_users is not None and self.user_id >= self.active_users.value:
+                # Parked until a later stair-step needs this user
+                time.sleep(0.1)
+                continue
+            result = self.make_request(test_end_time, from_queue=self.queries is None)
             # make_request will return None after 2 seconds if dataset_q is empty
             # to ensure that users don't get stuck waiting for requests indefinitely
             if result is not None:
-                self.results_list.append(result)
+                if self.results_buffer is not None:
+                    self.results_buffer.push(result)
+                elif self.results_sketch is not None:
+                    self.results_sketch.add(result)
+                else:
+                    self.results_list.append(result)
 
-        self.results_pipe.send(self.results_list)
+        if self.results_buffer is not None:
+            self.results_buffer.close()
+        elif self.results_sketch is not None:
+            self.results_pipe.send(self.results_sketch)
+        else:
+            self.results_pipe.send(self.results_list)
 
         time.sleep(4)
         self.logger.info("User %s done", self.user_id)
@@ -3,6 +3,7 @@
 import argparse
 import json
 import logging
+import math
 import os
 from pathlib import Path
 
@@ -18,10 +19,25 @@ from plugins import (
     tgis_grpc_plugin,
 )
 
+from result import ResultColumns
+
+from result_writer import ResultWriter, check_output_format, output_formats, output_suffix
+
+from slo_search import LoadSearch, SLO
+
+from trace_replay import TraceReplay
+
 import yaml
 
+# Percentiles in the summary of each metric, token level gaps also get the 99.9th.
+summary_percentiles = [80, 90, 95, 99]
+token_percentiles = [80, 90, 95, 99, 99.9]
+
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 
+# TraceReplays parsed by get_trace_replay, keyed by trace file and options.
+trace_replays = {}
+
 
 class customEncoder(json.JSONEncoder):
     """Return an encoder."""
@@ -54,6 +70,12 @@ def parse_args(args):
         default="config.yaml",
         help="config YAML file name",
     )
+    parser.add_argument(
+        "--agent",
+        metavar="[HOST:]PORT",
+        default=None,
+        help="run as a distributed load agent listening on HOST:PORT instead of running a test",
+    )
     parser.add_argument(
         "-log",
         "--log_level",
@@ -73,8 +95,37 @@ def parse_config(config):
     logging.info("load_options config: %s", config["load_options"])
 
     load_options = config.get("load_options")
-    concurrency = load_options.get("concurrency")
-    duration = load_options.get("duration")
+    load_type = load_options.get("type", "constant")
+    if load_type not in ("constant", "loadgen", "stair-step", "search", "trace"):
+        logging.error("Unknown load_options type %s", load_type)
+        raise ValueError(f"Unknown load_options type {load_type}")
+    if load_type == "loadgen" and not load_options.get("rate"):
+        raise ValueError("load_options.rate (requests per second) is required for loadgen")
+    if load_type == "search":
+        # Validates the search options
+        get_load_search(load_options)
+    if load_type == "trace":
+        # Validates the trace and its options
+        get_trace_replay(load_options)
+        if config["dataset"].get("sessions"):
+            raise ValueError("dataset.sessions can't be replayed from a trace")
+    concurrency, duration = get_concurrency_duration(load_options)
+
+    output_format = config.get("output", {}).get("format", "json")
+    check_output_format(output_format)
+
+    transport = config.get("results_options", {}).get("transport", "pipe")
+    if transport not in ("pipe", "shared_memory", "sketch"):
+        raise ValueError(f"Unknown results_options transport {transport}")
+    if transport == "sketch":
+        # Only whole run summaries are kept, nothing to split into steps or probes, or to stream
+        if load_type in ("stair-step", "search"):
+            raise ValueError(f"results_options.transport sketch doesn't support load_options.type {load_type}")
+        if config.get("metrics_options", {}).get("port") or config.get("metrics_options", {}).get("console"):
+            raise ValueError("metrics_options need the results streamed, not results_options.transport sketch")
+        if output_format != "json":
+            # The summary is a single json document, there are no per request results to write column wise
+            raise ValueError(f"results_options.transport sketch only writes output.format json, not {output_format}")
 
     plugin_type = config.get("plugin")
     if plugin_type == "openai_plugin":
@@ -93,9 +144,122 @@ def parse_config(config):
         logging.error("Unknown plugin type %s", plugin_type)
         raise ValueError(f"Unknown plugin type {plugin_type}")
 
+    if load_options.get("hard_deadline"):
+        # Abort requests still in flight deadline_grace seconds after the end of the test
+        plugin.deadline_grace = load_options.get("deadline_grace", 0)
+
     return concurrency, duration, plugin
 
 
+def get_concurrency_duration(load_options):
+    """Return the number of users to spawn and the total duration of the test."""
+    concurrency = load_options.get("concurrency")
+    duration = load_options.get("duration")
+    load_type = load_options.get("type", "constant")
+    if load_type == "stair-step":
+        # Users are spawned once for the largest step and the test runs for all steps
+        steps = get_stair_steps(load_options)
+        concurrency = max(step_concurrency for step_concurrency, _ in steps)
+        duration = len(steps) * get_step_duration(load_options)
+    if load_type == "search":
+        # Users are spawned once for the largest concurrency
+        duration = get_max_probes(load_options) * get_probe_duration(load_options)
+    if load_type == "trace" and duration is None:
+        # The whole trace, up to its last request
+        duration = math.ceil(get_trace_replay(load_options).duration()) + 1
+    return concurrency, duration
+
+
+def get_trace_replay(load_options):
+    """Return the TraceReplay of a trace load, load_options.trace is the CSV or JSON lines file.
+
+    The trace is parsed once per process, later calls with the same options
+    and an unchanged file return the same TraceReplay.
+    """
+    if not load_options.get("trace"):
+        raise ValueError("load_options.trace (CSV or JSON lines file of requests) is required for a trace load")
+    stat = os.stat(load_options["trace"])
+    key = json.dumps([
+        os.path.abspath(load_options["trace"]),
+        stat.st_size,
+        stat.st_mtime_ns,
+        load_options.get("speedup", 1.0),
+        load_options.get("trace_columns"),
+        load_options.get("trace_time_unit", "s"),
+    ], sort_keys=True)
+    if key not in trace_replays:
+        trace_replays[key] = TraceReplay(
+            load_options["trace"],
+            speedup=load_options.get("speedup", 1.0),
+            columns=load_options.get("trace_columns"),
+            time_unit=load_options.get("trace_time_unit", "s"),
+        )
+    return trace_replays[key]
+
+
+def get_stair_steps(load_options):
+    """Return the (concurrency, rate) of each step of a stair-step load.
+
+    Either load_options.concurrency is a list of concurrency levels, or
+    load_options.rate is a list of request rates sent open-loop with at most
+    load_options.concurrency requests in flight (rate is None for closed-loop steps).
+    """
+    concurrency = load_options.get("concurrency")
+    rate = load_options.get("rate")
+    if isinstance(rate, list):
+        if not isinstance(concurrency, int):
+            raise ValueError("load_options.concurrency must be a single number when stepping load_options.rate")
+        return [(concurrency, step_rate) for step_rate in rate]
+    if isinstance(concurrency, list):
+        return [(step_concurrency, None) for step_concurrency in concurrency]
+    raise ValueError("stair-step requires a list of load_options.concurrency levels or load_options.rate values")
+
+
+def get_step_duration(load_options):
+    """Return the duration in seconds of each step of a stair-step load."""
+    return load_options.get("step_duration", load_options.get("duration"))
+
+
+def get_load_search(load_options):
+    """Return the LoadSearch and SLO of a search load.
+
+    The search is over concurrency levels from load_options.min_concurrency
+    up to load_options.concurrency, or with search_over: rate over request
+    rates from load_options.min_rate up to load_options.rate.
+    """
+    slo = SLO(load_options.get("slo"), load_options.get("slo_percentile", 99))
+    search_over = load_options.get("search_over", "concurrency")
+    if search_over == "concurrency":
+        load_search = LoadSearch(
+            load_options.get("min_concurrency", 1),
+            load_options.get("concurrency"),
+            tolerance=load_options.get("search_tolerance", 1),
+            integer=True,
+        )
+    elif search_over == "rate":
+        if not load_options.get("rate"):
+            raise ValueError("load_options.rate (highest requests per second tried) is required to search over rate")
+        load_search = LoadSearch(
+            load_options.get("min_rate", 1),
+            load_options.get("rate"),
+            tolerance=load_options.get("search_tolerance", 1),
+            integer=False,
+        )
+    else:
+        raise ValueError(f"Unknown load_options.search_over {search_over}, expected concurrency or rate")
+    return load_search, slo
+
+
+def get_probe_duration(load_options):
+    """Return the duration in seconds of each probe of a search load."""
+    return load_options.get("probe_duration", 30)
+
+
+def get_max_probes(load_options):
+    """Return the maximum number of probes of a search load."""
+    return load_options.get("max_probes", 12)
+
+
 def yaml_load(file):
     """Load a yaml file."""
     if not Path(file).is_file():
@@ -107,8 +271,22 @@ def yaml_load(file):
             raise RuntimeError(f"Could not parse {file}") from exc
 
 
-def write_output(config, results_list):
-    """Write the results."""
+def streams_results(config):
+    """Return True if the results reach the main process while the test runs, not only at its end.
+
+    A search needs the results of each probe as soon as it ends, live
+    metrics as they complete.
+    """
+    metrics_options = config.get("metrics_options", {})
+    return (
+        config.get("results_options", {}).get("transport", "pipe") == "shared_memory"
+        or config["load_options"].get("type") == "search"
+        or bool(metrics_options.get("port") or metrics_options.get("console"))
+    )
+
+
+def get_output_file(config, concurrency, duration, rate, step=None):
+    """Return the path of the results file, creating its directory if needed."""
     output_options = config.get("output")
     output_path = output_options.get("dir")
 
@@ -118,65 +296,96 @@ def write_output(config, results_list):
         logging.warning("Output path %s does not exist, creating it!", path)
         path.mkdir(parents=True, exist_ok=True)
 
-    concurrency, duration, _ = parse_config(config)
     outfile_name = output_options.get("file").format(
-        concurrency=concurrency, duration=duration
+        concurrency=concurrency, duration=duration, rate=rate
     )
+    output_format = output_options.get("format", "json")
+    if output_format != "json":
+        outfile_name = output_suffix(outfile_name, output_format)
     outfile = path / Path(outfile_name)
-    results_list = [result.asdict() for result in results_list]
+    if step is not None and output_format != "json":
+        suffix = output_formats[output_format]
+        outfile = outfile.with_name(f"{outfile.name[:-len(suffix)]}_step{step}{suffix}")
+    elif step is not None:
+        outfile = outfile.with_name(f"{outfile.stem}_step{step}{outfile.suffix}")
+    return outfile
+
+
+def open_result_writer(config):
+    """Return a ResultWriter to append the results to while the test runs, None if they are written at the end.
+
+    Only a columnar output.format of a test whose results are streamed
+    can be written as they arrive. Stair-steps and searches write one
+    file per step, once the steps are known.
+    """
+    output_options = config.get("output")
+    output_format = output_options.get("format", "json")
+    if output_format == "json" or config["load_options"].get("type") in ("stair-step", "search"):
+        return None
+    if not streams_results(config):
+        return None
+    concurrency, duration = get_concurrency_duration(config["load_options"])
+    outfile = get_output_file(config, concurrency, duration, config["load_options"].get("rate"))
+    logging.info("Writing the results to %s as they arrive", outfile)
+    return ResultWriter(
+        outfile,
+        output_format,
+        {"config": json.dumps(config, cls=customEncoder)},
+        output_options.get("row_group_size", 65536),
+    )
+
+
+def write_output(config, results_list, concurrency=None, duration=None, rate=None, step=None, results_writer=None):
+    """Write the results.
+
+    concurrency, duration and rate default to the values in config, a
+    stair-step passes its own values and step index for each step.
+    results_list is a ResultColumns or a list of RequestResult.
+    results_writer is the open_result_writer() the results were already
+    appended to, it only gets the summary and is closed.
+    Returns the summary dict.
+    """
+    output_options = config.get("output")
+    output_format = output_options.get("format", "json")
+    if concurrency is None or duration is None:
+        concurrency, duration = get_concurrency_duration(config["load_options"])
+        rate = config["load_options"].get("rate")
+    if results_writer is not None:
+        outfile = results_writer.path
+    else:
+        outfile = get_output_file(config, concurrency, duration, rate, step)
+
+    results = as_result_columns(results_list)
     output_obj = {
-        "results": results_list,
+        "results": [],
         "config": config,
         "summary": {},
     }
 
-    logging.info("Length of results: %d", len(results_list))
-
-    # TODO, should this be output using logging?
-    df = pd.DataFrame(results_list)
-    df.head()
+    logging.info("Length of results: %d", len(results))
 
-    with pd.option_context("display.max_rows", None, "display.max_columns", None):
-        print(df)
+    df = results.to_dataframe()
     print(f"\n---\nFull results in {outfile}. Results summary:")
 
-    error_count = len(df[~df["error_text"].isnull()])
+    error_free = df["error_text"].isnull().to_numpy()
+    error_count = int((~error_free).sum())
     req_count = len(df)
     print(f"Error count: {error_count} of {req_count} total requests")
 
-    # Ignore errors for summary results
-    df = df[df["error_text"].isnull()]
+    # Token level inter-token latencies of all error free requests, pooled
+    has_itl_deltas = error_free & (results.numpy("itl_lengths") > 0)
+    itl_lengths, itl_deltas = results.token_itl(has_itl_deltas)
 
-    if "ttft" in df:
-        # Streaming
-        summary_df = df[
-            [
-                "tt_ack",
-                "ttft",
-                "itl",
-                "tpot",
-                "response_time",
-                "output_tokens",
-                "output_tokens_before_timeout",
-                "input_tokens",
-            ]
-        ].mean(numeric_only=True)
-    else:
-        # Non-streaming, no TTFT or ITL
-        summary_df = df[
-            [
-                "tpot",
-                "response_time",
-                "output_tokens",
-                "output_tokens_before_timeout",
-                "input_tokens",
-            ]
-        ].mean(numeric_only=True)
-    print(summary_df)
+    timeseries_window = output_options.get("timeseries_window", 1)
+    if timeseries_window:
+        output_obj["timeseries"] = get_timeseries(df, has_itl_deltas, itl_lengths, itl_deltas, timeseries_window)
+
+    # Ignore errors for summary results
+    df = df[error_free]
 
     # Only consider requests that were completed within the duration of the test for
     # calculating the summary statistics on tpot, ttft, itl, tt_ack
-    df_test_duration = df[df["output_tokens"] == df["output_tokens_before_timeout"]]
+    df_test_duration = df[(df["output_tokens"] == df["output_tokens_before_timeout"]).fillna(False)]
     req_completed_within_test_duration = len(df_test_duration)
 
     # Time per output token summary
@@ -192,9 +401,40 @@ def write_output(config, results_list):
         # Time to ack summary
         output_obj = get_summary(df_test_duration, output_obj, "tt_ack")
 
+        if df["turn"].notnull().any():
+            # Multi-turn sessions: first turns are cold, follow-ups can reuse the prefix cached for their history
+            turns = df_test_duration["turn"].to_numpy(dtype=np.float64, na_value=np.nan)
+            ttft = df_test_duration["ttft"].to_numpy(dtype=np.float64, na_value=np.nan)
+            output_obj["summary"]["ttft_cold"] = get_array_summary(ttft[turns == 0])
+            output_obj["summary"]["ttft_warm"] = get_array_summary(ttft[turns > 0])
+
+        if len(itl_deltas):
+            # Distribution of every gap between two tokens, stalls hidden by the per request itl mean
+            output_obj["summary"]["token_itl"] = get_array_summary(itl_deltas, token_percentiles, stats=True)
+
+        if df["max_itl"].notnull().any():
+            # Longest stall and jitter of the token gaps within each request
+            output_obj = get_summary(df, output_obj, "max_itl")
+            output_obj = get_summary(df, output_obj, "itl_jitter")
+
     # response time summary
     output_obj = get_summary(df, output_obj, "response_time")
 
+    if df["schedule_delay"].notnull().any():
+        # Open-loop load, latencies measured from the scheduled send time
+        output_obj = get_summary(df, output_obj, "schedule_delay")
+        if df["dispatch_delay"].notnull().any():
+            # Lateness of the scheduler itself, the rest of schedule_delay is spent waiting for a free user
+            output_obj = get_summary(df, output_obj, "dispatch_delay")
+        output_obj = get_summary(df, output_obj, "corrected_response_time")
+        if "ttft" in df:
+            output_obj = get_summary(df_test_duration, output_obj, "corrected_ttft")
+
+    if df["connect_time"].notnull().any():
+        # Connection setup, only for the requests which could not reuse a kept-alive connection
+        output_obj = get_summary(df, output_obj, "connect_time")
+        output_obj["summary"]["new_connections"] = int(df["connect_time"].notnull().sum())
+
     # output tokens summary
     output_obj = get_summary(df, output_obj, "output_tokens")
 
@@ -203,6 +443,7 @@ def write_output(config, results_list):
 
     # input tokens summary
     output_obj = get_summary(df, output_obj, "input_tokens")
+    print_summary_table(output_obj["summary"])
 
     # CALCULATE REAL DURATION NOT TARGET DURATION
     true_end = df["end_time"].max()
@@ -228,20 +469,271 @@ def write_output(config, results_list):
     output_obj["summary"]["total_failures"] = error_count
     output_obj["summary"]["failure_rate"] = error_count / req_count * 100
 
+    if output_format == "json":
+        # The per token gaps are summarized, not written out per request
+        output_obj["results"] = results.to_records()
+        json_out = json.dumps(output_obj, cls=customEncoder, indent=2)
+        with outfile.open("w") as f:
+            f.write(json_out)
+    else:
+        # Results are written straight from the RequestResults, config, summary and timeseries go in the metadata
+        if results_writer is None:
+            results_writer = ResultWriter(
+                outfile,
+                output_format,
+                {"config": json.dumps(config, cls=customEncoder)},
+                output_options.get("row_group_size", 65536),
+            )
+            results_writer.write(results)
+        results_writer.close({
+            key: json.dumps(value, cls=customEncoder)
+            for key, value in output_obj.items()
+            if key not in ("results", "config")
+        })
+
+    return output_obj["summary"]
+
+
+def write_sketch_output(config, results_sketch):
+    """Write the summary of a ResultsSketch, the output has no per request results.
+
+    Returns the summary dict.
+    """
+    output_options = config.get("output")
+    path = Path(output_options.get("dir"))
+    logging.info("Writing output to %s", path)
+    if not (path.exists() and path.is_dir()):
+        logging.warning("Output path %s does not exist, creating it!", path)
+        path.mkdir(parents=True, exist_ok=True)
+
+    concurrency, duration = get_concurrency_duration(config["load_options"])
+    rate = config["load_options"].get("rate")
+    outfile = path / Path(output_options.get("file").format(concurrency=concurrency, duration=duration, rate=rate))
+
+    summary = results_sketch.summary(duration)
+    output_obj = {
+        "config": config,
+        "summary": summary,
+    }
+
+    print(f"\n---\nSummary in {outfile}, percentiles within {100 * results_sketch.relative_accuracy}%. Results summary:")
+    print(f"Error count: {summary['total_failures']} of {summary['total_requests']} total requests")
+    for metric in ("tt_ack", "ttft", "itl", "tpot", "response_time", "output_tokens", "input_tokens"):
+        print(f"{metric:<16} {summary[metric]['mean']}")
+    print(
+        f"Total true throughput across all users: {summary['throughput_full_duration']} tokens / sec, "
+        f"for duration {summary['full_duration']}"
+    )
+    print(
+        f"Total throughput across all users bounded by the test duration: {summary['throughput']} tokens / sec, "
+        f"for duration {duration}"
+    )
+
     json_out = json.dumps(output_obj, cls=customEncoder, indent=2)
     with outfile.open("w") as f:
         f.write(json_out)
 
+    return summary
+
+
+def write_stair_step_output(config, results_list, step_windows):
+    """Write one output file per stair-step, plus a combined throughput/latency curve file.
+
+    A request belongs to the step during which it was started.
+    """
+    curve = []
+    results = as_result_columns(results_list)
+    start_times = results.numpy("start_time")
+    for step_window in step_windows:
+        step_results = results.select(
+            (start_times >= step_window["start_time"]) & (start_times < step_window["end_time"])
+        )
+        if not len(step_results):
+            logging.warning("No results in step %d, skipping its output", step_window["step"])
+            continue
+        summary = write_output(
+            config,
+            step_results,
+            concurrency=step_window["concurrency"],
+            duration=step_window["duration"],
+            rate=step_window["rate"],
+            step=step_window["step"],
+        )
+        point = dict(step_window)
+        for key in ("throughput", "throughput_full_duration", "total_requests", "failure_rate"):
+            point[key] = summary[key]
+        for key in ("ttft", "itl", "tpot", "response_time", "corrected_response_time"):
+            if key in summary:
+                point[key] = {
+                    "median": summary[key]["median"],
+                    "percentile_99": summary[key]["percentile_99"],
+                }
+        curve.append(point)
+
+    output_options = config.get("output")
+    outfile_name = output_options.get("file").format(
+        concurrency="sweep", duration=get_step_duration(config["load_options"]), rate="sweep"
+    )
+    outfile = Path(output_options.get("dir")) / Path(outfile_name)
+    outfile = outfile.with_name(f"{outfile.stem}_curve{outfile.suffix}")
+    output_obj = {"curve": curve, "config": config}
+    if any("slo_met" in step_window for step_window in step_windows):
+        # SLO search, report the passing probe with the highest goodput
+        best = max(
+            (step_window for step_window in step_windows if step_window["slo_met"]),
+            key=lambda step_window: step_window["goodput"],
+            default=None,
+        )
+        output_obj["search"] = {
+            "slo": config["load_options"].get("slo"),
+            "slo_percentile": config["load_options"].get("slo_percentile", 99),
+            "probes": len(step_windows),
+            "best_concurrency": best and best["concurrency"],
+            "best_rate": best and best["rate"],
+            "goodput": best and best["goodput"],
+        }
+        if best is None:
+            print("\n---\nNo probe met the SLO")
+        else:
+            print(
+                f"\n---\nHighest goodput meeting the SLO: {best['goodput']} tokens / sec, "
+                f"concurrency {best['concurrency']}, rate {best['rate']}"
+            )
+
+    logging.info("Writing stair-step curve to %s", outfile)
+    json_out = json.dumps(output_obj, cls=customEncoder, indent=2)
+    with outfile.open("w") as f:
+        f.write(json_out)
+
+
+def _bucket_percentile(buckets: np.ndarray, values: np.ndarray, pct: float, bucket_count: int):
+    """Nearest-rank percentile of values within each bucket, NaN for empty buckets."""
+    order = np.lexsort((values, buckets))
+    counts = np.bincount(buckets, minlength=bucket_count)
+    starts = np.cumsum(counts) - counts
+    ranks = np.maximum(np.ceil(pct / 100 * counts).astype(np.int64), 1) - 1
+    out = np.full(bucket_count, np.nan)
+    nonempty = counts > 0
+    out[nonempty] = values[order][starts[nonempty] + ranks[nonempty]]
+    return out
+
+
+def get_timeseries(
+    df: pd.DataFrame, has_itl_deltas: np.ndarray, itl_lengths: np.ndarray, itl_deltas: np.ndarray, window: float
+):
+    """Bin the results of a run into buckets of window seconds from the first request start.
+
+    Output tokens are counted when they arrived when the per token gaps are
+    known, at the end of the request otherwise. Errors are counted when the
+    request ended, the TTFT percentiles of a bucket are over the requests
+    whose first token arrived in it. itl_lengths are the itl_deltas counts of
+    the has_itl_deltas results, itl_deltas all their gaps concatenated.
+    Returns one list per column.
+    """
+    start_time = df["start_time"].min()
+    end_time = np.nanmax(df[["start_time", "end_time"]].to_numpy(dtype=np.float64))
+    bucket_count = int(np.floor((end_time - start_time) / window)) + 1
+
+    def bucket(times):
+        return np.clip(((times - start_time) // window).astype(np.int64), 0, bucket_count - 1)
+
+    def count(times, weights=None):
+        valid = ~np.isnan(times)
+        if weights is not None:
+            weights = weights[valid]
+        return np.bincount(bucket(times[valid]), weights=weights, minlength=bucket_count)
+
+    starts = df["start_time"].to_numpy(dtype=np.float64)
+    ends = df["end_time"].to_numpy(dtype=np.float64)
+    failed = df["error_text"].notnull().to_numpy()
+
+    # Tokens of error free requests without per token times, at the end of the request
+    at_end = ~failed & ~has_itl_deltas
+    output_tokens = count(ends[at_end], df["output_tokens"].to_numpy(dtype=np.float64)[at_end])
+    if len(itl_deltas):
+        # Arrival times of every token: first_token_time, then the running sum of the gaps of each request
+        lengths = itl_lengths
+        gaps = itl_deltas.astype(np.float64) / 1000
+        elapsed = np.cumsum(gaps)
+        # Restart the running sum at each request
+        offsets = np.repeat(np.concatenate(([0.0], elapsed))[np.cumsum(lengths) - lengths], lengths)
+        first_token_times = df["first_token_time"].to_numpy(dtype=np.float64)[has_itl_deltas]
+        token_times = np.concatenate(
+            (first_token_times, np.repeat(first_token_times, lengths) + elapsed - offsets)
+        )
+        output_tokens += count(token_times)
+
+    timeseries = {
+        "window": window,
+        "start_time": start_time,
+        "time": (np.arange(bucket_count) * window).tolist(),
+        "requests_started": count(starts).astype(np.int64).tolist(),
+        "requests_completed": count(ends[~failed]).astype(np.int64).tolist(),
+        "errors": count(ends[failed]).astype(np.int64).tolist(),
+        "output_tokens": output_tokens.astype(np.int64).tolist(),
+    }
+    if "ttft" in df:
+        ttft = df["ttft"].to_numpy(dtype=np.float64)
+        first_token_times = df["first_token_time"].to_numpy(dtype=np.float64)
+        valid = ~failed & ~np.isnan(ttft) & ~np.isnan(first_token_times)
+        for pct in (50, 99):
+            values = _bucket_percentile(bucket(first_token_times[valid]), ttft[valid], pct, bucket_count)
+            timeseries[f"ttft_percentile_{pct}"] = [None if np.isnan(value) else value for value in values.tolist()]
+    return timeseries
+
+
+def get_array_summary(values: np.ndarray, percentiles=summary_percentiles, stats=False):
+    """Summarize the values of a numpy array, NaNs ignored, with all percentiles in one pass.
+
+    Returns min, max, median, mean and percentile_<pct> keys, plus std and
+    count when stats is set.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        summary = dict.fromkeys(["min", "max", "median", "mean"], math.nan)
+        summary.update({f"percentile_{pct}": math.nan for pct in percentiles})
+        return summary
+    # Linear interpolation, like pandas quantile()
+    quantiles = np.percentile(values, [50] + list(percentiles))
+    summary = {
+        "min": values.min(),
+        "max": values.max(),
+        "median": quantiles[0],
+        "mean": values.mean(),
+    }
+    if stats:
+        summary["std"] = values.std()
+    for pct, value in zip(percentiles, quantiles[1:]):
+        summary[f"percentile_{pct}"] = value
+    if stats:
+        summary["count"] = len(values)
+    return summary
+
 
 def get_summary(df: pd.DataFrame, output_obj: dict, summary_key: str):
     """Get the summary."""
-    output_obj["summary"][summary_key] = {}
-    output_obj["summary"][summary_key]["min"] = df[summary_key].min()
-    output_obj["summary"][summary_key]["max"] = df[summary_key].max()
-    output_obj["summary"][summary_key]["median"] = df[summary_key].median()
-    output_obj["summary"][summary_key]["mean"] = df[summary_key].mean()
-    output_obj["summary"][summary_key]["percentile_80"] = df[summary_key].quantile(0.80)
-    output_obj["summary"][summary_key]["percentile_90"] = df[summary_key].quantile(0.90)
-    output_obj["summary"][summary_key]["percentile_95"] = df[summary_key].quantile(0.95)
-    output_obj["summary"][summary_key]["percentile_99"] = df[summary_key].quantile(0.99)
+    output_obj["summary"][summary_key] = get_array_summary(
+        df[summary_key].to_numpy(dtype=np.float64, na_value=np.nan)
+    )
     return output_obj
+
+
+def print_summary_table(summary: dict):
+    """Print one line per summarized metric."""
+    print(f"{'metric':<30} {'mean':>12} {'median':>12} {'p90':>12} {'p99':>12} {'max':>12}")
+    for key, values in summary.items():
+        if isinstance(values, dict) and "mean" in values:
+            print(
+                f"{key:<30} {values['mean']:>12.3f} {values['median']:>12.3f} {values['percentile_90']:>12.3f} "
+                f"{values['percentile_99']:>12.3f} {values['max']:>12.3f}"
+            )
+
+
+def as_result_columns(results_list):
+    """Return results_list as a ResultColumns, converting a list of RequestResult."""
+    if isinstance(results_list, ResultColumns):
+        return results_list
+    results = ResultColumns()
+    results.extend(results_list)
+    return results